@@ -0,0 +1,55 @@
+"""Compare the matchers of `jay.match` on synthetic indexes.
+
+Usage:
+    python benchmarks/matchers.py [<size>...]
+
+Every matcher scores a few terms against every path of indexes of 1k,
+10k and 100k random paths (or the sizes given), like a fuzzy search
+without trigram candidates would, and the milliseconds per query are
+printed for each.
+"""
+from __future__ import print_function, unicode_literals
+import os
+import sys
+import random
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from jay.match import matcher
+
+
+SIZES = [1000, 10000, 100000]
+MATCHERS = ['fuzzy', 'subsequence']
+TERMS = ['proj', 'jay', 'srcdoc', 'tmp', 'zzq']
+WORDS = ['home', 'user', 'projects', 'src', 'docs', 'tmp', 'lib', 'python',
+         'jay', 'music', 'photos', 'work', 'api', 'build', 'node_modules',
+         'test', 'var', 'log', 'etc', 'config', 'backup', 'old', 'new']
+
+
+def paths(size, seed=0):
+    """`size` random paths 2 to 7 levels deep"""
+    rand = random.Random(seed)
+    return ['/' + '/'.join(rand.choice(WORDS) + rand.choice(['', '', str(rand.randint(1, 99))])
+                           for _ in range(rand.randint(2, 7)))
+            for _ in range(size)]
+
+
+def bench(name, choices, limit=10):
+    m = matcher(name)
+    start = time()
+    for term in TERMS:
+        m.best(term, choices, limit)
+    return (time() - start) / len(TERMS) * 1000
+
+
+def main(argv):
+    sizes = [int(size) for size in argv] or SIZES
+    print('{:>8} {:>14} {:>14}'.format('paths', *MATCHERS))
+    for size in sizes:
+        choices = paths(size)
+        print('{:>8} {:>11.1f} ms {:>11.1f} ms'.format(
+            size, *[bench(name, choices) for name in MATCHERS]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
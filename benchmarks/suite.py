@@ -0,0 +1,265 @@
+"""Time jay on synthetic indexes and dir trees, and compare against a
+baseline to catch regressions.
+
+Usage:
+    suite.py [options]
+
+Options:
+    --sizes <n,...>     dirs in each synthetic index [default: 1000,10000,100000]
+    --backend <name>    index backend, csv, binary or sqlite [default: csv]
+    --fanout <n>        child dirs of each dir of the tree walked [default: 6]
+    --depth <n>         levels of the tree walked [default: 4]
+    --repeat <n>        runs of each benchmark, the fastest counts [default: 5]
+    --output <file>     write the results there instead of stdout
+    --compare <file>    flag the results slower than in this earlier output
+    --tolerance <pct>   how much slower is a regression [default: 25]
+
+Run it as `python benchmarks/suite.py`. Everything happens in a temp
+dir that's removed afterwards, jay's data dir included. Indexes are made
+of random paths whose components follow a zipf distribution (a few
+names like src or projects are everywhere, most are rare), rooted in the
+temp dir so that the few dirs an end-to-end jump lands on can be created
+for real. For each size it times, in milliseconds:
+
+    load       opening the index and reading its rows
+    fuzzyfind  a search, without the query cache
+    update     a visit, journaled (and compacted once in a while)
+    dump       writing a snapshot
+    run        a whole `j TERM`, from parsing the args to printing
+
+and `walkdir` walks the tree with a few terms. Results are printed as
+json, and with --compare the ones over the tolerance are listed on
+stderr and the exit status is 1.
+"""
+from __future__ import print_function, unicode_literals
+import os
+import sys
+import json
+import bisect
+import random
+import shutil
+import platform
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+WORDS = ['src', 'projects', 'home', 'user', 'docs', 'lib', 'tmp', 'build',
+         'test', 'api', 'web', 'python', 'config', 'node_modules', 'music',
+         'photos', 'work', 'backup', 'old', 'new', 'data', 'scripts', 'bin',
+         'assets', 'vendor', 'dist', 'notes', 'downloads', 'jay', 'www']
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'ta', 'vo', 'zi', 'pe', 'sa',
+             'do', 'fu', 'gi', 'ha', 'je', 'bo']
+VOCABULARY_SIZE = 5000
+SEARCHES = 20  # terms searched by fuzzyfind and run
+VISITS = 100  # visits timed by update
+HOUR = 60 * 60
+
+
+def vocabulary(rand, size=VOCABULARY_SIZE):
+    """The common words, then made up names with some digits"""
+    names = list(WORDS)
+    while len(names) < size:
+        name = ''.join(rand.choice(SYLLABLES) for _ in range(rand.randint(2, 4)))
+        names.append(name + rand.choice(['', '', '', str(rand.randint(1, 20))]))
+    return names
+
+
+class Zipf(object):
+    """Picks names, the n-th one 1/n times as often as the first"""
+
+    def __init__(self, names, rand):
+        self.names = names
+        self.rand = rand
+        self.cumulative = []
+        total = 0.0
+        for n in range(1, len(names) + 1):
+            total += 1.0 / n
+            self.cumulative.append(total)
+
+    def __call__(self):
+        i = bisect.bisect(self.cumulative, self.rand.random() * self.cumulative[-1])
+        return self.names[min(i, len(self.names) - 1)]
+
+
+def synthetic_paths(root, size, seed=0):
+    """`size` distinct paths under `root`, 2 to 8 components deep"""
+    rand = random.Random(seed)
+    pick = Zipf(vocabulary(rand), rand)
+    paths = set()
+    while len(paths) < size:
+        depth = min(8, 2 + int(rand.expovariate(0.6)))
+        paths.add(os.path.join(root, *[pick() for _ in range(depth)]))
+    return sorted(paths)
+
+
+def synthetic_tree(root, fanout, depth, seed=0):
+    """Make dirs `depth` levels deep under `root`, each with `fanout`
+       children, returns the leaves"""
+    rand = random.Random(seed)
+    names = vocabulary(rand, fanout * 4)
+    level = [root]
+    for _ in range(depth):
+        level = [os.path.join(parent, name) for parent in level
+                 for name in rand.sample(names, fanout)]
+    for leaf in level:
+        os.makedirs(leaf)
+    return level
+
+
+def terms_of(paths, count, seed=0):
+    """Search terms: the start of the basename of some of the paths"""
+    rand = random.Random(seed)
+    return [os.path.basename(d)[:rand.randint(3, 5)] for d in rand.sample(paths, count)]
+
+
+def best_of(repeat, fn, *args):
+    """Milliseconds of the fastest of `repeat` calls"""
+    from jay.timings import clock
+    best = None
+    for _ in range(repeat):
+        start = clock()
+        fn(*args)
+        elapsed = (clock() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best, 4)
+
+
+def open_jay(idx_filename, size, backend):
+    import jay
+    jay.Jay._instance = None  # open the index again, as a new process would
+    return jay.Jay(idx_filename=idx_filename, idx_max_size=size, backend=backend)
+
+
+def bench_index(tmp, size, backend, repeat):
+    import jay
+    results = {}
+    data = os.path.join(tmp, 'data-{}'.format(size))
+    os.makedirs(data)
+    idx_filename = os.path.join(data, 'index')
+    paths = synthetic_paths(os.path.join(tmp, 'dirs'), size)
+    now = jay.time()
+    rand = random.Random(size)
+
+    j = open_jay(idx_filename, size, backend)
+    j.idx_rows = {d: now - rand.random() * 30 * 24 * HOUR for d in paths}
+    results['dump'] = best_of(repeat, j.dump)
+
+    def load():
+        len(open_jay(idx_filename, size, backend).idx_rows)
+    results['load'] = best_of(repeat, load)
+
+    terms = terms_of(paths, SEARCHES)
+    j = open_jay(idx_filename, size, backend)
+
+    def fuzzyfind():
+        for term in terms:
+            j._queries = None  # empty the query cache
+            if os.path.exists(j.store.queries_filename):
+                os.remove(j.store.queries_filename)
+            j.fuzzyfind(term)
+    results['fuzzyfind'] = round(best_of(repeat, fuzzyfind) / len(terms), 4)
+
+    visits = iter(synthetic_paths(os.path.join(tmp, 'visited'), VISITS * repeat, seed=size))
+
+    def update():
+        for _ in range(VISITS):
+            j.update(next(visits))
+    results['update'] = round(best_of(repeat, update) / VISITS, 4)
+
+    # the dirs jumps land on have to exist, or they are dropped
+    jay._data_home = data
+    open_jay(idx_filename, size, backend)
+    for term in terms:
+        d = jay.resolve([term])
+        if d and not os.path.isdir(d):
+            os.makedirs(d)
+
+    def run():
+        for term in terms:
+            if jay.run(jay.parse_args([term])) != 0:
+                raise RuntimeError('jumping to {} failed'.format(term))
+    out, jay.out = jay.out, lambda d: None
+    try:
+        open_jay(idx_filename, size, backend)  # run() reuses the singleton
+        results['run'] = round(best_of(repeat, run) / len(terms), 4)
+    finally:
+        jay.out = out
+    return results
+
+
+def bench_walkdir(tmp, fanout, depth, repeat):
+    import jay
+    root = os.path.join(tmp, 'tree')
+    leaves = synthetic_tree(root, fanout, depth)
+    walks = [[component[:3] for component in os.path.relpath(leaf, root).split(os.sep)]
+             for leaf in random.Random(depth).sample(leaves, min(SEARCHES, len(leaves)))]
+
+    def walk():
+        for terms in walks:
+            jay.walkdir(root, list(reversed(terms)))
+    return round(best_of(repeat, walk) / len(walks), 4)
+
+
+def compare(results, baseline, tolerance):
+    """The (name, baseline ms, ms) of the results over `tolerance`
+       percent slower than the baseline"""
+    return [(name, baseline[name], ms) for name, ms in sorted(results.items())
+            if name in baseline and ms > baseline[name] * (1 + tolerance / 100.0)]
+
+
+def main(argv):
+    from docopt import docopt
+    args = docopt(__doc__, argv=argv)
+    sizes = [int(size) for size in args['--sizes'].split(',')]
+    repeat = int(args['--repeat'])
+
+    tmp = tempfile.mkdtemp(prefix='jay-bench-')
+    try:
+        # keep jay away from the real data dir and the settings
+        # of whoever runs the benchmarks
+        os.environ['XDG_DATA_HOME'] = os.path.join(tmp, 'xdg')
+        os.environ['JAY_INDEX_SIZE'] = str(max(sizes))
+        os.environ['JAY_BACKEND'] = args['--backend']
+        for name in ('JAY_DEFER_WRITES', 'JAY_DIRCACHE', 'JAY_METRICS', 'JAY_PROFILE'):
+            os.environ.pop(name, None)
+        import jay
+
+        results = {}
+        for size in sizes:
+            for name, ms in bench_index(tmp, size, args['--backend'], repeat).items():
+                results['{}/{}'.format(name, size)] = ms
+        walkdir = 'walkdir/{}x{}'.format(args['--fanout'], args['--depth'])
+        results[walkdir] = bench_walkdir(tmp, int(args['--fanout']), int(args['--depth']), repeat)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {
+        'python': platform.python_version(),
+        'backend': args['--backend'],
+        'matcher': jay.MATCHER,
+        'results': results,
+    }
+    dumped = json.dumps(report, indent=2, sort_keys=True)
+    if args['--output']:
+        with open(args['--output'], 'w') as f:
+            f.write(dumped + '\n')
+    else:
+        print(dumped)
+
+    if args['--compare']:
+        with open(args['--compare']) as f:
+            baseline = json.load(f)
+        if any(baseline.get(key) != report[key] for key in ('python', 'backend', 'matcher')):
+            print('the baseline was run with another python, backend or matcher',
+                  file=sys.stderr)
+        regressions = compare(results, baseline['results'], float(args['--tolerance']))
+        for name, before, after in regressions:
+            print('regression: {} {:.3f} ms -> {:.3f} ms ({:+.0f}%)'.format(
+                name, before, after, (after / before - 1) * 100), file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
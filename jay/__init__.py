@@ -3,91 +3,301 @@ import os
 import sys
 import io
 from os.path import join
-from docopt import docopt
-from fuzzywuzzy import process
-from xdg import BaseDirectory
 from time import time
-from future.builtins import super
-import csv
+from jay import timings
 
 
-if sys.version_info.major < 3:
-    import unicodecsv as csv
+# heavier modules (docopt, fuzzywuzzy, xdg, csv) are imported
+# by the code paths that need them, `j` is called way too often
+# to pay for all of them on every jump
 
 
 __doc__ = """
 Usage:
-    jay [-h] [--setup-bash | --version] [INPUT ...]
+    jay [-h] [--setup-bash | --version] [--timings] [INPUT ...]
     jay --autocomplete <current-position> <params>...
+    jay --list [-n <k>] [--timings] [INPUT ...]
+    jay --batch [--record] [--timings]
+    jay --daemon
+    jay --crawl [<root>...]
+    jay --watch [<root>...]
+    jay --import <source>...
 
 -h --help       show this
 --setup-bash    setup `j` function and autocomplete for bash
 --version       print current version
+--timings       print how long each phase took to stderr
 --autocomplete  provides autocompletion instead of just one matching dir
+--list          print the best matches (or the top ranked dirs) as
+                score, rank and dir separated by tabs
+-n <k>          number of dirs listed [default: 10]
+--batch         print the dir each line of stdin leads to, or an empty line
+--record        count the dirs found by --batch as visits
+--daemon        keep the index in memory and serve queries over a unix socket
+--crawl         add the dirs under each root (or $JAY_ROOTS) to the index
+--watch         keep the index up to date with changes under each root (linux)
+--import        add the dirs visited in each source: bash, zsh, autojump, z,
+                fasd or a file in any of their formats
 """
 
 
 __version__ = '0.3'
 
-JAY_XDG_DATA_HOME = BaseDirectory.save_data_path('jay')
-RECENT_IDX_FILENAME = join(JAY_XDG_DATA_HOME, 'recent')
-IDX_FILENAME = join(JAY_XDG_DATA_HOME, 'index')  # index filename
-IDX_MAX_SIZE = 100  # max number of entries in the index
+RECENT_IDX_BASENAME = 'recent'
+IDX_BASENAME = 'index'  # index filename
+# max number of entries in the index, raise it along
+# with the sqlite backend to remember large histories
+IDX_MAX_SIZE = int(os.environ.get('JAY_INDEX_SIZE', 100))
+IDX_BACKEND = os.environ.get('JAY_BACKEND', 'csv')  # csv, binary or sqlite
+SOCKET_BASENAME = 'socket'  # daemon socket
+FUZZY_CANDIDATES = 200  # max number of dirs scored by a fuzzy search
+# how terms are matched against dirs, fuzzy or subsequence (see jay.match)
+MATCHER = os.environ.get('JAY_MATCHER', 'fuzzy')
+# most points frecency adds to the fuzzy score (0-100) of a dir
+FRECENCY_WEIGHT = 10
+DIRCACHE_BASENAME = 'dirs'  # cache of the child dirs listed by walkdir
+DIRCACHE = os.environ.get('JAY_DIRCACHE') == '1'
+# paths followed at once when walking dirs with several
+# terms, 1 to always follow the best match of each term
+WALKDIR_BEAM_WIDTH = int(os.environ.get('JAY_BEAM_WIDTH', 3))
+AUTOCOMPLETE_MAX = 20  # max number of completions
+PATH_CANDIDATES = 10  # indexed dirs tried before walking the filesystem
+AUTOCOMPLETE_DEADLINE = 0.03  # seconds a completion may take
+# seconds a jump may spend on the filesystem, see jay.probe
+FS_DEADLINE = float(os.environ.get('JAY_FS_DEADLINE', 0.5))
+SLOW_BASENAME = 'slow'  # mounts found slow, skipped for a while
+# dirs crawled or watched when no root is given
+CRAWL_ROOTS = [root for root in os.environ.get('JAY_ROOTS', '').split(os.pathsep) if root]
+# print the jump first and write the index after, in a child process
+DEFER_WRITES = os.environ.get('JAY_DEFER_WRITES') == '1'
+# append the timings of every invocation as json lines to the metrics file
+METRICS = os.environ.get('JAY_METRICS') == '1'
+METRICS_BASENAME = 'metrics'
+# dump cProfile stats of every invocation to this file
+PROFILE = os.environ.get('JAY_PROFILE')
 READ_MODE = 'rb' if sys.version_info.major < 3 else 'r'
 WRITE_MODE = 'wb' if sys.version_info.major < 3 else 'w'
 
+_data_home = None
+_dircache = None
+_deferred = []  # writes put off until the output is sent, see `defer`
+_listings = None  # dirs listed during a batch, see `batch`
 
-class Jay(object):
-    """Singleton of directories index"""
 
-    _instance = None
+def data_path(basename):
+    """Path of `basename` in jay's XDG data dir, which is created on first use"""
+    global _data_home
+    if _data_home is None:
+        with timings.phase('data_path'):
+            with timings.phase('import'):
+                from xdg import BaseDirectory
+            try:
+                _data_home = BaseDirectory.save_data_path('jay')
+            except OSError:  # another jay created it meanwhile
+                _data_home = BaseDirectory.save_data_path('jay')
+    return join(_data_home, basename)
+
+
+class Index(object):
+    """Index of directories opened by path, see `jay.store` for how
+       the index is stored by each backend. Any number of them can be
+       open at once, `Jay` is the one the command line uses"""
+
+    def __init__(self, idx_filename, idx_max_size=IDX_MAX_SIZE,
+                 journal_max_size=None, backend=IDX_BACKEND):
+        from jay import store
+        journal_max_size = journal_max_size or store.JOURNAL_MAX_SIZE
+        # how to open the index again, eg. on another thread
+        self.store_args = (backend, idx_filename, idx_max_size, journal_max_size)
+        with timings.phase('open'):
+            self.store = store.open_store(*self.store_args)
+        self._queries = None
+        self.resolved = set()  # dirs found in the index
 
-    def __new__(cls, *args, **kwargs):
-        if not cls._instance:
-            cls._instance = super().__new__(cls)
-        return cls._instance
+    @property
+    def idx_rows(self):
+        """Index entries as {dir: rank}, see `jay.frecency`"""
+        return self.store.rows
 
-    def __init__(self, idx_filename=IDX_FILENAME,
-                 idx_max_size=IDX_MAX_SIZE, recent_idx_filename=RECENT_IDX_FILENAME):
-        self.idx = idx_filename
-        self.idx_max_size = idx_max_size
-        self.recent_idx = recent_idx_filename
-        self.idx_rows = {}
+    @idx_rows.setter
+    def idx_rows(self, rows):
+        self.store.rows = rows
 
-        # create the idx file if does not exist
-        if not os.path.isfile(self.idx):
-            with io.open(self.idx, 'w') as f:
-                pass
+    def load(self):
+        """Index entries as they are on disk"""
+        return self.store.load()
 
-        with io.open(self.idx, 'r') as f:
-            # get each row from index,
-            # where each csv row is [dir, access_timestamp]
-            self.idx_rows = {d: ts for d, ts in csv.reader(f)}
+    @property
+    def queries(self):
+        """Cache of the dirs each term matched, see `jay.querycache`"""
+        if self._queries is None:
+            from jay.querycache import QueryCache
+            self._queries = QueryCache(self.store.queries_filename, self.store)
+        return self._queries
 
     def fuzzyfind(self, term):
-        result = process.extractOne(term, sorted(self.idx_rows.keys()))
-        if result:
-            directory, score = result
-            return directory
+        """The best match of `term`, the dirs that may be it are
+           cached along with their fuzzy score and rank, so that the
+           index is neither loaded nor scored to answer the term again"""
+        from jay.frecency import weight
+        with timings.phase('queries'):
+            contenders = self.queries.get(term)
+        if contenders is None:
+            contenders = self.contenders(term)
+            self.queries.set(term, contenders)
+        now = time()
+        best = None
+        for d, score, rank in contenders:
+            if rank is None:
+                continue  # gone from the index
+            score += FRECENCY_WEIGHT * weight(rank, now)
+            if best is None or score > best[1]:
+                best = d, score
+        if best is None:
+            return None
+        self.resolved.add(best[0])
+        return best[0]
+
+    def contenders(self, term):
+        """The (dir, fuzzy score, rank) that may be the best match of
+           `term` once their frecency is added: every one within
+           FRECENCY_WEIGHT of the best fuzzy score, sorted like the dirs
+           are scored"""
+        rows = self.idx_rows
+        with timings.phase('score'):
+            scores = list(self.fuzzy_scores(term, 1))
+        if not scores:
+            return []
+        best = max(score for d, score in scores)
+        return [(d, score, rows[d]) for d, score in scores
+                if score > best - FRECENCY_WEIGHT]
+
+    def pathfind(self, terms):
+        """The top ranked indexed dir that `terms` match component by
+           component (see `jay.components`), None if there's none or
+           they are gone"""
+        from jay import probe
+        with timings.phase('paths'):
+            directories = self.store.paths(terms, PATH_CANDIDATES)
+        for directory in directories:
+            # a dir on a slow mount is taken as it is in the index
+            if probe.isdir(directory, True):
+                return directory
         return None
 
+    def top(self, term, limit):
+        """The `limit` best matches of `term` in the index as
+           (dir, score, rank), from the best one. The score is the fuzzy
+           score of the dir plus up to FRECENCY_WEIGHT for its frecency,
+           without a term the top ranked dirs are returned"""
+        import heapq
+        from jay.frecency import weight
+        now = time()
+        rows = self.idx_rows
+        if not term:
+            return [(d, FRECENCY_WEIGHT * weight(rank, now), rank) for d, rank in
+                    heapq.nlargest(limit, rows.items(), key=lambda row: row[1])]
+
+        def scores():
+            # computed as the heap consumes them
+            for d, score in self.fuzzy_scores(term, limit):
+                rank = rows[d]
+                yield d, score + FRECENCY_WEIGHT * weight(rank, now), rank
+
+        with timings.phase('score'):
+            return heapq.nlargest(limit, scores(), key=lambda match: match[1])
+
+    def fuzzy_scores(self, term, limit):
+        """Lazily yield the (dir, fuzzy score) of the dirs matching `term`.
+           Only the dirs that share the most trigrams with the term are
+           scored, falling back to as many of the top ranked dirs when
+           none matches, in the order of the dirs so that ties are kept
+           like extractOne does"""
+        import heapq
+        from jay.match import matcher
+        limit = max(limit, FUZZY_CANDIDATES)
+        with timings.phase('candidates'):
+            candidates = self.store.candidates(term, limit)
+        timings.count('candidates', len(candidates))
+
+        matched = False
+        for d, score in matcher(MATCHER).scores(term, sorted(candidates)):
+            matched = True
+            yield d, score
+        if not matched:
+            # no dir shares trigrams with the term, or the matcher
+            # rejected every one that does. Scoring the whole index
+            # instead would take seconds on a large one
+            top = heapq.nlargest(limit, self.idx_rows.items(), key=lambda row: row[1])
+            fallback = set(d for d, rank in top).difference(candidates)
+            for d, score in matcher(MATCHER).scores(term, sorted(fallback)):
+                yield d, score
+
     def update(self, d):
-        """Write the directory to the index file"""
-        self.idx_rows.update({d: str(time())})
-        self.dump()
+        """Record a visit to the directory in the index"""
+        known = d in self.resolved
+        self.resolved.discard(d)
+        self.store.visit(d, time(), known=known)
+
+    def update_many(self, dirs):
+        """Record a visit to each of the dirs, in a single write"""
+        dirs = list(dirs)
+        known = self.resolved.intersection(dirs)
+        self.resolved.difference_update(dirs)
+        self.store.visit_many(dirs, time(), known=known)
 
     def delete(self, d):
-        """Remove the directory from the index file"""
-        self.idx_rows.pop(d, None)
-        self.dump()
+        """Remove the directory from the index"""
+        self.store.delete(d)
+
+    def delete_many(self, dirs):
+        """Remove the directories from the index, in a single write"""
+        self.store.delete_many(dirs)
 
     def dump(self):
-        """Dump the dirs to the index file"""
-        with io.open(self.idx, WRITE_MODE) as f:
-            # save the most recent dirs only
-            rows = [tup for tup in self.idx_rows.items()]
-            rows = sorted(rows, key=lambda x: x[1], reverse=True)
-            csv.writer(f).writerows(rows[:self.idx_max_size])
+        """Persist the top ranked dirs of the index"""
+        self.store.dump()
+
+    def deferred(self):
+        """Context manager holding every write to the index until it's
+           left, when they are made at once. They are dropped if it's
+           left by an exception:
+
+               with index.deferred():
+                   index.update(d)
+                   index.delete(gone)
+        """
+        return self.store.deferred()
+
+
+class Jay(Index):
+    """Singleton of the index the command line uses, in the XDG data
+       dir unless told otherwise, along with the recent dir"""
+
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super(Jay, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self, idx_filename=None,
+                 idx_max_size=IDX_MAX_SIZE, recent_idx_filename=None,
+                 journal_max_size=None, backend=IDX_BACKEND):
+        from jay import store
+        idx_filename = idx_filename or data_path(IDX_BASENAME)
+        journal_max_size = journal_max_size or store.JOURNAL_MAX_SIZE
+        self.recent_idx = recent_idx_filename or data_path(RECENT_IDX_BASENAME)
+
+        # the singleton is reused by the daemon, so only load the
+        # index again if it changed on disk since we last read it
+        if getattr(self, 'store_key', None) != (backend, idx_filename) or \
+                self.store.changed():
+            self.store_key = (backend, idx_filename)
+            super(Jay, self).__init__(idx_filename, idx_max_size,
+                                      journal_max_size, backend)
+        self.store.max_size = idx_max_size
+        self.store.journal_max_size = journal_max_size
 
     @property
     def recent_dir(self):
@@ -103,11 +313,12 @@ class Jay(object):
             except IndexError:
                 return ''
 
-    def update_recent_dir(self):
-        """Write the cwd to the RECENT_DIR_IDX file"""
+    def update_recent_dir(self, cwd=None):
+        """Write the cwd (or `cwd`) to the RECENT_DIR_IDX file"""
+        from jay.files import atomic_write
         try:
-            with io.open(self.recent_idx, WRITE_MODE) as f:
-                f.writelines([os.getcwd()])
+            with atomic_write(self.recent_idx, WRITE_MODE) as f:
+                f.writelines([cwd or os.getcwd()])
         except:
             raise Exception("jay: an error ocurred while opening the recent index {}.".format(self.recent_idx))
 
@@ -115,9 +326,13 @@ class Jay(object):
 def dispatch(d):
     """Try to saves cwd, updates the index and print
        the matched directory"""
+    from jay import probe
     j = Jay()
-    if not os.path.isdir(d):
+    # don't forget a dir that is only on a slow mount
+    if not probe.isdir(d, True):
         try:
+            j.queries.discard(d)
+            defer(j.queries.save)
             j.delete(d)
         except Exception as e:
             out(e)
@@ -126,8 +341,9 @@ def dispatch(d):
         finally:
             return 1
     try:
-        j.update_recent_dir()
-        j.update(d)
+        defer(j.queries.save)
+        defer(j.update_recent_dir, os.getcwd())
+        defer(j.update, d)
     except Exception as e:
         out(e)
         return 1
@@ -136,18 +352,65 @@ def dispatch(d):
         return 0
 
 
+def defer(fn, *args):
+    """Call `fn` once the output was sent if DEFER_WRITES is on,
+       or right away"""
+    if DEFER_WRITES:
+        _deferred.append((fn, args))
+    else:
+        with timings.phase('write'):
+            fn(*args)
+
+
+def run_deferred():
+    """Call the functions put off by `defer`"""
+    while _deferred:
+        fn, args = _deferred.pop(0)
+        try:
+            fn(*args)
+        except Exception as e:
+            sys.stderr.write('{}\n'.format(e))
+
+
+def drop_deferred():
+    """Forget the functions put off by `defer` without calling them"""
+    del _deferred[:]
+
+
+def detach_deferred():
+    """Send the output and let the shell go on, leaving the deferred
+       writes to a child process"""
+    if not _deferred:
+        return
+    sys.stdout.flush()
+    if not hasattr(os, 'fork'):
+        return run_deferred()
+
+    # the shell reads the output until every copy of our stdout is closed
+    with io.open(os.devnull, 'w') as devnull:
+        os.dup2(devnull.fileno(), sys.stdout.fileno())
+    if os.fork() == 0:
+        try:
+            os.setsid()  # don't go down with the shell's job
+            run_deferred()
+        finally:
+            os._exit(0)
+    del _deferred[:]
+
+
 def relative_of_cwd(term):
     """checks if term matches a relative directory of our cwd or term is a dir"""
     # if term is ... convert it to cwd + ../ + ../
     term = join('..', '..') if term == '...' else term
 
+    from jay import probe
     rel_of_cwd = join(os.getcwd(), term)
-    if os.path.isdir(rel_of_cwd):
+    if probe.isdir(rel_of_cwd, False):
         return os.path.abspath(rel_of_cwd)
     return None
 
 
-def walkdir(rootdir, terms):
+def walkdir(rootdir, terms, beam_width=WALKDIR_BEAM_WIDTH):
     """
     Recursively searches for child directories of the rootdir
     `terms` is a list that matches fuzzyly from the child directory name
@@ -155,31 +418,185 @@ def walkdir(rootdir, terms):
     1) walkdir('/root', terms=['dir2', 'dir1']) --> walkdir('/root/dir1', terms=['dir2'])
     2) walkdir('/root/dir1', terms=['dir2']) --> walkdir('/root/dir1/dir2', terms=[])
     3) walkdir('/root/dir1/dir2', terms=[]) --> '/root/dir1/dir2'
+    With a `beam_width` over 1 the search is done by `beamwalk` instead.
     """
+    if beam_width > 1:
+        return beamwalk(rootdir, terms, beam_width)
+
     if not len(terms):
         return rootdir
 
+    from jay.match import matcher
     term = terms.pop()
-    matched_dir = ''
-    match = process.extractOne(term, listdir(rootdir))
-    if match:
-        matched_dir, score = match
+    start = timings.clock()
+    directories = safe_listdir(rootdir)
+    matches = matcher(MATCHER).best(term, directories, 1)
+    timings.event('walkdir', term=term, paths=1, listed=len(directories),
+                  matched=len(matches), ms=round((timings.clock() - start) * 1000, 3))
+    matched_dir = matches[0][0] if matches else ''
     fulldir = join(rootdir, matched_dir)
-    return walkdir(fulldir, terms)
+    return walkdir(fulldir, terms, beam_width)
 
 
-def listdir(path):
-    """Lists directories only"""
-    directories = []
-    for d in os.listdir(path):
-        if not os.path.isdir(os.path.join(path, d)):
-            continue
-        directories.append(d)
-    return sorted(directories)
+def beamwalk(rootdir, terms, width):
+    """
+    Like walkdir, but instead of following only the best match for each
+    term it follows the `width` paths with the best total score so far,
+    so a wrong pick near the root doesn't send the whole search to the
+    wrong subtree. It takes at most `width` listings per term, and the
+    listings of each level are read concurrently.
+    """
+    import heapq
+    from jay.match import matcher
+
+    beam = [(0, rootdir)]  # (total score, path)
+    terms = list(terms)
+    with listing_pool(width) as pool:
+        while terms:
+            term = terms.pop()
+            start = timings.clock()
+            listings = list(pool.map(safe_listdir, [path for score, path in beam]))
+            candidates = []
+            for (score, path), directories in zip(beam, listings):
+                matches = matcher(MATCHER).best(term, directories, width)
+                if not matches:
+                    # nothing to match, the path ends here
+                    candidates.append((score, join(path, '')))
+                for matched_dir, match_score in matches:
+                    candidates.append((score + match_score, join(path, matched_dir)))
+            # same as a stable sort, ties go to the first path listed
+            beam = heapq.nlargest(width, candidates, key=lambda c: c[0])
+            timings.event('walkdir', term=term, paths=len(listings),
+                          listed=sum(len(directories) for directories in listings),
+                          matched=len(candidates),
+                          ms=round((timings.clock() - start) * 1000, 3))
+    return beam[0][1]
+
+
+def listing_pool(workers):
+    """Pool of threads to list dirs concurrently, listing is mostly
+       waiting for the disk (or the network on remote mounts)"""
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:  # python2 without the futures backport
+        return SerialPool()
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+class SerialPool(object):
+    """Stand in for a ThreadPoolExecutor that does the work itself"""
 
+    def __enter__(self):
+        return self
 
-def autocomplete(params, current_position):
-    out(current_position)
+    def __exit__(self, *exc_info):
+        pass
+
+    def map(self, fn, *iterables):
+        return map(fn, *iterables)
+
+
+def safe_listdir(path):
+    """listdir, but paths that can't be read have no child dirs"""
+    try:
+        return listdir(path)
+    except OSError:
+        return []
+
+
+def listdir(path):
+    """Lists directories only, raises `jay.probe.SlowPath`
+       if the path is too slow to list"""
+    if _listings is not None and path in _listings:
+        return _listings[path]
+    from jay import probe
+    with timings.phase('listdir'):
+        directories = probe.call(read_dirs, path, listdir_cache())
+    timings.count('listed', len(directories))
+    if _listings is not None:
+        _listings[path] = directories
+    return directories
+
+
+def read_dirs(path, cache):
+    if cache is not None:
+        from jay.dircache import mtime
+        path_mtime = mtime(path)
+        directories = cache.get(path, path_mtime)
+        if directories is not None:
+            return directories
+
+    if hasattr(os, 'scandir'):
+        # the type of each entry comes with the listing (d_type),
+        # so there's no need to stat every one of them
+        directories = [entry.name for entry in os.scandir(path) if entry.is_dir()]
+    else:
+        directories = [d for d in os.listdir(path) if os.path.isdir(join(path, d))]
+    directories.sort()
+
+    if cache is not None:
+        cache.set(path, path_mtime, directories)
+    return directories
+
+
+def listdir_cache():
+    """The cache of listed dirs, if it's enabled"""
+    global _dircache
+    if _dircache is None and DIRCACHE:
+        import atexit
+        from jay.dircache import DirCache
+        _dircache = DirCache(data_path(DIRCACHE_BASENAME))
+        atexit.register(_dircache.save)
+    return _dircache
+
+
+def autocomplete(params, current_position, deadline=AUTOCOMPLETE_DEADLINE):
+    """Print the dirs that complete the word at `current_position` of `params`:
+       the top ranked dirs in the index with a component starting with it,
+       and the dirs under the partial path it is. It doesn't wait for the
+       search over `deadline` seconds, a TAB shouldn't block the shell, and
+       prints whatever was found until then. The search may go on after
+       that, so it opens the index again instead of sharing the one of
+       this thread (which the daemon goes on using), and it doesn't
+       touch the cache of listed dirs"""
+    import threading
+    from jay.store import open_store
+    try:
+        word = params[int(current_position)]
+    except (IndexError, ValueError):
+        word = ''  # bash leaves out the empty word being completed
+
+    store_args = Jay().store_args
+    completions = []
+
+    def find():
+        if word and not word.startswith(('/', '.', '~')) and os.sep not in word:
+            completions.extend(open_store(*store_args).complete(word, AUTOCOMPLETE_MAX))
+        completions.extend(complete_path(word))
+
+    worker = threading.Thread(target=find)
+    worker.daemon = True  # don't wait for it to exit
+    worker.start()
+    worker.join(deadline)
+
+    seen = set()
+    for d in list(completions):
+        if d not in seen and len(seen) < AUTOCOMPLETE_MAX:
+            seen.add(d)
+            out(d)
+    return 0
+
+
+def complete_path(word):
+    """Child dirs of the partial path `word` (relative to the cwd)
+       starting with its last component"""
+    head, tail = os.path.split(word)
+    try:
+        directories = read_dirs(join(os.getcwd(), os.path.expanduser(head)), None)
+    except OSError:
+        return []
+    return [join(head, d) for d in directories
+            if d.startswith(tail) and (tail.startswith('.') or not d.startswith('.'))]
 
 
 def run(args):
@@ -188,16 +605,79 @@ def run(args):
         setup_bash()
         return 0
 
+    if args['--version']:
+        out(__version__)
+        return 0
+
+    if args['--daemon']:
+        from jay.daemon import serve
+        return serve(data_path(SOCKET_BASENAME))
+
+    if args['--crawl']:
+        from jay.crawl import crawl, CRAWL_BASENAME
+        from jay.dircache import DirCache
+        listings = DirCache(data_path(CRAWL_BASENAME), max_size=None)
+        added, kept = crawl(Jay(), args['<root>'] or CRAWL_ROOTS, listings)
+        out('jay: discovered {} dirs, the index kept {}.'.format(added, kept))
+        if kept < added:
+            sys.stderr.write('jay: the index is too small to keep the dirs discovered, '
+                             'raise JAY_INDEX_SIZE (now {}).\n'.format(IDX_MAX_SIZE))
+        return 0
+
+    if args['--import']:
+        from jay.history import import_history
+        try:
+            imported = import_history(Jay(), args['<source>'])
+        except (IOError, OSError, ValueError) as e:
+            out('jay: {}'.format(e))
+            return 1
+        out('jay: imported {} dirs.'.format(imported))
+        return 0
+
+    if args['--watch']:
+        from jay.watch import Watcher
+        try:
+            Watcher(Jay(), args['<root>'] or CRAWL_ROOTS).run()
+        except KeyboardInterrupt:
+            pass
+        except OSError as e:
+            out(e)
+            return 1
+        return 0
+
     if args['--autocomplete']:
         return autocomplete(params=args['<params>'],
                             current_position=args['<current-position>'])
 
+    if args['--list']:
+        try:
+            limit = int(args['-n'])
+        except ValueError:
+            out('jay: -n takes a number of dirs.')
+            return 1
+        for d, score, rank in Jay().top(' '.join(args['INPUT']), limit):
+            out('{:.2f}\t{:.2f}\t{}'.format(score, rank, d))
+        return 0
+
+    if args['--batch']:
+        return batch(sys.stdin, record=args['--record'])
+
     search_terms = args['INPUT']
 
     # if len(terms) is 0 jump to previous dir
     if not len(search_terms):
         return dispatch(Jay().recent_dir)
 
+    directory = resolve(search_terms)
+    if directory:
+        return dispatch(directory)
+    return 1  # else we didn't find anything
+
+
+def resolve(search_terms):
+    """The dir the search terms lead to, None if there's none.
+       Nothing is written, see `dispatch` for that"""
+    search_terms = list(search_terms)
     first_term = search_terms[0]  # first search term
 
     # check if first_term is a relative dir of cwd or a dir
@@ -207,25 +687,53 @@ def run(args):
     #   if first arg is a relative dir, use it as rootdir and then
     #   recursively search for best match with starting chars of each arg
     if len(search_terms) > 1:
+        # from the root, the dirs in the index are tried first, and the
+        # filesystem is only walked when none of them matches
+        if not rel_directory:
+            directory = Jay().pathfind(search_terms)
+            if directory:
+                return directory
         search_terms.reverse()
         rootdir = rel_directory if rel_directory else '/'
         if rel_directory:
             search_terms.pop()  # becouse rel_directory is our rootdir now
-        result = walkdir(rootdir, terms=search_terms)
-        if result:
-            return dispatch(result)
-        return 1  # else we didn't find anything
+        return walkdir(rootdir, terms=search_terms) or None
 
     # len(terms) is 1, if rel_directory is a dir, cd to it
     if rel_directory:
-        return dispatch(rel_directory)
+        return rel_directory
 
     # len(input) is 1, fuzzy search index with the term, cd to matched dir
-    directory = Jay().fuzzyfind(first_term)
-    if directory:
-        return dispatch(directory)
+    return Jay().fuzzyfind(first_term)
 
-    return 1  # else we didn't find anything
+
+def batch(lines, record=False):
+    """Resolve each of `lines` as the terms of a jump, printing the dir
+       it leads to (or an empty line) as soon as it's found. The index
+       is only updated to `record` the visits, and the dirs listed are
+       kept for the whole batch"""
+    global _listings
+    from jay import probe
+    j = Jay()
+    _listings = {}
+    try:
+        for line in lines:
+            probe.rearm()  # every query gets the budget of a jump
+            terms = line.split()
+            directory = resolve(terms) if terms else None
+            if directory and not probe.isdir(directory, True):
+                if record:
+                    j.queries.discard(directory)
+                    defer(j.delete, directory)
+                directory = None
+            if directory and record:
+                defer(j.update, directory)
+            out(directory or '')
+            sys.stdout.flush()
+    finally:
+        _listings = None
+    defer(j.queries.save)
+    return 0
 
 
 def setup_bash():
@@ -240,10 +748,99 @@ def out(d):
     print(d)
 
 
-def main():
-    args = docopt(__doc__, argv=None, help=True,
+def parse_args(argv):
+    """Parse the command line, the common cases (search terms only, or
+       a single flag) are handled by hand and docopt is only imported
+       for anything else"""
+    args = {'--autocomplete': False,
+            '--batch': False,
+            '--crawl': False,
+            '--daemon': False,
+            '--help': False,
+            '--import': False,
+            '--list': False,
+            '--record': False,
+            '--setup-bash': False,
+            '--timings': False,
+            '--version': False,
+            '--watch': False,
+            '-n': '10',
+            '<current-position>': None,
+            '<params>': [],
+            '<root>': [],
+            '<source>': [],
+            'INPUT': []}
+
+    if len(argv) == 1 and argv[0] in ('--setup-bash', '--version', '--daemon', '--batch'):
+        args[argv[0]] = True
+        return args
+
+    if len(argv) > 2 and argv[0] == '--autocomplete':
+        args['--autocomplete'] = True
+        args['<current-position>'] = argv[1]
+        args['<params>'] = list(argv[2:])
+        return args
+
+    if not any(arg.startswith('-') for arg in argv):
+        args['INPUT'] = list(argv)
+        return args
+
+    with timings.phase('import'):
+        from docopt import docopt
+    return docopt(__doc__, argv=argv, help=True,
                   options_first=False, version=__version__)
-    return run(args)
+
+
+def main():
+    argv = sys.argv[1:]
+    show_timings = '--timings' in argv
+    if show_timings or METRICS:
+        timings.enable()
+        argv = [arg for arg in argv if arg != '--timings']
+
+    if PROFILE:
+        status = timings.profile(PROFILE, answer, argv)
+    else:
+        status = answer(argv)
+
+    if show_timings:
+        timings.report(sys.stderr)
+    if METRICS:
+        timings.append(data_path(METRICS_BASENAME), argv)
+    detach_deferred()
+    return status
+
+
+def forwarded(argv):
+    """Whether a running daemon may answer `argv`: jumps, lists and
+       completions. Anything else may block its single thread, or
+       depends on the client's environment (or stdin)"""
+    if argv and argv[0] == '--autocomplete':
+        return True
+    return all(not arg.startswith('-') or arg == '--list' or arg.startswith('-n')
+               for arg in argv)
+
+
+def answer(argv):
+    """Run jay with `argv`, or let a running daemon do it"""
+    if forwarded(argv):
+        socket_filename = data_path(SOCKET_BASENAME)
+        if os.path.exists(socket_filename):
+            # let a running daemon answer, if there is one
+            from jay.daemon import forward
+            with timings.phase('forward'):
+                status = forward(argv, socket_filename)
+            if status is not None:
+                return status
+
+    with timings.phase('parse_args'):
+        args = parse_args(argv)
+    if not (args['--version'] or args['--setup-bash']):
+        # these don't need the data dir, nor xdg to find it
+        from jay import probe
+        probe.arm(FS_DEADLINE, data_path(SLOW_BASENAME))
+    with timings.phase('run'):
+        return run(args)
 
 
 if __name__ == '__main__':
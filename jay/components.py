@@ -0,0 +1,89 @@
+"""Index of the components of the indexed dirs, to resolve jumps with
+several terms (`j proj api`) against the known dirs before walking the
+filesystem from the root.
+
+A dir matches the terms when they start some of its components in the
+same order (ignoring case), like walking down the filesystem would
+match them but skipping the components in between, and it resolves to
+the dir up to the component matching the last term. The index maps
+every component to the dirs having it, and looks up the components
+starting with a term by bisecting them sorted.
+"""
+from __future__ import unicode_literals
+import os
+import bisect
+import heapq
+from jay.postings import PostingsIndex
+from jay.trie import components
+
+
+def match_components(d, terms):
+    """`d` up to the component matching the last of `terms`, None if
+       the terms don't start components of `d` in order"""
+    parts = d.split(os.sep)
+    i = 0
+    for term in terms:
+        term = term.lower()
+        while i < len(parts) and not (parts[i] and parts[i].lower().startswith(term)):
+            i += 1
+        if i == len(parts):
+            return None
+        i += 1
+    return os.sep.join(parts[:i]) or os.sep
+
+
+def best_paths(rows, terms, limit):
+    """The `limit` top ranked dirs that the (dir, rank) `rows` resolve
+       `terms` to, each ranked as the top ranked row resolving to it"""
+    ranks = {}
+    for d, rank in rows:
+        path = match_components(d, terms)
+        if path is not None and (path not in ranks or rank > ranks[path]):
+            ranks[path] = rank
+    return heapq.nlargest(limit, ranks, key=ranks.get)
+
+
+class ComponentIndex(PostingsIndex):
+    """Maps each lowercased component to the set of dirs having it"""
+
+    def __init__(self, dirs=()):
+        self._sorted = None  # components sorted, worked out on lookup
+        super(ComponentIndex, self).__init__(dirs)
+
+    keys = staticmethod(components)
+
+    def add(self, d):
+        size = len(self.postings)
+        super(ComponentIndex, self).add(d)
+        if len(self.postings) != size:
+            self._sorted = None
+
+    def discard(self, d):
+        size = len(self.postings)
+        super(ComponentIndex, self).discard(d)
+        if len(self.postings) != size:
+            self._sorted = None
+
+    def starting_with(self, prefix):
+        """The dirs having a component starting with `prefix`"""
+        if self._sorted is None:
+            self._sorted = sorted(self.postings)
+        prefix = prefix.lower()
+        dirs = set()
+        for i in range(bisect.bisect_left(self._sorted, prefix), len(self._sorted)):
+            component = self._sorted[i]
+            if not component.startswith(prefix):
+                break
+            dirs.update(self.postings[component])
+        return dirs
+
+    def candidates(self, terms):
+        """The dirs having components starting with each of `terms`, in
+           whatever order, which `match_components` has to check"""
+        dirs = None
+        # the longer terms start fewer components, so they go first
+        for term in sorted(terms, key=len, reverse=True):
+            dirs = self.starting_with(term) if dirs is None else dirs & self.starting_with(term)
+            if not dirs:
+                break
+        return dirs or set()
@@ -0,0 +1,99 @@
+"""Crawl the filesystem under some roots adding the dirs found to the
+index, so `j` can jump to dirs that were never visited, like fresh
+checkouts, without a slow `walkdir` from /.
+
+Dirs found by the crawler are "discovered": they rank as if visited
+once DISCOVERED_AGE ago, so any visited dir ranks (and outlives them
+in the index) above them, and a crawl never touches dirs already in the
+index. The listing of each crawled dir is remembered along with its
+mtime, and only dirs whose mtime changed are listed again, but every
+dir crawled is checked against the index, so the dirs evicted from it
+or deleted since the last crawl are discovered again.
+
+Discovered dirs rank below every visited one, so a small index evicts
+them first: crawls tell how many dirs the index kept.
+"""
+from __future__ import unicode_literals
+import os
+from os.path import join
+from time import time
+
+
+CRAWL_BASENAME = 'crawl'  # crawled listings, in the XDG data dir
+CRAWL_MAX_DEPTH = 8  # levels below each root
+CRAWL_MAX_ENTRIES = 100000  # dirs looked at in a crawl
+CRAWL_BATCH_SIZE = 1000  # dirs added to the index at once
+DISCOVERED_AGE = 365 * 24 * 60 * 60  # how older than visits discoveries are
+
+
+def crawl(j, roots, listings, max_depth=CRAWL_MAX_DEPTH,
+          max_entries=CRAWL_MAX_ENTRIES, batch_size=CRAWL_BATCH_SIZE):
+    """Add the dirs under `roots` that aren't in the index of `j` yet,
+       `listings` is the DirCache of the previous crawls.
+       Returns the number of dirs added, and how many of them the
+       index kept once trimmed to its max size"""
+    rank = time() - DISCOVERED_AGE
+    added = []
+    for batch in batches(walk(roots, listings, max_depth, max_entries), batch_size):
+        rows = [(d, rank) for d in batch if d not in j.idx_rows]
+        j.store.update_many(rows)
+        added.extend(d for d, rank in rows)
+    listings.save()
+    if not added:
+        return 0, 0
+    j.dump()  # trim the index, to tell what it kept
+    rows = j.idx_rows
+    return len(added), sum(1 for d in added if d in rows)
+
+
+def walk(roots, listings, max_depth, max_entries):
+    """Yield the dirs under `roots` (depth first), the ones that didn't
+       change since the last crawl are only stat'ed to find out, and
+       aren't listed again. At most `max_entries` dirs are looked at"""
+    from jay.dircache import mtime
+    stack = [(os.path.abspath(root), 0) for root in reversed(roots)]
+    entries = 0
+    while stack and entries < max_entries:
+        path, depth = stack.pop()
+        entries += 1
+        try:
+            path_mtime = mtime(path)
+        except OSError:
+            continue  # gone since its parent was listed
+
+        directories = listings.get(path, path_mtime)
+        if directories is None:
+            try:
+                directories = children(path)
+            except OSError:
+                continue  # eg. permission denied
+            listings.set(path, path_mtime, directories)
+        yield path
+
+        if depth < max_depth:
+            stack.extend((join(path, d), depth + 1) for d in reversed(directories))
+
+
+def children(path):
+    """Child dirs of `path` worth crawling, hidden dirs and links
+       to dirs (which may loop back) are left out"""
+    if hasattr(os, 'scandir'):
+        return sorted(entry.name for entry in os.scandir(path)
+                      if not entry.name.startswith('.') and
+                      entry.is_dir(follow_symlinks=False))
+    return sorted(d for d in os.listdir(path)
+                  if not d.startswith('.') and
+                  os.path.isdir(join(path, d)) and
+                  not os.path.islink(join(path, d)))
+
+
+def batches(iterable, size):
+    """Split `iterable` in lists of `size` items, lazily"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
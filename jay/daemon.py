@@ -0,0 +1,176 @@
+"""A resident jay process that keeps the index loaded and answers queries
+sent over a unix socket, so each `j` doesn't have to pay for a new
+interpreter, imports and parsing the index.
+
+Each request is a single json line with the argv and cwd of the client,
+the reply is a json document with the exit status and the output. The
+writes to the index a request makes are held until its reply is sent,
+and dropped if the client gave up waiting and answered it by itself.
+"""
+from __future__ import unicode_literals
+import os
+import io
+import sys
+import json
+import select
+import socket
+import signal
+from contextlib import closing
+
+
+BUFSIZE = 4096
+# seconds a client waits for the daemon before answering by itself,
+# a stuck daemon mustn't freeze every shell
+FORWARD_TIMEOUT = 1.0
+CLIENT_TIMEOUT = 1.0  # seconds the daemon waits for a request
+
+
+def serve(path):
+    """Answer requests on the unix socket `path` until interrupted"""
+    if is_listening(path):
+        print("jay: a daemon is already listening on {}.".format(path))
+        return 1
+    if os.path.exists(path):
+        os.remove(path)  # stale socket from a daemon that died
+
+    # clean up the socket when killed too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+        os.chmod(path, 0o600)
+        server.listen(16)
+        while True:
+            accept(server)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def accept(server):
+    """Answer the next client, one that goes away or sends garbage
+       doesn't take the daemon down"""
+    conn, _ = server.accept()
+    with closing(conn):
+        conn.settimeout(CLIENT_TIMEOUT)
+        try:
+            handle(conn)
+        except (socket.error, KeyError, TypeError) as e:
+            sys.stderr.write('jay: dropped a client: {}\n'.format(e))
+
+
+def handle(conn):
+    """Read one request from `conn` and send back its reply"""
+    try:
+        request = json.loads(recvall(conn, until=b'\n').decode('utf-8'))
+    except ValueError:
+        return
+    import jay
+    defer_writes, jay.DEFER_WRITES = jay.DEFER_WRITES, True
+    try:
+        status, output = respond(request['argv'], request['cwd'])
+    finally:
+        jay.DEFER_WRITES = defer_writes
+    if not connected(conn):
+        jay.drop_deferred()  # the client answered it by itself meanwhile
+        return
+    reply = json.dumps({'status': status, 'output': output})
+    try:
+        conn.sendall(reply.encode('utf-8'))
+    except socket.error:
+        jay.drop_deferred()
+        raise
+    jay.run_deferred()
+
+
+def connected(conn):
+    """Whether the client of `conn` is still waiting for its reply"""
+    if not hasattr(select, 'poll'):
+        return True
+    poller = select.poll()
+    poller.register(conn, select.POLLHUP)
+    return not any(event & (select.POLLHUP | select.POLLERR)
+                   for fd, event in poller.poll(0))
+
+
+def respond(argv, cwd):
+    """Run jay with `argv` as if it were called from `cwd`,
+       returns the exit status and everything it printed"""
+    import jay
+    from jay import probe
+
+    stdout = sys.stdout
+    sys.stdout = buf = io.StringIO()
+    try:
+        # relative jumps and the recent dir depend on the client's cwd
+        os.chdir(cwd)
+        probe.arm(jay.FS_DEADLINE, jay.data_path(jay.SLOW_BASENAME))
+        args = jay.parse_args(argv)
+        if args['--daemon']:
+            status = 1
+        else:
+            status = jay.run(args)
+    except SystemExit as e:
+        # docopt exits on --help, --version and bad usage
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            print(e.code)
+            status = 1
+    except Exception as e:
+        print(e)
+        status = 1
+    finally:
+        sys.stdout = stdout
+        probe.disarm()
+    return status, buf.getvalue()
+
+
+def forward(argv, path):
+    """Ask the daemon listening on `path` to run `argv`, printing its output.
+       Returns its exit status or None if there is no daemon to talk to"""
+    if not os.path.exists(path):
+        return None
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(FORWARD_TIMEOUT)
+    with closing(client):
+        try:
+            client.connect(path)
+            request = json.dumps({'argv': argv, 'cwd': os.getcwd()})
+            client.sendall(request.encode('utf-8') + b'\n')
+            client.shutdown(socket.SHUT_WR)
+            reply = json.loads(recvall(client).decode('utf-8'))
+        except (socket.error, ValueError, OSError):
+            return None
+
+    sys.stdout.write(reply['output'])
+    sys.stdout.flush()
+    return reply['status']
+
+
+def is_listening(path):
+    """Check if there is a daemon accepting connections on `path`"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with closing(client):
+        try:
+            client.connect(path)
+        except socket.error:
+            return False
+    return True
+
+
+def recvall(conn, until=None):
+    """Read from `conn` until EOF or the `until` delimiter"""
+    chunks = []
+    while True:
+        chunk = conn.recv(BUFSIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if until is not None and chunk.endswith(until):
+            break
+    return b''.join(chunks)
@@ -0,0 +1,62 @@
+"""On disk cache of the child directories of the directories listed
+by `jay.listdir`, so jumping into the same trees again and again doesn't
+read them every time. A cached listing is valid as long as the mtime of
+its directory doesn't change, which happens whenever a child is added,
+removed or renamed.
+"""
+from __future__ import unicode_literals
+import os
+import io
+import marshal
+from time import time
+from jay.files import atomic_write
+
+
+DIRCACHE_MAX_SIZE = 10000  # max number of cached listings
+# listings of dirs modified this recently (in seconds) aren't cached,
+# since another change within the same mtime tick would go unnoticed
+DIRCACHE_MIN_AGE = 2
+
+
+def mtime(path):
+    st = os.stat(path)
+    return getattr(st, 'st_mtime_ns', st.st_mtime)
+
+
+class DirCache(object):
+    """Maps a dir to its mtime and its sorted child dirs,
+       a `max_size` of None doesn't limit the number of dirs"""
+
+    def __init__(self, filename, max_size=DIRCACHE_MAX_SIZE):
+        self.filename = filename
+        self.max_size = max_size
+        self.dirty = False
+        try:
+            with io.open(filename, 'rb') as f:
+                self.entries = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            self.entries = {}
+
+    def get(self, path, path_mtime):
+        """Cached child dirs of `path`, None if they aren't cached or
+           `path` was modified since"""
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == path_mtime:
+            return list(entry[1])
+        return None
+
+    def set(self, path, path_mtime, directories):
+        if time() - os.stat(path).st_mtime < DIRCACHE_MIN_AGE:
+            return
+        if self.max_size is not None and path not in self.entries and \
+                len(self.entries) >= self.max_size:
+            del self.entries[next(iter(self.entries))]
+        self.entries[path] = (path_mtime, list(directories))
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        with atomic_write(self.filename) as f:
+            marshal.dump(self.entries, f)
+        self.dirty = False
@@ -0,0 +1,34 @@
+"""Atomic writes of the files jay keeps next to the index, so a reader
+(another `j` running meanwhile) sees either the old file or the new one,
+never one half written.
+"""
+from __future__ import unicode_literals
+import io
+import os
+from contextlib import contextmanager
+
+
+# atomically replace a file, os.rename does it on posix only
+replace = getattr(os, 'replace', os.rename)
+
+
+def tmp_filename(filename):
+    """A temporary file next to `filename`, private to this process"""
+    return '{}.{}.tmp'.format(filename, os.getpid())
+
+
+@contextmanager
+def atomic_write(filename, mode='wb'):
+    """Open a temporary file to write, that replaces `filename` once
+       written, or is removed if writing it fails"""
+    tmp = tmp_filename(filename)
+    try:
+        with io.open(tmp, mode) as f:
+            yield f
+        replace(tmp, filename)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
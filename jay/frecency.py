@@ -0,0 +1,38 @@
+"""Frecency of the indexed dirs: every visit to a dir counts one, and
+counts half as much every FRECENCY_HALF_LIFE seconds.
+
+The decayed sum of the visits of a dir is kept as a single number, its
+rank: the time a single visit would have been made to be worth as much.
+A dir visited once ranks at the time of the visit, more visits push its
+rank forward, and time doesn't change the order of the ranks, so they
+are stored, compared and evicted like access timestamps, and a visit
+only updates the rank of the dir visited.
+"""
+from __future__ import unicode_literals
+import math
+
+
+FRECENCY_HALF_LIFE = 14 * 24 * 60 * 60  # seconds for a visit to count half
+DECAY = math.log(2) / FRECENCY_HALF_LIFE
+MAX_EXPONENT = 700  # math.exp overflows a bit over it
+
+
+def visit(rank, ts):
+    """Rank of a dir with `rank` (None if it was never visited)
+       after a visit at `ts`"""
+    if rank is None:
+        return ts
+    # log(exp(rank) + exp(ts)) in decay units, without overflowing
+    high, low = max(rank, ts), min(rank, ts)
+    return high + math.log1p(math.exp(DECAY * (low - high))) / DECAY
+
+
+def weight(rank, now):
+    """Frecency of a dir with `rank` at `now`, squashed in (0, 1)"""
+    exponent = DECAY * (rank - now)
+    if exponent < -MAX_EXPONENT:
+        return 0.0
+    if exponent > MAX_EXPONENT:
+        return 1.0
+    frecency = math.exp(exponent)
+    return frecency / (1 + frecency)
@@ -0,0 +1,41 @@
+"""Trigram inverted index over the indexed dirs, so a fuzzy search only
+has to score the dirs that share the most trigrams with the search term
+instead of every dir in the index.
+
+Dirs are split into words the way fuzzywuzzy splits them (lowercased, on
+anything that isn't alphanumeric) and each word is padded before taking
+its trigrams, so short terms and word prefixes still get matches.
+"""
+from __future__ import unicode_literals
+import re
+import heapq
+from collections import defaultdict
+from jay.postings import PostingsIndex
+
+
+WORDS = re.compile(r'\w+', re.UNICODE)
+
+
+def trigrams(s):
+    """Set of the trigrams of every word in `s`"""
+    grams = set()
+    for word in WORDS.findall(s.lower()):
+        word = '  {} '.format(word)
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+class GramIndex(PostingsIndex):
+    """Maps each trigram to the set of dirs containing it"""
+
+    keys = staticmethod(trigrams)
+
+    def candidates(self, term, limit):
+        """The `limit` dirs sharing the most trigrams with `term`"""
+        counts = defaultdict(int)
+        for gram in trigrams(term):
+            for d in self.postings.get(gram, ()):
+                counts[d] += 1
+        if len(counts) <= limit:
+            return list(counts)
+        return heapq.nlargest(limit, counts, key=counts.get)
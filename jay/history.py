@@ -0,0 +1,204 @@
+"""Import the dirs visited from shell histories and the data files of
+other jumpers, to start with an index that already knows where you go.
+
+Every source is read line by line through a pipeline of generators
+yielding (path, ts, count) records, so huge histories are read in
+constant memory: only the distinct dirs are kept, merged as they come.
+The formats read are:
+
+    bash      `cd` commands of ~/.bash_history, timed by the `#ts` lines
+              written along with HISTTIMEFORMAT
+    zsh       `cd` commands of ~/.zsh_history, timed with EXTENDED_HISTORY
+    autojump  weight<TAB>path lines of autojump.txt
+    z, fasd   path|count|ts lines of ~/.z and ~/.fasd
+
+Relative `cd`s are followed from the last absolute one, and commands
+without a time count as run when the history was last written. The
+counts and times of a dir are merged into a single rank, as if every
+visit was made with `jay.frecency.visit`.
+"""
+from __future__ import unicode_literals
+import io
+import os
+import math
+from itertools import chain
+from jay.frecency import visit, DECAY
+
+
+FORMATS = ('bash', 'zsh', 'autojump', 'z', 'fasd')
+CD_COMMANDS = ('cd', 'pushd')
+AUTOJUMP_VISIT_WEIGHT = 10.0  # autojump weighs n visits as 10 * sqrt(n)
+
+
+def default_filename(fmt):
+    """Where each format is kept unless configured otherwise"""
+    home = os.path.expanduser('~')
+    if fmt == 'bash':
+        return os.environ.get('HISTFILE') or os.path.join(home, '.bash_history')
+    if fmt == 'zsh':
+        return os.path.join(os.environ.get('ZDOTDIR') or home, '.zsh_history')
+    if fmt == 'autojump':
+        from xdg import BaseDirectory
+        return os.path.join(BaseDirectory.xdg_data_home, 'autojump', 'autojump.txt')
+    if fmt == 'z':
+        return os.environ.get('_Z_DATA') or os.path.join(home, '.z')
+    if fmt == 'fasd':
+        return os.environ.get('_FASD_DATA') or os.path.join(home, '.fasd')
+    raise ValueError('unknown format {}'.format(fmt))
+
+
+def sniff(line):
+    """The format of a file starting with `line`"""
+    import re
+    if re.match(r': \d+:\d+;', line):
+        return 'zsh'
+    if re.match(r'\d+(\.\d+)?\t', line):
+        return 'autojump'
+    if re.match(r'.+\|\d+(\.\d+)?\|\d+$', line):
+        return 'z'
+    return 'bash'
+
+
+def read(source):
+    """The (path, ts, count) records of `source`, a format name read
+       from its default file or the name of a file in any format"""
+    if source in FORMATS:
+        fmt, filename = source, default_filename(source)
+    else:
+        fmt, filename = None, source
+    mtime = os.path.getmtime(filename)
+    with io.open(filename, encoding='utf-8', errors='replace') as f:
+        lines = (line.rstrip('\n') for line in f)
+        first = next(lines, None)
+        if first is None:
+            return
+        if fmt is None:
+            fmt = sniff(first)
+        lines = chain([first], lines)
+        if fmt in ('bash', 'zsh'):
+            commands = bash_commands(lines) if fmt == 'bash' else zsh_commands(lines)
+            records = cd_records(commands, mtime)
+        elif fmt == 'autojump':
+            records = autojump_records(lines, mtime)
+        else:
+            records = z_records(lines)
+        for record in records:
+            yield record
+
+
+def bash_commands(lines):
+    """(ts, command) of bash history lines, ts is None if not timed"""
+    ts = None
+    for line in lines:
+        if line.startswith('#') and line[1:].isdigit():
+            ts = float(line[1:])
+            continue
+        yield ts, line
+
+
+def zsh_commands(lines):
+    """(ts, command) of zsh history lines, extended or not"""
+    for line in lines:
+        if line.startswith(': '):
+            stamp, _, command = line.partition(';')
+            try:
+                yield float(stamp[2:].split(':')[0]), command
+            except ValueError:
+                continue
+        else:
+            yield None, line
+
+
+def cd_records(commands, mtime):
+    """(dir, ts, 1) of each `cd` of the (ts, command) pairs, following
+       the dir the shell would be in from the last absolute `cd`"""
+    import re
+    import shlex
+    separators = re.compile(r'&&|\|\||;')
+    home = os.path.expanduser('~')
+    cwd = previous = None
+    for ts, command in commands:
+        if 'cd' not in command and 'pushd' not in command:
+            continue  # most commands, skipped before splitting them
+        for segment in separators.split(command):
+            words = segment.split()
+            if not words or words[0] not in CD_COMMANDS:
+                continue
+            if '"' in segment or "'" in segment or '\\' in segment:
+                try:
+                    words = shlex.split(segment)  # slow, only when quoted
+                except ValueError:  # unbalanced quotes, a multiline command
+                    continue
+            args = [word for word in words[1:] if not word.startswith('-') or word == '-']
+            target = args[0] if args else home
+            if target == '-':
+                target = previous
+            else:
+                if '$' in target:
+                    target = os.path.expandvars(target)
+                if target.startswith('~'):
+                    target = os.path.expanduser(target)
+                if not target.startswith(os.sep):
+                    target = os.path.join(cwd, target) if cwd else None
+            if target is None:
+                continue  # relative to a dir we can't tell
+            previous, cwd = cwd, os.path.normpath(target)
+            yield cwd, ts if ts is not None else mtime, 1
+
+
+def autojump_records(lines, mtime):
+    """(dir, mtime, visits) of autojump.txt lines"""
+    for line in lines:
+        weight, _, d = line.partition('\t')
+        try:
+            count = (float(weight) / AUTOJUMP_VISIT_WEIGHT) ** 2
+        except ValueError:
+            continue
+        if d:
+            yield d, mtime, max(count, 1)
+
+
+def z_records(lines):
+    """(dir, ts, count) of z and fasd lines"""
+    for line in lines:
+        try:
+            d, count, ts = line.rsplit('|', 2)
+            yield d, float(ts), max(float(count), 1)
+        except ValueError:
+            continue
+
+
+def visits(ts, count):
+    """Rank of a dir visited `count` times at `ts`"""
+    return ts + math.log(count) / DECAY
+
+
+def merge(records, ranks=None):
+    """{dir: rank} of the (dir, ts, count) records, merged into `ranks`"""
+    ranks = {} if ranks is None else ranks
+    for d, ts, count in records:
+        ranks[d] = visit(ranks.get(d), visits(ts, count))
+    return ranks
+
+
+def resolve(ranks):
+    """The ranks of the dirs that still exist, by their real path, the
+       ranks of paths leading to the same dir are merged"""
+    resolved = {}
+    for d, rank in ranks.items():
+        real = os.path.realpath(d)
+        if os.path.isdir(real):
+            resolved[real] = visit(resolved.get(real), rank)
+    return resolved
+
+
+def import_history(j, sources):
+    """Merge the dirs visited in `sources` into the index of `j` in a
+       single write. Returns the number of dirs imported"""
+    ranks = {}
+    for source in sources:
+        merge(read(source), ranks)
+    ranks = resolve(ranks)
+    rows = j.idx_rows
+    j.store.update_many([(d, visit(rows.get(d), rank)) for d, rank in ranks.items()])
+    return len(ranks)
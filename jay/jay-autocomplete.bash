@@ -2,7 +2,8 @@ _jay() {
     # this script should be placed in /etc/bash_completion.d/
     # COMPWORDS is an array that contains every param
     # COMP_CWORD is the position the cursor is currently at
-    COMPREPLY=(`jay --autocomplete ${COMP_CWORD} ${COMP_WORDS[@]}`)
+    local IFS=$'\n'  # one completion per line, they may have spaces
+    COMPREPLY=($(jay --autocomplete "${COMP_CWORD}" "${COMP_WORDS[@]}"))
     return $?
 }
 
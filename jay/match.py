@@ -0,0 +1,113 @@
+"""Matchers score how well a term matches a dir, for `Jay.fuzzyfind` and
+`walkdir`. Every matcher scores from 0 to 100 and leaves out the dirs
+that don't match at all:
+
+    matcher.scores(term, choices)  lazily yield (choice, score)
+    matcher.best(term, choices, limit)  the `limit` best (choice, score),
+                                        ties in the order of the choices
+
+`FuzzyMatcher` is fuzzywuzzy's WRatio, which tolerates typos.
+`SubsequenceMatcher` works like fzf: the characters of the term must
+appear in order in the dir, and matches on word boundaries, in a row
+and in the basename score higher. It's a lot cheaper per dir, and most
+dirs are rejected with a few str.rfind calls.
+"""
+from __future__ import unicode_literals
+import os
+import heapq
+from jay import timings
+
+
+SCORE_MATCH = 16  # for every character matched
+SCORE_GAP_START = -3  # for the first character skipped between matches
+SCORE_GAP_EXTENSION = -1  # for every other character skipped
+BONUS_BOUNDARY = 8  # for matching the first character of a word
+BONUS_CONSECUTIVE = 4  # for matching right after the previous match
+BONUS_BASENAME = 4  # for matching in the last component of the path
+BOUNDARIES = frozenset(os.sep + '-_. ')
+
+
+def matcher(name):
+    """The matcher called `name`"""
+    if name == 'fuzzy':
+        return FuzzyMatcher()
+    if name == 'subsequence':
+        return SubsequenceMatcher()
+    raise ValueError("jay: unknown matcher {}.".format(name))
+
+
+class Matcher(object):
+    """Subclasses yield the (choice, score) of the matching choices
+       from `scores`"""
+
+    def best(self, term, choices, limit):
+        return heapq.nlargest(limit, self.scores(term, choices), key=lambda match: match[1])
+
+
+class FuzzyMatcher(Matcher):
+
+    def __init__(self):
+        with timings.phase('import'):
+            from fuzzywuzzy import process
+        self.process = process
+
+    def scores(self, term, choices):
+        return self.process.extractWithoutOrder(term, choices, score_cutoff=1)
+
+
+class SubsequenceMatcher(Matcher):
+
+    def scores(self, term, choices):
+        for choice in choices:
+            score = subsequence_score(term, choice)
+            if score is not None:
+                yield choice, score
+
+
+def subsequence_score(term, choice):
+    """Score from 0 to 100 of the characters of `term` appearing in
+       order in `choice` (ignoring case), None if they don't"""
+    if not term:
+        return 0
+    lterm = term.lower()
+    lchoice = choice.lower()
+
+    # match from the end so the basename is preferred, and give up as
+    # soon as a character isn't found
+    start = len(lchoice)
+    for char in reversed(lterm):
+        start = lchoice.rfind(char, 0, start)
+        if start < 0:
+            return None
+
+    # then match from the first character onward, to close the gaps
+    positions = []
+    position = start
+    for char in lterm:
+        position = lchoice.find(char, position)
+        positions.append(position)
+        position += 1
+
+    basename = lchoice.rfind(os.sep, 0, len(lchoice.rstrip(os.sep))) + 1
+    # lowercasing a few characters changes the length of the string
+    camel_case = len(choice) == len(lchoice)
+    score = 0
+    previous = None
+    for position in positions:
+        score += SCORE_MATCH
+        if position == 0 or lchoice[position - 1] in BOUNDARIES or \
+                (camel_case and choice[position].isupper() and choice[position - 1].islower()):
+            score += BONUS_BOUNDARY
+        if previous is not None:
+            if position == previous + 1:
+                score += BONUS_CONSECUTIVE
+            else:
+                score += SCORE_GAP_START + SCORE_GAP_EXTENSION * (position - previous - 2)
+        if position >= basename:
+            score += BONUS_BASENAME
+        previous = position
+
+    # relative to a term matching a whole word of the basename
+    ideal = len(term) * (SCORE_MATCH + BONUS_BASENAME) + BONUS_BOUNDARY + \
+        (len(term) - 1) * BONUS_CONSECUTIVE
+    return max(1, min(100, int(round(100.0 * score / ideal))))
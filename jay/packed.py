@@ -0,0 +1,165 @@
+"""The dirs of a large index packed in arrays, to pick the candidates of
+a fuzzy search by scoring every dir at once instead of one at a time.
+
+Every dir is summed up by two 64 bit masks: the characters in it, and
+the pairs of characters in a row in it (hashed to 64 bits). The coarse
+score of a dir for a term is the number of bits of the term's masks
+that are set in the dir's, and the dirs with the highest coarse scores
+(the top ranked first on ties) are the candidates handed over to the
+matcher. Every dir is scored in one vectorised pass, so the arrays are
+only used with numpy installed: scoring them in a plain loop is slower
+than the trigram index (see `jay.grams`).
+
+Dirs added after the arrays were packed are kept aside and scored one
+at a time, and removed ones are masked out, until the arrays are packed
+again when the index is dumped.
+"""
+from __future__ import unicode_literals
+import io
+import heapq
+import marshal
+from array import array
+from jay.files import atomic_write
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def masks(s):
+    """Masks of the characters and of the pairs of characters of `s`"""
+    s = s.lower()
+    chars = 0
+    pairs = 0
+    for char in s:
+        chars |= 1 << (ord(char) & 63)
+    for first, second in zip(s, s[1:]):
+        pairs |= 1 << ((ord(first) * 31 + ord(second)) & 63)
+    return chars, pairs
+
+
+def popcount(n):
+    return bin(n).count('1')
+
+
+def tobytes(a):
+    return getattr(a, 'tobytes', getattr(a, 'tostring', None))()
+
+
+class PackedIndex(object):
+
+    def __init__(self, rows=None):
+        """Pack the (dir, rank) `rows`"""
+        self.dirs = []
+        chars, pairs, ranks = array(str('Q')), array(str('Q')), array(str('d'))
+        for d, rank in rows or ():
+            c, p = masks(d)
+            self.dirs.append(d)
+            chars.append(c)
+            pairs.append(p)
+            ranks.append(rank)
+        self.pack(chars, pairs, ranks)
+
+    def pack(self, chars, pairs, ranks):
+        if numpy is not None:
+            chars = numpy.array(chars, dtype=numpy.uint64)
+            pairs = numpy.array(pairs, dtype=numpy.uint64)
+            ranks = numpy.array(ranks, dtype=numpy.float64)
+        self.chars = chars
+        self.pairs = pairs
+        self.ranks = ranks
+        self.positions = {d: i for i, d in enumerate(self.dirs)}
+        self.removed = set()  # positions of the dirs removed since
+        self.extra = {}  # dir -> (chars, pairs, rank) of the dirs added since
+
+    def add(self, d, rank):
+        i = self.positions.get(d)
+        if i is not None and i not in self.removed:
+            self.ranks[i] = rank
+        else:
+            self.extra[d] = masks(d) + (rank,)
+
+    def discard(self, d):
+        i = self.positions.get(d)
+        if i is not None:
+            self.removed.add(i)
+        self.extra.pop(d, None)
+
+    def sync(self, rows):
+        """Add and discard dirs so that the index covers exactly
+           the {dir: rank} `rows`"""
+        for d in set(self.positions).union(self.extra).difference(rows):
+            self.discard(d)
+        for d, rank in rows.items():
+            i = self.positions.get(d)
+            if i is not None and i not in self.removed:
+                if self.ranks[i] != rank:
+                    self.ranks[i] = rank
+            elif self.extra.get(d, (None, None, None))[2] != rank:
+                self.add(d, rank)
+
+    def candidates(self, term, limit):
+        """The `limit` dirs with the highest coarse scores for `term`"""
+        term_chars, term_pairs = masks(term)
+        best = self.vectorised_best(term_chars, term_pairs, limit)
+        best.extend((popcount(c & term_chars) + popcount(p & term_pairs), rank, d)
+                    for d, (c, p, rank) in self.extra.items())
+        return [d for score, rank, d in heapq.nlargest(limit, best) if score > 0]
+
+    def vectorised_best(self, term_chars, term_pairs, limit):
+        if not self.dirs:
+            return []
+        scores = vectorised_popcount(self.chars & numpy.uint64(term_chars)) + \
+            vectorised_popcount(self.pairs & numpy.uint64(term_pairs))
+        if self.removed:
+            scores[list(self.removed)] = -1
+        # break ties on the rank, squashed in [0, 1)
+        low, high = self.ranks.min(), self.ranks.max()
+        keys = scores + (self.ranks - low) / (high - low + 1)
+        limit = min(limit, len(keys))
+        top = numpy.argpartition(-keys, limit - 1)[:limit]
+        return [(int(scores[i]), float(self.ranks[i]), self.dirs[i]) for i in top]
+
+    def dump(self, filename):
+        """Persist the arrays packed again with the dirs kept aside,
+           without working out the masks of the dirs already packed"""
+        dirs = []
+        chars, pairs, ranks = array(str('Q')), array(str('Q')), array(str('d'))
+        for i, d in enumerate(self.dirs):
+            if i not in self.removed:
+                dirs.append(d)
+                chars.append(int(self.chars[i]))
+                pairs.append(int(self.pairs[i]))
+                ranks.append(float(self.ranks[i]))
+        for d, (c, p, rank) in self.extra.items():
+            dirs.append(d)
+            chars.append(c)
+            pairs.append(p)
+            ranks.append(rank)
+        with atomic_write(filename) as f:
+            marshal.dump((dirs, tobytes(chars), tobytes(pairs), tobytes(ranks)), f)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a persisted index, None if it's missing or unreadable"""
+        try:
+            with io.open(filename, 'rb') as f:
+                dirs, chars, pairs, ranks = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+        index = cls.__new__(cls)
+        index.dirs = dirs
+        arrays = [array(str('Q')), array(str('Q')), array(str('d'))]
+        for a, data in zip(arrays, (chars, pairs, ranks)):
+            getattr(a, 'frombytes', getattr(a, 'fromstring', None))(data)
+        index.pack(*arrays)
+        return index
+
+
+def vectorised_popcount(a):
+    """Number of bits set in each uint64 of `a`"""
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(a).astype(numpy.int64)
+    return numpy.unpackbits(a.view(numpy.uint8)).reshape(-1, 64).sum(axis=1).astype(numpy.int64)
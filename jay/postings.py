@@ -0,0 +1,75 @@
+"""Inverted index over the indexed dirs, the base of the trigram index
+(see `jay.grams`) and of the component index (see `jay.components`).
+
+Each dir is filed under the keys that the `keys` function of the
+subclass works out of it, and the index is kept in sync with the rows
+and persisted the same way whatever the keys are.
+"""
+from __future__ import unicode_literals
+import io
+import marshal
+from collections import defaultdict
+from jay.files import atomic_write
+
+
+class PostingsIndex(object):
+    """Maps each key of the dirs to the set of dirs having it.
+       Subclasses set `keys` to the function listing the keys of a dir"""
+
+    def __init__(self, dirs=()):
+        self.dirs = set()
+        self.postings = defaultdict(set)
+        for d in dirs:
+            self.add(d)
+
+    def add(self, d):
+        if d in self.dirs:
+            return
+        self.dirs.add(d)
+        for key in self.keys(d):
+            self.postings[key].add(d)
+
+    def discard(self, d):
+        if d not in self.dirs:
+            return
+        self.dirs.discard(d)
+        for key in self.keys(d):
+            posting = self.postings.get(key)
+            if posting is not None:
+                posting.discard(d)
+                if not posting:
+                    del self.postings[key]
+
+    def sync(self, dirs):
+        """Add and discard dirs so that the index covers exactly `dirs`"""
+        dirs = set(dirs)
+        for d in self.dirs - dirs:
+            self.discard(d)
+        for d in dirs - self.dirs:
+            self.add(d)
+
+    def dump(self, filename):
+        """Persist the index, dirs are stored once and referenced by
+           position from the postings to keep the file small"""
+        dirs = sorted(self.dirs)
+        ids = {d: i for i, d in enumerate(dirs)}
+        postings = {key: [ids[d] for d in posting]
+                    for key, posting in self.postings.items()}
+        with atomic_write(filename) as f:
+            marshal.dump((dirs, postings), f)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a persisted index, None if it's missing or unreadable
+           (eg. written by another python version)"""
+        try:
+            with io.open(filename, 'rb') as f:
+                dirs, postings = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+        index = cls()
+        index.dirs = set(dirs)
+        for key, ids in postings.items():
+            index.postings[key] = set(dirs[i] for i in ids)
+        return index
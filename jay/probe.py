@@ -0,0 +1,140 @@
+"""Filesystem calls with a deadline, so a hung mount (NFS, sshfs...)
+doesn't freeze the shell inside `j`.
+
+Once `arm`ed for an invocation, every probe (a listing, an isdir) runs
+in a worker thread and is given up on when the invocation runs out of
+its budget, raising `SlowPath`. If the probe had a fair share of the
+budget, the mount its path is on is remembered as slow for a cooldown,
+and paths on it aren't probed at all until it's over: jay answers from
+the index alone meanwhile. Unarmed, probes are plain calls.
+"""
+from __future__ import unicode_literals
+import io
+import os
+import errno
+import marshal
+import threading
+from time import time
+from jay.files import atomic_write
+
+
+SLOW_PROBE = 0.1  # seconds a probe given up on must have had to mark its mount slow
+SLOW_COOLDOWN = 5 * 60  # seconds paths on a slow mount aren't probed
+MOUNTS_FILENAME = '/proc/self/mounts'
+
+_budget = None
+_deadline = None  # when the armed invocation runs out of budget
+_slow_filename = None
+_slow = None  # SlowMounts, loaded on the first probe
+
+
+class SlowPath(OSError):
+    """A probe ran out of time, or its path is on a slow mount"""
+
+
+def arm(budget, slow_filename):
+    """Give the probes from now on `budget` seconds in total, and keep
+       the slow mounts in `slow_filename`"""
+    global _budget, _deadline, _slow_filename, _slow
+    _budget = budget
+    _deadline = time() + budget
+    _slow_filename = slow_filename
+    _slow = None
+
+
+def rearm():
+    """Give the probes from now on the whole budget again, if armed"""
+    global _deadline
+    if _deadline is not None:
+        _deadline = time() + _budget
+
+
+def disarm():
+    global _deadline, _slow
+    _deadline = None
+    _slow = None
+
+
+def call(fn, path, *args):
+    """`fn(path, *args)`, raising SlowPath if it doesn't return in time"""
+    global _slow
+    if _deadline is None:
+        return fn(path, *args)
+    if _slow is None:
+        _slow = SlowMounts(_slow_filename)
+    if _slow.covers(path):
+        raise SlowPath(errno.ETIMEDOUT, 'jay: skipping slow mount', path)
+    budget = _deadline - time()
+    if budget <= 0:
+        raise SlowPath(errno.ETIMEDOUT, 'jay: out of time', path)
+
+    outcome = []
+
+    def probe():
+        try:
+            outcome.append((fn(path, *args), None))
+        except Exception as e:
+            outcome.append((None, e))
+
+    worker = threading.Thread(target=probe)
+    worker.daemon = True  # a hung probe doesn't keep jay from exiting
+    worker.start()
+    worker.join(budget)
+    if not outcome:
+        if budget >= SLOW_PROBE:
+            _slow.add(path)
+        raise SlowPath(errno.ETIMEDOUT, 'jay: gave up on', path)
+    result, error = outcome[0]
+    if error is not None:
+        raise error
+    return result
+
+
+def isdir(path, default):
+    """os.path.isdir, `default` if the path is slow to tell"""
+    try:
+        return call(os.path.isdir, path)
+    except SlowPath:
+        return default
+
+
+def mount_of(path):
+    """The mount point `path` is on, read from the mount table since
+       asking the filesystem is what may hang. Paths on the root mount
+       or on an unknown one are their own mount point, not to skip
+       every path in the system for a single slow dir"""
+    import re
+    try:
+        with io.open(MOUNTS_FILENAME) as f:
+            # spaces and the like are escaped as octal in the table
+            mounts = [re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)),
+                             line.split()[1]) for line in f if line.strip()]
+    except (IOError, IndexError):
+        mounts = []
+    mounts = [m for m in mounts
+              if m != os.sep and (path == m or path.startswith(m.rstrip(os.sep) + os.sep))]
+    return max(mounts, key=len) if mounts else path
+
+
+class SlowMounts(object):
+    """Mounts found slow, with the time their cooldown is over"""
+
+    def __init__(self, filename, cooldown=SLOW_COOLDOWN):
+        self.filename = filename
+        self.cooldown = cooldown
+        try:
+            with io.open(filename, 'rb') as f:
+                until = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            until = {}
+        now = time()
+        self.until = {mount: t for mount, t in until.items() if t > now}
+
+    def covers(self, path):
+        return any(path == mount or path.startswith(mount.rstrip(os.sep) + os.sep)
+                   for mount in self.until)
+
+    def add(self, path):
+        self.until[mount_of(path)] = time() + self.cooldown
+        with atomic_write(self.filename) as f:
+            marshal.dump(self.until, f)
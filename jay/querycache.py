@@ -0,0 +1,120 @@
+"""On disk cache of the dirs each search term may jump to, so typing the
+same few terms over and over neither loads nor scores the index.
+
+A term is cached along with its contenders: the dirs whose fuzzy score
+is close enough to the best one that their frecency may make them the
+best match (see `Jay.contenders`), with their ranks. Visits only change
+the ranks, so answering a cached term again only takes bringing them up
+to date with the records journaled since they were cached. They are
+looked up in the index again once it's compacted, and on every hit with
+the sqlite backend, which reads single rows cheaply.
+
+The cache belongs to a generation of the index, a counter that the
+stores bump whenever dirs are added or removed (see `jay.store`), and
+it's emptied when the index moves on to another generation, since the
+new dirs may be contenders. The least recently used terms are evicted
+first.
+"""
+from __future__ import unicode_literals
+import io
+import marshal
+from collections import OrderedDict
+from jay.files import atomic_write
+from jay.store import apply
+
+
+QUERY_CACHE_MAX_SIZE = 200  # max number of cached terms
+
+
+class QueryCache(object):
+    """Maps a term to the (dir, fuzzy score, rank) of its contenders, in
+       the `store`'s current generation. Their ranks are up to `mark`
+       in the journal (see `store.loaded_mark`)"""
+
+    def __init__(self, filename, store, max_size=QUERY_CACHE_MAX_SIZE):
+        self.filename = filename
+        self.store = store
+        self.max_size = max_size
+        self.dirty = False
+        try:
+            with io.open(filename, 'rb') as f:
+                self.generation, self.mark, entries = marshal.load(f)
+            self.entries = OrderedDict(entries)
+        except (IOError, EOFError, ValueError, TypeError):
+            self.generation, self.mark, self.entries = None, None, OrderedDict()
+
+    def validate(self):
+        """Forget the entries of an older generation of the index"""
+        generation = self.store.generation()
+        if generation != self.generation:
+            self.generation = generation
+            self.entries.clear()
+            self.dirty = True
+
+    def get(self, term):
+        """The contenders of `term` with their current ranks, None if
+           it isn't cached. The rank of a dir gone from the index is None"""
+        self.validate()
+        contenders = self.entries.pop(term, None)
+        if contenders is None:
+            return None
+        self.entries[term] = contenders  # the most recently used
+        self.dirty = True
+        caught_up = self.mark is not None and self.store.journaled_since(self.mark)
+        if caught_up:
+            records, self.mark = caught_up
+            if records:
+                self.replay(records)
+        else:
+            self.look_up([term])
+        return self.entries[term]
+
+    def set(self, term, contenders):
+        """Cache the (dir, fuzzy score, rank) contenders of `term`, their
+           ranks taken from the loaded rows"""
+        self.validate()
+        self.entries.pop(term, None)
+        self.entries[term] = list(contenders)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        if self.mark != self.store.loaded_mark:
+            self.look_up(list(self.entries))
+        self.dirty = True
+
+    def look_up(self, terms):
+        """Read the ranks of the contenders of `terms` from the index,
+           every term has to be looked up unless the rows aren't journaled"""
+        rows = self.store.rows
+        self.mark = self.store.loaded_mark
+        if self.mark is not None:
+            terms = list(self.entries)
+        for term in terms:
+            self.entries[term] = [(d, score, rows.get(d))
+                                  for d, score, rank in self.entries[term]]
+
+    def replay(self, records):
+        """Fold the journal `records` into the ranks of the contenders"""
+        ranks = {}
+        for contenders in self.entries.values():
+            ranks.update((d, rank) for d, score, rank in contenders)
+        for op, ts, d in records:
+            if d in ranks:
+                apply(ranks, op, ts, d)
+        for term, contenders in self.entries.items():
+            self.entries[term] = [(d, score, ranks.get(d)) for d, score, rank in contenders]
+
+    def discard(self, d):
+        """Forget the terms `d` is a contender of"""
+        terms = [term for term, contenders in self.entries.items()
+                 if any(contender == d for contender, score, rank in contenders)]
+        for term in terms:
+            del self.entries[term]
+        if terms:
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        with atomic_write(self.filename) as f:
+            marshal.dump((self.generation, self.mark, list(self.entries.items())), f)
+        self.dirty = False
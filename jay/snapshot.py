@@ -0,0 +1,143 @@
+"""Binary snapshot of the index that is mmapped and read in place,
+so loading it costs paging in the parts that are used instead of
+parsing every row.
+
+The layout (little endian) is:
+
+    header   magic b'JAY1', number of entries (uint64)
+    entries  offset of the path in the paths blob (uint64), its length
+             in bytes (uint32) and the rank (float64), sorted
+             by path so they can be binary searched
+    paths    utf-8 encoded paths, one after the other
+"""
+from __future__ import unicode_literals
+import io
+import os
+import mmap
+import struct
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # python2
+    from collections import MutableMapping
+
+
+MAGIC = b'JAY1'
+HEADER = struct.Struct(str('<4sQ'))
+ENTRY = struct.Struct(str('<QId'))
+
+
+def write(filename, rows):
+    """Write (dir, rank) `rows` as a snapshot"""
+    entries = sorted((d.encode('utf-8'), float(ts)) for d, ts in rows)
+    with io.open(filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(entries)))
+        offset = 0
+        for path, ts in entries:
+            f.write(ENTRY.pack(offset, len(path), ts))
+            offset += len(path)
+        for path, ts in entries:
+            f.write(path)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class Snapshot(object):
+    """Read only access to the entries of a mmapped snapshot"""
+
+    def __init__(self, filename):
+        self.buf = None
+        self.size = 0
+        try:
+            with io.open(filename, 'rb') as f:
+                self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return  # missing or empty, the mmap stays open after closing f
+
+        magic, self.size = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("jay: {} is not an index snapshot.".format(filename))
+        self.paths_offset = HEADER.size + self.size * ENTRY.size
+
+    def __len__(self):
+        return self.size
+
+    def entry(self, i):
+        offset, length, ts = ENTRY.unpack_from(self.buf, HEADER.size + i * ENTRY.size)
+        start = self.paths_offset + offset
+        return self.buf[start:start + length], ts
+
+    def path(self, i):
+        return self.entry(i)[0].decode('utf-8')
+
+    def find(self, d):
+        """Position of the dir `d`, or -1 if it isn't in the snapshot"""
+        path = d.encode('utf-8')
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[0] < path:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.size and self.entry(lo)[0] == path:
+            return lo
+        return -1
+
+    def items(self):
+        for i in range(self.size):
+            path, ts = self.entry(i)
+            yield path.decode('utf-8'), ts
+
+    def close(self):
+        if self.buf is not None:
+            self.buf.close()
+
+
+class SnapshotRows(MutableMapping):
+    """{dir: rank} rows of a snapshot, with the changes made
+       since it was written kept in memory on top of it"""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.updated = {}
+        self.deleted = set()
+
+    def __getitem__(self, d):
+        if d in self.updated:
+            return self.updated[d]
+        if d not in self.deleted:
+            i = self.snapshot.find(d)
+            if i >= 0:
+                return self.snapshot.entry(i)[1]
+        raise KeyError(d)
+
+    def __setitem__(self, d, ts):
+        self.updated[d] = ts
+        self.deleted.discard(d)
+
+    def __delitem__(self, d):
+        if d not in self:
+            raise KeyError(d)
+        self.updated.pop(d, None)
+        if self.snapshot.find(d) >= 0:
+            self.deleted.add(d)
+
+    def __iter__(self):
+        for d in self.updated:
+            yield d
+        for d, ts in self.snapshot.items():
+            if d not in self.updated and d not in self.deleted:
+                yield d
+
+    def __len__(self):
+        # deleted dirs are in the snapshot, updated ones may not be
+        return len(self.snapshot) - len(self.deleted) + \
+            sum(1 for d in self.updated if self.snapshot.find(d) < 0)
+
+    def items(self):
+        for d, ts in self.updated.items():
+            yield d, ts
+        for d, ts in self.snapshot.items():
+            if d not in self.updated and d not in self.deleted:
+                yield d, ts
@@ -0,0 +1,916 @@
+"""Storage backends for the index of visited dirs.
+
+Every backend keeps {dir: rank} rows, where the rank is a float that
+combines the number of visits and how recent they are (see
+`jay.frecency`), plus a trigram index over them, and exposes them the
+same way to `jay.Jay`:
+
+    store.rows          mapping of the rows (assignable)
+    store.load()        rows as they are on disk
+    store.visit(d, ts)  record a visit, folding it into the rank of d
+    store.visit_many(dirs, ts)  record a visit to many dirs at once
+    store.update(d, rank)    set the rank of a dir
+    store.update_many(rows)  set the rank of many dirs at once
+    store.delete(d)     forget a dir
+    store.delete_many(dirs)  forget many dirs at once
+    store.dump()        persist, keeping the `max_size` top ranked dirs
+    store.candidates(term, limit)  dirs sharing most trigrams with term
+    store.complete(prefix, limit)  top ranked dirs with a component
+                                   starting with prefix
+    store.paths(terms, limit)  top ranked dirs the terms resolve to,
+                               component by component (see
+                               `jay.components`)
+    store.stamp()       changes whenever the index changes on disk
+    store.loaded_mark   where in the journal the loaded rows are up to,
+                        None if the rows aren't journaled
+    store.journaled_since(mark)  (records, mark) journaled since `mark`,
+                                 None if they can't be told
+    store.generation()  changes whenever dirs are added or removed
+    with store.deferred():  hold the writes made within until the end
+                            of the block, dropping them on an exception
+
+Many shells may jump at once, so the csv and binary stores never
+rewrite a file in place: journal records are appended under a shared
+lock, and compactions take an exclusive one, fold in whatever other
+processes journaled meanwhile and atomically replace the snapshot.
+Reads don't lock. Sqlite does its own locking.
+"""
+from __future__ import unicode_literals
+import os
+import io
+import sys
+import heapq
+import locale
+import marshal
+from contextlib import contextmanager
+from jay import timings
+from jay.files import atomic_write, replace, tmp_filename
+from jay.frecency import visit
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # python2
+    from collections import Mapping
+
+
+JOURNAL_SUFFIX = '.log'  # journal filename, next to the index
+JOURNAL_MAX_SIZE = 16 * 1024  # bytes of journal before compacting the index
+JOURNAL_UPDATE = 'u'
+JOURNAL_DELETE = 'd'
+JOURNAL_VISIT = 'v'
+GRAMS_SUFFIX = '.grams'  # trigram index filename, next to the index
+TRIE_SUFFIX = '.trie'  # completion trie filename, next to the index
+COMPONENTS_SUFFIX = '.components'  # component index filename, next to the index
+PACKED_SUFFIX = '.packed'  # packed arrays filename, next to the index
+# identity of the snapshot the grams, trie, components and packed
+# arrays were saved along with, next to the index
+INDEXED_SUFFIX = '.indexed'
+# indexes with this many dirs pick the candidates of a fuzzy search
+# from packed arrays (see jay.packed) instead of the trigram index, if
+# numpy is installed, looping over the arrays is slower than the trigrams
+PACKED_MIN_SIZE = 5000
+SQLITE_SUFFIX = '.sqlite'  # sqlite database filename, next to the index
+BINARY_SUFFIX = '.bin'  # binary snapshot filename, next to the index
+GENERATION_SUFFIX = '.gen'  # generation counter filename, next to the index
+QUERIES_SUFFIX = '.queries'  # query cache filename, next to the index
+LOCK_SUFFIX = '.lock'  # lock filename, next to the index
+LOAD_ATTEMPTS = 3  # lock free reads before reading under a lock
+WRITE_MODE = 'wb' if sys.version_info.major < 3 else 'w'
+
+
+def csv_module():
+    """The csv module that handles unicode in this python version"""
+    if sys.version_info.major < 3:
+        import unicodecsv as csv
+    else:
+        import csv
+    return csv
+
+
+def read_generation(filename):
+    try:
+        with io.open(filename, 'r') as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return 0
+
+
+def bump_generation(filename):
+    """Move the generation counter at `filename` forward, concurrent
+       bumps may be counted once, but always move it forward"""
+    with atomic_write(filename, 'w') as f:
+        f.write('{}'.format(read_generation(filename) + 1))
+
+
+def parse_record(line):
+    """(op, rank or time, dir) of a journal line, without its newline"""
+    op, ts, d = line.split(' ', 2)
+    return op, float(ts), d.replace('\0', '\n')
+
+
+def apply(rows, op, ts, d):
+    """Apply a journal record to the rows"""
+    if op == JOURNAL_VISIT:
+        rows[d] = visit(rows.get(d), ts)
+    elif op == JOURNAL_UPDATE:
+        rows[d] = ts
+    else:
+        rows.pop(d, None)
+
+
+def open_store(backend, filename, max_size, journal_max_size=JOURNAL_MAX_SIZE):
+    """Open the index at `filename` with the given backend"""
+    if backend == 'csv':
+        return CsvStore(filename, max_size, journal_max_size)
+    if backend == 'binary':
+        return BinaryStore(filename, max_size, journal_max_size)
+    if backend == 'sqlite':
+        return SqliteStore(filename, max_size, journal_max_size)
+    raise ValueError("jay: unknown index backend {}.".format(backend))
+
+
+class CsvStore(object):
+    """The index is a csv snapshot of [dir, rank] rows plus a journal of
+       the visits, updates and deletions made since the snapshot was
+       written, which gets folded back into it once it grows too big"""
+
+    def __init__(self, filename, max_size, journal_max_size=JOURNAL_MAX_SIZE):
+        self.idx = filename
+        self.journal = filename + JOURNAL_SUFFIX
+        self.grams_filename = filename + GRAMS_SUFFIX
+        self.trie_filename = filename + TRIE_SUFFIX
+        self.components_filename = filename + COMPONENTS_SUFFIX
+        self.packed_filename = filename + PACKED_SUFFIX
+        self.indexed_filename = filename + INDEXED_SUFFIX
+        self.generation_filename = filename + GENERATION_SUFFIX
+        self.queries_filename = filename + QUERIES_SUFFIX
+        self.lock_filename = filename + LOCK_SUFFIX
+        self.max_size = max_size
+        self.journal_max_size = journal_max_size
+        self._rows = None  # loaded on first use
+        self._grams = None  # loaded on first fuzzy search
+        self._trie = None  # loaded on first completion
+        self._components = None  # loaded on first search with several terms
+        self._packed = None  # loaded on first fuzzy search of a large index
+        self.assigned = False  # whether rows were assigned instead of journaled
+        self.loaded_stamp = None
+        self.loaded_snapshot = None  # snapshot the rows were read from
+        self.journaled = None  # dirs changed since that snapshot
+        self.replayed = None  # dirs in the journal, as of the last replay
+        self.replayed_size = 0  # bytes of the journal, as of the last replay
+        self.loaded_mark = None  # (snapshot, journal size) the rows are up to
+        self._pending = None  # journal records held back, see `deferred`
+        self._pending_bump = False
+        self._pending_dump = False
+
+        # create the idx file if does not exist
+        if not os.path.isfile(self.idx):
+            self.create()
+
+    def create(self):
+        # another process may have created it meanwhile, don't truncate it
+        with io.open(self.idx, 'a') as f:
+            pass
+
+    @property
+    def rows(self):
+        """Index entries as {dir: rank}, parsed lazily
+           so that code paths that don't need them skip the parsing"""
+        if self._rows is None:
+            with timings.phase('load'):
+                self._rows = self.load()
+                self.loaded_stamp = self.stamp()
+                self.loaded_mark = (self.loaded_snapshot, self.replayed_size)
+                self.journaled = self.replayed
+                for op, ts, d in self._pending or ():
+                    apply(self._rows, op, ts, d)  # held by `deferred`
+                    self.journaled.add(d)
+        return self._rows
+
+    @rows.setter
+    def rows(self, rows):
+        self._rows = rows
+        self.assigned = True
+        self.loaded_snapshot = None  # the saved indexes don't match them
+        self.loaded_mark = None  # nor does the journal
+        self._grams = None
+        self._trie = None
+        self._components = None
+        self._packed = None
+        self.bump()
+
+    @property
+    def grams(self):
+        """Trigram index of the dirs, loaded from the last snapshot
+           and brought up to date with the journal"""
+        if self._grams is None:
+            from jay.grams import GramIndex
+            self._grams = self.caught_up(GramIndex, self.grams_filename)
+        return self._grams
+
+    @property
+    def trie(self):
+        """Completion trie of the dirs, loaded from the last snapshot
+           and brought up to date with the journal"""
+        if self._trie is None:
+            from jay.trie import ComponentTrie
+            self._trie = self.caught_up(ComponentTrie, self.trie_filename, ranked=True)
+        return self._trie
+
+    @property
+    def components(self):
+        """Component index of the dirs, loaded from the last snapshot
+           and brought up to date with the journal"""
+        if self._components is None:
+            from jay.components import ComponentIndex
+            self._components = self.caught_up(ComponentIndex, self.components_filename)
+        return self._components
+
+    @property
+    def packed(self):
+        """Packed arrays of the dirs, loaded from the last snapshot
+           and brought up to date with the journal"""
+        if self._packed is None:
+            from jay.packed import PackedIndex
+            self._packed = self.caught_up(PackedIndex, self.packed_filename, ranked=True)
+        return self._packed
+
+    def caught_up(self, cls, filename, ranked=False):
+        """Load the `cls` index saved along with the snapshot and bring
+           it up to date with the rows. If it was saved along with the
+           snapshot the rows were read from, only the dirs journaled
+           since are looked up, otherwise every row is walked"""
+        rows = self.rows
+        snapshot = self.loaded_snapshot
+        key = os.path.basename(filename)
+        index = None
+        if snapshot is not None and self.indexed().get(key) == snapshot:
+            index = cls.load(filename)
+            if self.indexed().get(key) != snapshot:
+                index = None  # compacted meanwhile, it may be the new one
+        if index is None:
+            index = cls.load(filename) or cls()
+            index.sync(rows)
+            self.save_index(index, filename)
+            return index
+        for d in self.journaled:
+            if d not in rows:
+                index.discard(d)
+            elif ranked:
+                index.add(d, rows[d])
+            else:
+                index.add(d)
+        return index
+
+    def save_index(self, index, filename):
+        """Save an index synced with the rows read from the files, tied
+           to their snapshot unless a compaction replaced it meanwhile"""
+        if self._pending or self.loaded_mark is None:
+            return  # the rows have changes the files don't
+        # a compaction can't run meanwhile, and the changes to the
+        # rows since the snapshot are all journaled, so they will be
+        # looked up again when the index is loaded
+        with self.lock('LOCK_SH'):
+            snapshot = self.loaded_mark[0]
+            if self.snapshot_stamp() != snapshot:
+                return
+            index.dump(filename)
+            indexed = self.indexed()
+            indexed[os.path.basename(filename)] = snapshot
+            self.write_indexed(indexed)
+
+    def indexed(self):
+        """Identity of the snapshot each saved index was synced with,
+           by name of the index file"""
+        try:
+            with io.open(self.indexed_filename, 'rb') as f:
+                indexed = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return {}
+        return indexed if isinstance(indexed, dict) else {}
+
+    def write_indexed(self, indexed):
+        with atomic_write(self.indexed_filename) as f:
+            marshal.dump(indexed, f)
+
+    def load(self):
+        """Read the snapshot and replay the journal on top of it. Reads
+           don't lock, if a compaction replaced the snapshot meanwhile
+           the journal read may belong to the new one, so both are read
+           again, under a shared lock if it keeps happening"""
+        for attempt in range(LOAD_ATTEMPTS):
+            snapshot = self.snapshot_stamp()
+            rows = self.replay()
+            if self.snapshot_stamp() == snapshot:
+                self.loaded_snapshot = snapshot
+                return rows
+        with self.lock('LOCK_SH'):
+            self.loaded_snapshot = self.snapshot_stamp()
+            return self.replay()
+
+    def snapshot_stamp(self):
+        """Identify the snapshot, which is replaced but never modified"""
+        try:
+            return self.stamp()[:-1]
+        except OSError:
+            return None
+
+    def replay(self):
+        rows = self.read()
+        self.replayed = set()
+        self.replayed_size = 0
+        try:
+            with io.open(self.journal, 'r') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break  # a record cut short by a crash
+                    op, ts, d = parse_record(line[:-1])
+                    apply(rows, op, ts, d)
+                    self.replayed.add(d)
+                    self.replayed_size += len(line.encode(f.encoding))
+        except IOError:
+            pass  # nothing journaled since the last snapshot
+        return rows
+
+    def journaled_since(self, mark):
+        """The records journaled since `mark`, a (snapshot, journal size)
+           like `loaded_mark`, along with the mark they lead to. None if
+           the snapshot was replaced since, folding them in"""
+        snapshot, size = mark
+        if snapshot is None or self.snapshot_stamp() != snapshot:
+            return None
+        try:
+            with io.open(self.journal, 'rb') as f:
+                f.seek(size)
+                data = f.read()
+        except IOError:
+            data = None
+        if self.snapshot_stamp() != snapshot:
+            return None  # compacted while the journal was read
+        if data is None:
+            return ([], mark) if size == 0 else None
+        data = data[:data.rfind(b'\n') + 1]  # up to the last whole record
+        lines = data.decode(locale.getpreferredencoding(False)).split('\n')[:-1]
+        return [parse_record(line) for line in lines], (snapshot, size + len(data))
+
+    def read(self):
+        """Rows of the snapshot"""
+        with io.open(self.idx, 'r') as f:
+            # get each row from index,
+            # where each csv row is [dir, rank]
+            return {d: float(rank) for d, rank in csv_module().reader(f)}
+
+    def write(self, filename, rows):
+        """Write a snapshot of `rows`"""
+        with io.open(filename, WRITE_MODE) as f:
+            csv_module().writer(f).writerows((d, repr(rank)) for d, rank in rows)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def stamp(self):
+        """Identify the current version of the index files"""
+        st = os.stat(self.idx)
+        try:
+            journal_size = os.path.getsize(self.journal)
+        except OSError:
+            journal_size = 0
+        return (st.st_ino, st.st_size,
+                getattr(st, 'st_mtime_ns', st.st_mtime), journal_size)
+
+    def generation(self):
+        return read_generation(self.generation_filename)
+
+    def bump(self):
+        if self._pending is not None:
+            self._pending_bump = True
+            return
+        bump_generation(self.generation_filename)
+
+    @contextmanager
+    def deferred(self):
+        """Hold the journal records, bumps and dumps made within, and
+           write them at once on the way out. If left by an exception
+           they are dropped, along with the rows loaded"""
+        if self._pending is not None:
+            yield  # nested, the outermost one writes
+            return
+        self._pending = []
+        self._pending_bump = self._pending_dump = False
+        try:
+            yield
+        except BaseException:
+            self._pending = None
+            self.assigned = False
+            self.reload()
+            raise
+        records, self._pending = self._pending, None
+        self.log(*records)
+        if self._pending_dump:
+            self.dump()
+        if self._pending_bump:
+            self.bump()
+
+    @contextmanager
+    def lock(self, operation):
+        """Hold the 'LOCK_SH' or 'LOCK_EX' advisory lock of the index"""
+        try:
+            import fcntl
+        except ImportError:  # not on posix, go without
+            yield
+            return
+        with io.open(self.lock_filename, 'a') as f:
+            fcntl.flock(f.fileno(), getattr(fcntl, operation))
+            yield
+
+    def changed(self):
+        """Whether the loaded rows are out of date with the files"""
+        try:
+            stamp = self.stamp()
+        except OSError:
+            return True  # the index was removed
+        return self._rows is not None and self.loaded_stamp != stamp
+
+    def candidates(self, term, limit):
+        if self.use_packed(self.rows):
+            return self.packed.candidates(term, limit)
+        return self.grams.candidates(term, limit)
+
+    def use_packed(self, rows):
+        if len(rows) < PACKED_MIN_SIZE:
+            return False
+        from jay import packed
+        return packed.numpy is not None
+
+    def complete(self, prefix, limit):
+        return self.trie.complete(prefix, limit)
+
+    def paths(self, terms, limit):
+        from jay.components import best_paths
+        rows = self.rows
+        return best_paths(((d, rows[d]) for d in self.components.candidates(terms)),
+                          terms, limit)
+
+    def visit(self, d, ts, known=False):
+        """Journal a visit to the directory, its rank is only worked out
+           if the rows are loaded, or when the journal is replayed.
+           Unless the dir is `known` to be in the index, the generation
+           is bumped if the rows aren't loaded to tell"""
+        self.visit_many([d], ts, known=[d] if known else ())
+
+    def visit_many(self, dirs, ts, known=()):
+        """Journal a visit to many dirs at once, `known` are the ones
+           known to be in the index"""
+        records = []
+        new = False
+        for d in dirs:
+            new = new or (d not in known and (self._rows is None or d not in self._rows))
+            if self._rows is not None:
+                self.add(d, visit(self._rows.get(d), ts))
+            records.append((JOURNAL_VISIT, ts, d))
+        self.log(*records)
+        if new:
+            self.bump()
+
+    def update(self, d, rank):
+        """Journal the rank of the directory"""
+        self.update_many([(d, rank)])
+
+    def update_many(self, rows):
+        """Journal the ranks of many dirs at once"""
+        records = []
+        new = False
+        for d, rank in rows:
+            new = new or self._rows is None or d not in self._rows
+            if self._rows is not None:
+                self.add(d, rank)
+            records.append((JOURNAL_UPDATE, rank, d))
+        self.log(*records)
+        if new:
+            self.bump()
+
+    def add(self, d, rank):
+        """Set the rank of a dir in the loaded rows and indexes"""
+        self._rows[d] = rank
+        if self._grams is not None:
+            self._grams.add(d)
+        if self._trie is not None:
+            self._trie.add(d, rank)
+        if self._components is not None:
+            self._components.add(d)
+        if self._packed is not None:
+            self._packed.add(d, rank)
+
+    def delete(self, d):
+        """Journal the removal of the directory"""
+        self.delete_many([d])
+
+    def delete_many(self, dirs):
+        """Journal the removal of many dirs at once"""
+        records = []
+        for d in dirs:
+            if d in self.rows:
+                del self.rows[d]
+                if self._grams is not None:
+                    self._grams.discard(d)
+                if self._trie is not None:
+                    self._trie.discard(d)
+                if self._components is not None:
+                    self._components.discard(d)
+                if self._packed is not None:
+                    self._packed.discard(d)
+                records.append((JOURNAL_DELETE, 0.0, d))
+        self.log(*records)
+        if records:
+            self.bump()
+
+    def reload(self):
+        """Forget what was loaded, to read the files again"""
+        self._rows = None
+        self._grams = None
+        self._trie = None
+        self._components = None
+        self._packed = None
+
+    def log(self, *records):
+        """Append (op, rank or time, dir) records to the journal, and compact
+           the index if the journal grew past its max size"""
+        if not records:
+            return
+        if self.journaled is not None:
+            self.journaled.update(d for op, ts, d in records)
+        if self._pending is not None:
+            self._pending.extend(records)
+            return
+        # one write on a file opened for appending, so records
+        # from different processes don't get mixed, and a newline
+        # can't be part of a path since \0 can't be part of one
+        data = ''.join('{} {!r} {}\n'.format(op, float(ts), d.replace('\n', '\0'))
+                       for op, ts, d in records)
+        # the shared lock keeps a compaction from removing the journal
+        # between the append and a read of it that would miss the record
+        with self.lock('LOCK_SH'):
+            with io.open(self.journal, 'a') as f:
+                f.write(data)
+                size = f.tell()
+
+        if size > self.journal_max_size:
+            self.dump(min_journal_size=self.journal_max_size)
+        elif self._rows is not None:
+            self.loaded_stamp = self.stamp()
+            if self.loaded_mark is not None:
+                self.loaded_mark = (self.loaded_mark[0], size)
+
+    def dump(self, min_journal_size=0):
+        """Dump the dirs to a new snapshot, replacing the old one and
+           its journal, unless the journal is `min_journal_size` or
+           smaller (another process compacted it meanwhile)"""
+        if self._pending is not None:
+            self._pending_dump = True
+            return
+        with timings.phase('dump'), self.lock('LOCK_EX'):
+            try:
+                journal_size = os.path.getsize(self.journal)
+            except OSError:
+                journal_size = 0
+            if min_journal_size and journal_size <= min_journal_size:
+                return
+            if not self.assigned:
+                # every change made here was journaled, and reading the
+                # files again folds in the changes of other processes
+                self._rows = self.replay()
+            self.assigned = False
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        # save the top ranked dirs only, selecting them with a bounded
+        # heap instead of sorting every row
+        rows = heapq.nlargest(self.max_size, self._rows.items(), key=lambda x: x[1])
+        evicted = len(rows) < len(self._rows)
+        tmp = tmp_filename(self.idx)
+        self.write(tmp, rows)
+        st = os.stat(tmp)  # the snapshot keeps its identity once renamed
+        snapshot = (st.st_ino, st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime))
+
+        # the indexes loaded here are saved along with the snapshot, they
+        # will only have to catch up with the journal when loaded. The
+        # others are synced with every row when next loaded, and saved
+        # then, rather than loaded here to be rewritten
+        self._rows = dict(rows)
+        loaded = [(index, os.path.basename(filename), filename)
+                  for index, filename in ((self._grams, self.grams_filename),
+                                          (self._trie, self.trie_filename),
+                                          (self._components, self.components_filename),
+                                          (self._packed, self.packed_filename))
+                  if index is not None]
+        indexed = self.indexed()
+        if any(key in indexed for index, key, filename in loaded):
+            # untie them from the old snapshot before rewriting them
+            for index, key, filename in loaded:
+                indexed.pop(key, None)
+            self.write_indexed(indexed)
+        for index, key, filename in loaded:
+            index.sync(self._rows)
+            index.dump(filename)
+            indexed[key] = snapshot
+        if loaded:
+            self.write_indexed(indexed)
+
+        # a crash before this leaves the old snapshot and its journal
+        # in place, and a crash right after it only leaves records
+        # that are already part of the snapshot to be replayed again,
+        # which at worst counts some visits twice
+        replace(tmp, self.idx)
+        try:
+            os.remove(self.journal)
+        except OSError:
+            pass
+        self.loaded_stamp = self.stamp()
+        self.loaded_snapshot = snapshot
+        self.loaded_mark = (snapshot, 0)
+        self.journaled = set()
+        if evicted:
+            self.bump()
+
+
+class BinaryStore(CsvStore):
+    """Same as the csv index, but the snapshot is a binary file that is
+       mmapped and queried in place (see `jay.snapshot`) instead of being
+       parsed, so only the parts of the index that are used are read.
+
+       It's created from the csv index the first time it's opened."""
+
+    def __init__(self, filename, max_size, journal_max_size=JOURNAL_MAX_SIZE):
+        self.csv_idx = filename
+        super(BinaryStore, self).__init__(filename + BINARY_SUFFIX, max_size,
+                                          journal_max_size)
+
+    def create(self):
+        with self.lock('LOCK_EX'):
+            if os.path.isfile(self.idx):
+                return  # another process created it meanwhile
+            self._rows = {}
+            if os.path.isfile(self.csv_idx):
+                self._rows = CsvStore(self.csv_idx, self.max_size).load()
+            self.write_snapshot()
+
+    def read(self):
+        from jay.snapshot import Snapshot, SnapshotRows
+        return SnapshotRows(Snapshot(self.idx))
+
+    def write(self, filename, rows):
+        from jay import snapshot
+        snapshot.write(filename, rows)
+
+
+class SqliteStore(object):
+    """The index is a sqlite database in WAL mode, with the trigrams of
+       each dir in their own table, so neither loading nor updating it
+       touches more than the rows involved. Meant for large histories.
+
+       It's created from the csv index the first time it's opened."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS dirs (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            ts REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS dirs_ts ON dirs (ts);
+        CREATE TABLE IF NOT EXISTS grams (
+            gram TEXT NOT NULL,
+            dir INTEGER NOT NULL,
+            PRIMARY KEY (gram, dir)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS grams_dir ON grams (dir);
+    """
+
+    def __init__(self, filename, max_size, journal_max_size=None):
+        import sqlite3
+        self.idx = filename
+        self.db_filename = filename + SQLITE_SUFFIX
+        self.generation_filename = filename + SQLITE_SUFFIX + GENERATION_SUFFIX
+        self.queries_filename = filename + SQLITE_SUFFIX + QUERIES_SUFFIX
+        self.max_size = max_size
+        self.journal_max_size = journal_max_size  # sqlite has its own journal
+        self._pending_bump = None  # whether to bump, within `deferred`
+        self.loaded_mark = None  # rows are always read from the database
+
+        migrate = not os.path.isfile(self.db_filename)
+        self.db = sqlite3.connect(self.db_filename)
+        self.db.create_function('visit', 2, visit)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.executescript(self.SCHEMA)
+        if migrate and os.path.isfile(self.idx):
+            self.rows = CsvStore(self.idx, max_size).load()
+
+    @property
+    def rows(self):
+        return SqliteRows(self.db)
+
+    @rows.setter
+    def rows(self, rows):
+        with self.transaction():
+            self.db.execute('DELETE FROM grams')
+            self.db.execute('DELETE FROM dirs')
+            for d, ts in rows.items():
+                self.insert(d, ts)
+            self.evict()
+        self.bump()
+
+    def load(self):
+        return dict(self.rows.items())
+
+    def stamp(self):
+        return None  # rows are always read from the database
+
+    def journaled_since(self, mark):
+        return None
+
+    def generation(self):
+        return read_generation(self.generation_filename)
+
+    def bump(self):
+        if self._pending_bump is not None:
+            self._pending_bump = True
+            return
+        bump_generation(self.generation_filename)
+
+    @contextmanager
+    def transaction(self):
+        """Commit the changes made within, unless `deferred`"""
+        if self._pending_bump is not None:
+            yield
+            return
+        with self.db:
+            yield
+
+    @contextmanager
+    def deferred(self):
+        """Make the changes within a single transaction"""
+        if self._pending_bump is not None:
+            yield  # nested, the outermost one commits
+            return
+        self._pending_bump = False
+        try:
+            with self.db:
+                yield
+            bump = self._pending_bump
+        finally:
+            self._pending_bump = None
+        if bump:
+            self.bump()
+
+    def changed(self):
+        return not os.path.isfile(self.db_filename)
+
+    def candidates(self, term, limit):
+        from jay.grams import trigrams
+        grams = list(trigrams(term))
+        if not grams:
+            return []
+        query = """
+            SELECT dirs.path FROM grams JOIN dirs ON dirs.id = grams.dir
+            WHERE grams.gram IN ({})
+            GROUP BY grams.dir ORDER BY count(*) DESC LIMIT ?
+        """.format(', '.join('?' * len(grams)))
+        return [d for d, in self.db.execute(query, grams + [limit])]
+
+    def complete(self, prefix, limit):
+        from jay.grams import WORDS
+        from jay.trie import components
+        prefix = prefix.lower()
+        if not WORDS.match(prefix):
+            return []
+        completions = []
+        for d, ts in self.starting_with([prefix]):
+            if any(c.startswith(prefix) for c in components(d)):
+                completions.append(d)
+                if len(completions) == limit:
+                    break
+        return completions
+
+    def paths(self, terms, limit):
+        from jay.components import best_paths
+        return best_paths(self.starting_with(terms), terms, limit)
+
+    def starting_with(self, prefixes):
+        """The (dir, rank) rows with words starting with each of
+           `prefixes` (and a few more), from the top ranked. Those have
+           all the trigrams of the padded first word of every prefix,
+           which narrows down the dirs to check"""
+        from jay.grams import WORDS
+        grams = set()
+        for prefix in prefixes:
+            word = WORDS.match(prefix.lower())
+            if word:
+                padded = '  ' + word.group()
+                grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+        if not grams:
+            return self.db.execute('SELECT path, ts FROM dirs ORDER BY ts DESC')
+        query = """
+            SELECT dirs.path, dirs.ts FROM grams JOIN dirs ON dirs.id = grams.dir
+            WHERE grams.gram IN ({})
+            GROUP BY grams.dir HAVING count(*) = ? ORDER BY dirs.ts DESC
+        """.format(', '.join('?' * len(grams)))
+        return self.db.execute(query, list(grams) + [len(grams)])
+
+    def visit(self, d, ts, known=False):
+        self.visit_many([d], ts)
+
+    def visit_many(self, dirs, ts, known=()):
+        inserted = False
+        with self.transaction():
+            for d in dirs:
+                # the rank is read and written by a single statement,
+                # which takes the write lock before reading, so that
+                # concurrent visits don't overwrite each other
+                cursor = self.db.execute('UPDATE dirs SET ts = visit(ts, ?) WHERE path = ?',
+                                         (ts, d))
+                if not cursor.rowcount:
+                    self.insert(d, ts)
+                    inserted = True
+            if inserted:
+                self.evict()
+        if inserted:
+            self.bump()
+
+    def update(self, d, ts):
+        self.update_many([(d, ts)])
+
+    def update_many(self, rows):
+        with self.transaction():
+            inserted = False
+            for d, ts in rows:
+                cursor = self.db.execute('UPDATE dirs SET ts = ? WHERE path = ?', (ts, d))
+                if not cursor.rowcount:
+                    self.insert(d, ts)
+                    inserted = True
+            if inserted:
+                self.evict()
+        if inserted:
+            self.bump()
+
+    def delete(self, d):
+        self.delete_many([d])
+
+    def delete_many(self, dirs):
+        with self.transaction():
+            removed = sum(self.remove(self.db.execute('SELECT id FROM dirs WHERE path = ?', (d,)))
+                          for d in dirs)
+        if removed:
+            self.bump()
+
+    def reload(self):
+        pass  # rows are always read from the database
+
+    def dump(self):
+        """Rows are written as they change, just make
+           sure the size of the index is respected"""
+        with self.transaction():
+            evicted = self.evict()
+        if evicted:
+            self.bump()
+
+    def insert(self, d, ts):
+        from jay.grams import trigrams
+        cursor = self.db.execute('INSERT INTO dirs (path, ts) VALUES (?, ?)', (d, ts))
+        self.db.executemany('INSERT INTO grams (gram, dir) VALUES (?, ?)',
+                            ((gram, cursor.lastrowid) for gram in trigrams(d)))
+
+    def evict(self):
+        """Remove the lowest ranked dirs over the max size,
+           returns the number of dirs removed"""
+        size, = self.db.execute('SELECT count(*) FROM dirs').fetchone()
+        if size > self.max_size:
+            return self.remove(self.db.execute('SELECT id FROM dirs ORDER BY ts LIMIT ?',
+                                               (size - self.max_size,)))
+        return 0
+
+    def remove(self, ids):
+        ids = [(i,) for i, in ids]
+        self.db.executemany('DELETE FROM grams WHERE dir = ?', ids)
+        self.db.executemany('DELETE FROM dirs WHERE id = ?', ids)
+        return len(ids)
+
+
+class SqliteRows(Mapping):
+    """Read only {dir: rank} view of the sqlite index"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, d):
+        row = self.db.execute('SELECT ts FROM dirs WHERE path = ?', (d,)).fetchone()
+        if row is None:
+            raise KeyError(d)
+        return row[0]
+
+    def __iter__(self):
+        return (d for d, in self.db.execute('SELECT path FROM dirs'))
+
+    def __len__(self):
+        return self.db.execute('SELECT count(*) FROM dirs').fetchone()[0]
+
+    def items(self):
+        return self.db.execute('SELECT path, ts FROM dirs')  # streamed
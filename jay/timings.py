@@ -0,0 +1,140 @@
+"""Timings and counters of the phases of an invocation, to find out where
+a slow `j` spends its time:
+
+    with timings.phase('load'):  time a phase, adding up repeated ones
+    timings.count('listdir')     add to a counter
+    timings.event('walkdir', level=1, listed=20)  record some stats
+
+Phases may nest, each one is timed whole. Until `enable` is called
+nothing is recorded, `phase` hands out the same do-nothing context
+manager and the rest return right away, so the calls can stay in the
+code paths of every jump.
+"""
+from __future__ import unicode_literals
+import io
+import time
+
+# monotonic clock where there's one (python 3)
+clock = getattr(time, 'perf_counter', time.time)
+
+_enabled = False
+_started = None
+_phases = {}  # name -> [seconds, calls]
+_order = []  # names of the phases as they first started
+_counters = {}
+_events = {}  # kind -> list of dicts
+
+
+class NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null = NullPhase()
+
+
+class Phase(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if self.name not in _phases:
+            _phases[self.name] = [0.0, 0]
+            _order.append(self.name)
+        self.start = clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        totals = _phases[self.name]
+        totals[0] += clock() - self.start
+        totals[1] += 1
+
+
+def enable():
+    """Start recording, forgetting anything recorded before"""
+    global _enabled, _started
+    _enabled = True
+    _started = clock()
+    _phases.clear()
+    del _order[:]
+    _counters.clear()
+    _events.clear()
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def phase(name):
+    if not _enabled:
+        return _null
+    return Phase(name)
+
+
+def count(name, n=1):
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def event(kind, **fields):
+    if _enabled:
+        _events.setdefault(kind, []).append(fields)
+
+
+def summary():
+    """What was recorded, milliseconds for the times"""
+    return {
+        'total_ms': round((clock() - _started) * 1000, 3),
+        'phases': [{'name': name, 'ms': round(_phases[name][0] * 1000, 3),
+                    'calls': _phases[name][1]} for name in _order],
+        'counters': dict(_counters),
+        'events': dict(_events),
+    }
+
+
+def report(stream):
+    """Print what was recorded for a human"""
+    s = summary()
+    lines = ['jay: {:.2f} ms'.format(s['total_ms'])]
+    for p in s['phases']:
+        lines.append('  {:<16} {:>9.2f} ms {:>5}x'.format(p['name'], p['ms'], p['calls']))
+    for name, n in sorted(s['counters'].items()):
+        lines.append('  {:<16} {:>12}'.format(name, n))
+    for kind, events in sorted(s['events'].items()):
+        for fields in events:
+            lines.append('  {} {}'.format(kind, ' '.join(
+                '{}={}'.format(key, value) for key, value in sorted(fields.items()))))
+    stream.write('\n'.join(lines) + '\n')
+
+
+def append(filename, argv):
+    """Append what was recorded as a json line to `filename`"""
+    import json
+    s = summary()
+    s['argv'] = list(argv)
+    s['ts'] = time.time()
+    line = json.dumps(s, sort_keys=True)
+    with io.open(filename, 'a') as f:
+        # one write, lines of concurrent jumps don't get mixed
+        f.write(line + '\n')
+
+
+def profile(filename, fn, *args):
+    """Call `fn(*args)` under cProfile, dumping the stats to `filename`
+       (see them with `python -m pstats filename`)"""
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, *args)
+    finally:
+        profiler.dump_stats(filename)
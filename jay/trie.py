@@ -0,0 +1,95 @@
+"""Trie of the components of the indexed dirs, for completion.
+
+Every node keeps the top ranked dirs having a component that starts
+with the prefix leading to it, so completing a prefix only takes walking
+down its characters, however big the index is.
+"""
+from __future__ import unicode_literals
+import io
+import os
+import marshal
+from jay.files import atomic_write
+
+
+TRIE_TOP_SIZE = 20  # top ranked dirs kept in each node
+
+# a node is a list of [children, top], where children maps the next
+# character to a node and top is a list of [rank, dir] sorted
+# from the top ranked
+CHILDREN = 0
+TOP = 1
+
+
+def components(d):
+    """Lowercased components of the dir `d`"""
+    return set(c.lower() for c in d.split(os.sep) if c)
+
+
+class ComponentTrie(object):
+
+    def __init__(self, top_size=TRIE_TOP_SIZE):
+        self.top_size = top_size
+        self.root = [{}, []]
+        self.dirs = {}  # dir -> rank, of every dir in the trie
+
+    def nodes(self, d):
+        """Nodes of every prefix of every component of `d`"""
+        for component in components(d):
+            node = self.root
+            for char in component:
+                node = node[CHILDREN].setdefault(char, [{}, []])
+                yield node
+
+    def add(self, d, rank):
+        if d in self.dirs:
+            self.discard(d)
+        self.dirs[d] = rank
+        for node in self.nodes(d):
+            top = node[TOP]
+            if len(top) < self.top_size or rank > top[-1][0]:
+                top.append([rank, d])
+                top.sort(reverse=True)
+                del top[self.top_size:]
+
+    def discard(self, d):
+        """Remove `d` from the trie, nodes whose top it was part of keep
+           one less dir until the trie is rebuilt or more dirs added"""
+        if self.dirs.pop(d, None) is None:
+            return
+        for node in self.nodes(d):
+            node[TOP] = [entry for entry in node[TOP] if entry[1] != d]
+
+    def sync(self, rows):
+        """Add and discard dirs so that the trie covers exactly the
+           {dir: rank} `rows`"""
+        for d in set(self.dirs) - set(rows):
+            self.discard(d)
+        for d, rank in rows.items():
+            if self.dirs.get(d) != rank:
+                self.add(d, rank)
+
+    def complete(self, prefix, limit):
+        """The top ranked dirs with a component starting with `prefix`"""
+        node = self.root
+        for char in prefix.lower():
+            node = node[CHILDREN].get(char)
+            if node is None:
+                return []
+        return [d for rank, d in node[TOP][:limit]]
+
+    def dump(self, filename):
+        with atomic_write(filename) as f:
+            marshal.dump((self.top_size, self.root, self.dirs), f)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a persisted trie, None if it's missing or unreadable"""
+        try:
+            with io.open(filename, 'rb') as f:
+                top_size, root, dirs = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        trie = cls(top_size)
+        trie.root = root
+        trie.dirs = dirs
+        return trie
@@ -0,0 +1,232 @@
+"""Keep the index up to date with the filesystem as it changes, using
+linux's inotify (through ctypes) on every dir under some roots.
+
+Created and moved in dirs are added as discovered (see `jay.crawl`),
+removed and moved out dirs are removed from the index along with the
+dirs under them, instead of being found out by a jump that fails.
+Dirs renamed or moved within the roots keep their ranks, and so do the
+dirs under them, at their new paths.
+Events are coalesced until things quiet down, so a `git checkout` or a
+`rm -rf` results in a single batch of writes to the index.
+"""
+from __future__ import unicode_literals
+import os
+import sys
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from os.path import join
+from itertools import chain
+from time import time
+
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+
+EVENT = struct.Struct(str('iIII'))  # wd, mask, cookie, length of the name
+READ_SIZE = 64 * 1024
+
+COALESCE_DELAY = 0.5  # seconds without events before writing to the index
+COALESCE_MAX_DELAY = 5  # max seconds changes wait to be written
+
+ADD = 'add'
+REMOVE = 'remove'
+
+
+class Inotify(object):
+    """Minimal ctypes binding of linux's inotify"""
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "jay: watching dirs needs linux's inotify.")
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            self.raise_errno()
+
+    def raise_errno(self, path=None):
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), path)
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(sys.getfilesystemencoding()), mask)
+        if wd < 0:
+            self.raise_errno(path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """List of (wd, mask, cookie, name) events, empty if there was
+           none in `timeout` seconds (None waits forever)"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.fd, READ_SIZE)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, name.decode(sys.getfilesystemencoding())))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """Applies the changes to the dirs under `roots` to the index of `j`"""
+
+    def __init__(self, j, roots, delay=COALESCE_DELAY, max_delay=COALESCE_MAX_DELAY):
+        self.j = j
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.delay = delay
+        self.max_delay = max_delay
+        self.inotify = Inotify()
+        self.paths = {}  # watch descriptor -> dir
+        self.pending = {}  # dir -> ADD or REMOVE, the last change wins
+        self.pending_since = None
+        self.moved_from = {}  # cookie -> dir moved out, until moved in
+        self.moves = []  # (old dir, new dir) of the dirs moved, in order
+        for root in self.roots:
+            self.watch_tree(root)
+
+    def watch_tree(self, path):
+        """Watch `path` and the dirs under it, returns the dirs watched"""
+        from jay.crawl import children
+        watched = []
+        stack = [path]
+        while stack:
+            d = stack.pop()
+            try:
+                self.paths[self.inotify.add_watch(d)] = d
+                stack.extend(join(d, child) for child in children(d))
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    print("jay: out of inotify watches, raise fs.inotify.max_user_watches.")
+                    break
+                continue  # gone already, or not readable
+            watched.append(d)
+        return watched
+
+    def unwatch_tree(self, path):
+        prefix = path + os.sep
+        for wd, d in list(self.paths.items()):
+            if d == path or d.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.paths[wd]
+
+    def run(self):
+        try:
+            while True:
+                self.poll()
+        finally:
+            self.flush()
+            self.inotify.close()
+
+    def poll(self):
+        """Wait for events and queue their changes, the queue is written
+           once no event came for a while, or it waited for too long"""
+        events = self.inotify.read(self.delay if self.pending else None)
+        for wd, mask, cookie, name in events:
+            self.handle(wd, mask, cookie, name)
+        if self.pending and (not events or time() - self.pending_since > self.max_delay):
+            self.flush()
+
+    def handle(self, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            # events were lost, pick up whatever changed from scratch
+            for root in self.roots:
+                self.queue(self.watch_tree(root), ADD)
+            return
+
+        if mask & IN_IGNORED:
+            self.paths.pop(wd, None)  # the dir was removed
+            return
+
+        if not mask & IN_ISDIR or wd not in self.paths or name.startswith('.'):
+            return
+
+        path = join(self.paths[wd], name)
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            old = self.moved_from.pop(cookie, None) if mask & IN_MOVED_TO else None
+            if old is not None:
+                # the other half of a move within the roots
+                if self.pending.get(old) == REMOVE:
+                    del self.pending[old]
+                self.moves.append((old, path))
+            # dirs may have been created inside before it was watched
+            self.queue(self.watch_tree(path), ADD)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            if mask & IN_MOVED_FROM:
+                self.moved_from[cookie] = path  # removed unless moved in
+            self.unwatch_tree(path)
+            self.queue([path], REMOVE)
+
+    def queue(self, dirs, change):
+        if not self.pending:
+            self.pending_since = time()
+        for d in dirs:
+            self.pending[d] = change
+
+    def flush(self):
+        """Write the queued changes to the index"""
+        from jay.crawl import DISCOVERED_AGE
+        if not self.pending:
+            return
+
+        store = self.j.store
+        if store.changed():
+            store.reload()  # others jumped since we last read it
+        rows = self.j.idx_rows
+
+        moved, gone = self.moved_ranks(rows)
+        removed = set(d for d, change in self.pending.items() if change == REMOVE)
+        if removed or gone:
+            # removing a dir removes the dirs under it too
+            prefixes = tuple(d + os.sep for d in removed)
+            store.delete_many([d for d in list(rows) if d in gone or
+                               d in removed or d.startswith(prefixes)])
+
+        rank = time() - DISCOVERED_AGE
+        store.update_many(list(moved.items()) +
+                          [(d, rank) for d, change in self.pending.items()
+                           if change == ADD and d not in rows and d not in moved])
+        self.pending = {}
+        self.moved_from = {}
+        self.moves = []
+
+    def moved_ranks(self, rows):
+        """The ranks of the dirs moved at their new paths, and the set
+           of their old paths, following the moves in order"""
+        moved = {}
+        gone = set()
+        for old, new in self.moves:
+            prefix = old + os.sep
+            inside = [d for d in set(chain(rows, moved))
+                      if d == old or d.startswith(prefix)]
+            for d in inside:
+                if d in moved:
+                    rank = moved.pop(d)  # moved again
+                elif d in gone:
+                    continue
+                else:
+                    rank = rows[d]
+                    gone.add(d)
+                moved[new + d[len(old):]] = rank
+        return moved, gone
@@ -6,16 +6,47 @@ import mock
 import jay
 import io
 import shutil
+import socket
+import threading
+import subprocess
+import time
+import json
+from contextlib import closing
 from docopt import docopt
 sys.path.insert(0, os.path.abspath('..'))
-from jay import Jay, run, __doc__, relative_of_cwd, walkdir, listdir
+from jay import Jay, Index, run, __doc__, relative_of_cwd, walkdir, listdir, parse_args
+from jay import autocomplete
+from jay import daemon, store, snapshot
+from jay.grams import GramIndex, trigrams
+from jay.trie import ComponentTrie
+from jay.components import ComponentIndex, match_components
+from jay import frecency
+from jay.match import matcher, subsequence_score
+from jay import packed
+from jay.packed import PackedIndex
+from jay.querycache import QueryCache
+from jay.dircache import DirCache
+from jay.files import atomic_write
+from jay import probe
+from jay import timings
+from jay.crawl import crawl, children, DISCOVERED_AGE
+from jay.history import import_history, sniff, visits
+from jay.watch import Watcher
+from fuzzywuzzy import process
 from nose.tools import with_setup, eq_
+from nose.plugins.skip import SkipTest
 
 
 TEST_DIR = os.path.join('tests', os.path.abspath(os.path.dirname(__file__)), 'testdirs')
 TEST_RECENT_IDX_FILENAME = os.path.join(TEST_DIR, 'recent')
 TEST_IDX_FILENAME = os.path.join(TEST_DIR, 'index')
+TEST_JOURNAL_FILENAME = os.path.join(TEST_DIR, 'index.log')
+TEST_GRAMS_FILENAME = os.path.join(TEST_DIR, 'index.grams')
+TEST_TRIE_FILENAME = os.path.join(TEST_DIR, 'index.trie')
 TEST_IDX_MAX_SIZE = 2
+TEST_SOCKET_FILENAME = os.path.join(TEST_DIR, 'socket')
+# extra seconds over a bare interpreter that `j` may take to start up
+STARTUP_BUDGET = float(os.environ.get('JAY_STARTUP_BUDGET', '0.15'))
 
 
 def setup_idx():
@@ -48,7 +79,7 @@ def teardown_both_idx():
 
 
 def _update(jay_instance, directory, update_time):
-    with mock.patch.object(jay, 'time', return_value=update_time):
+    with mock.patch.object(jay, 'time', return_value=float(update_time)):
         jay_instance.update(directory)
 
 
@@ -71,6 +102,71 @@ def test_singleton():
     assert j1 is j2
 
 
+@with_setup(teardown=teardown_both_idx)
+def test_indexes_are_independent():
+    """Indexes opened by path shouldn't share anything, nor be the
+       singleton of the command line"""
+    mkdir('a', 'b')
+    for backend in ('csv', 'binary', 'sqlite'):
+        a = Index(os.path.join(TEST_DIR, 'a', backend), backend=backend)
+        b = Index(os.path.join(TEST_DIR, 'b', backend), backend=backend)
+        assert a is not b and a is not Jay(idx_filename=TEST_IDX_FILENAME)
+        a.update('/projects/web')
+        b.update_many(['/srv/db', '/srv/www'])
+        eq_(sorted(a.load()), ['/projects/web'])
+        eq_(sorted(b.load()), ['/srv/db', '/srv/www'])
+        eq_(Index(os.path.join(TEST_DIR, 'b', backend), backend=backend).fuzzyfind('www'),
+            '/srv/www')
+        b.delete_many(['/srv/db', '/srv/www', '/not/there'])
+        eq_(b.load(), {})
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_update_many_writes_once():
+    """Visits to many dirs should be journaled in a single write, and
+       count like the same visits made one by one"""
+    mkdir('')
+    index = Index(TEST_IDX_FILENAME)
+    with mock.patch.object(index.store, 'log', wraps=index.store.log) as log, \
+            mock.patch.object(jay, 'time', return_value=1387159989.41):
+        index.update_many(['/tmp/dir1', '/tmp/dir2', '/tmp/dir1'])
+    eq_(log.call_count, 1)
+    eq_(index.load(), {'/tmp/dir1': frecency.visit(1387159989.41, 1387159989.41),
+                       '/tmp/dir2': 1387159989.41})
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_deferred_writes_on_the_way_out():
+    """Writes made within `deferred` should only reach the disk when
+       it's left, and be dropped if it's left by an exception"""
+    mkdir('')
+    for backend in ('csv', 'binary', 'sqlite'):
+        filename = os.path.join(TEST_DIR, backend)
+        index = Index(filename, backend=backend)
+        generation = index.store.generation()
+        with index.deferred():
+            index.update('/tmp/dir1')
+            with index.deferred():
+                index.update_many(['/tmp/dir2', '/tmp/dir3'])
+            index.delete('/tmp/dir3')
+            index.dump()
+            eq_(sorted(index.idx_rows), ['/tmp/dir1', '/tmp/dir2'])
+            eq_(Index(filename, backend=backend).load(), {})
+            eq_(index.store.generation(), generation)
+        eq_(sorted(Index(filename, backend=backend).load()), ['/tmp/dir1', '/tmp/dir2'])
+        assert index.store.generation() > generation
+
+        try:
+            with index.deferred():
+                index.delete('/tmp/dir1')
+                index.update('/tmp/dir4')
+                raise KeyboardInterrupt
+        except KeyboardInterrupt:
+            pass
+        eq_(sorted(Index(filename, backend=backend).load()), ['/tmp/dir1', '/tmp/dir2'])
+        eq_(sorted(index.idx_rows), ['/tmp/dir1', '/tmp/dir2'])
+
+
 @with_setup(teardown=teardown_both_idx)
 def test_empty_idx_content_is_loaded_from_file():
     """An empty idx file should be loaded with no entries"""
@@ -83,8 +179,8 @@ def test_empty_idx_content_is_loaded_from_file():
 @with_setup(setup=setup_idx, teardown=teardown_both_idx)
 def test_idx_content_is_loaded_from_file():
     """Idx file entries should be loaded as a dict"""
-    expected_rows = {'/tmp/dir1': '1387159989.41',
-                     '/home/dir2': '1387158735.64'}
+    expected_rows = {'/tmp/dir1': 1387159989.41,
+                     '/home/dir2': 1387158735.64}
     j = Jay(idx_filename=TEST_IDX_FILENAME)
     eq_(j.idx_rows, expected_rows)
 
@@ -97,9 +193,9 @@ def test_dump_max_num_entries():
     d1 = '/test/dir1'
     d2 = '/test/dir2'
     d3 = '/test/dir3'
-    update_time1 = '1100000000.00'
-    update_time2 = '1200000000.00'
-    update_time3 = '1300000000.00'
+    update_time1 = 1100000000.00
+    update_time2 = 1200000000.00
+    update_time3 = 1300000000.00
     expected_output = ['{0},{1}\n'.format(d3, update_time3),
                        '{0},{1}\n'.format(d2, update_time2)]
 
@@ -117,7 +213,7 @@ def test_update_with_new_directory():
     mkdir('')
     assert not os.path.isfile(TEST_IDX_FILENAME)
     d = '/test/dir'
-    update_time = '1387159989.41'
+    update_time = 1387159989.41
     j = Jay(idx_filename=TEST_IDX_FILENAME)
 
     _update(j, d, update_time)
@@ -131,9 +227,9 @@ def test_update_with_existing_directory():
     assert not os.path.isfile(TEST_IDX_FILENAME)
     d = '/test/dir'
     j = Jay(idx_filename=TEST_IDX_FILENAME)
-    future_time = '2222222222.41'
+    future_time = 2222222222.41
 
-    _update(j, d, update_time='1387159989.41')
+    _update(j, d, update_time=1387159989.41)
     _update(j, d, future_time)
     eq_(j.idx_rows, {d: future_time})
 
@@ -145,7 +241,7 @@ def test_delete_with_existing_directory():
     assert not os.path.isfile(TEST_IDX_FILENAME)
     d = '/test/dir'
     j = Jay(idx_filename=TEST_IDX_FILENAME)
-    update_time = '1387159989.41'
+    update_time = 1387159989.41
     _update(j, d, update_time)
 
     j.delete(d)
@@ -168,11 +264,10 @@ def test_updates_are_persisted():
     """Idx updates should be persisted"""
     mkdir('')
     d = '/test/dir'
-    update_time = '1387159989.41'
+    update_time = 1387159989.41
     j = Jay(idx_filename=TEST_IDX_FILENAME)
     _update(j, d, update_time)
-    expected_output = '{0},{1}'.format(d, update_time)
-    eq_(io.open(TEST_IDX_FILENAME).read().strip(), expected_output)
+    eq_(j.load(), {d: update_time})
 
 
 @with_setup(setup=setup_idx, teardown=teardown_both_idx)
@@ -180,8 +275,53 @@ def test_deletions_are_persisted():
     """Idx deletions should be persisted"""
     j = Jay(idx_filename=TEST_IDX_FILENAME)
     j.delete('/tmp/dir1')  # delete an existent entry
-    expected_output = '/home/dir2,1387158735.64' # the other entry
-    eq_(io.open(TEST_IDX_FILENAME).read().strip(), expected_output)
+    eq_(j.load(), {'/home/dir2': 1387158735.64})  # the other entry
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_updates_are_journaled():
+    """Jay.update should append to the journal instead of
+       rewriting (or even reading) the index"""
+    snapshot = io.open(TEST_IDX_FILENAME).read()
+    j = Jay(idx_filename=TEST_IDX_FILENAME)
+    with mock.patch.object(store, 'csv_module') as fake_csv:
+        _update(j, '/test/dir', 1387159999.99)
+    assert not fake_csv.called
+    eq_(io.open(TEST_IDX_FILENAME).read(), snapshot)
+    eq_(io.open(TEST_JOURNAL_FILENAME).read(), 'v 1387159999.99 /test/dir\n')
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_journal_is_replayed_on_load():
+    """Loading the index should replay updates and deletions in order,
+       ignoring a last record cut short by a crash"""
+    with io.open(TEST_JOURNAL_FILENAME, 'w') as f:
+        f.write('u 1387159999.99 /test/dir\n')
+        f.write('d 0 /tmp/dir1\n')
+        f.write('u 1387160000.00 /test/new\x00line\n')
+        f.write('u 1387160001.00 /test/cut')
+    j = Jay(idx_filename=TEST_IDX_FILENAME)
+    eq_(j.load(), {'/home/dir2': 1387158735.64,
+                   '/test/dir': 1387159999.99,
+                   '/test/new\nline': 1387160000.00})
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_journal_is_compacted():
+    """A journal past its max size should be folded into the index,
+       keeping no more than the max idx rows allowed"""
+    mkdir('')
+    j = Jay(idx_filename=TEST_IDX_FILENAME, idx_max_size=TEST_IDX_MAX_SIZE,
+            journal_max_size=64)
+    _update(j, '/test/dir1', 1100000000.00)
+    _update(j, '/test/dir2', 1200000000.00)
+    assert os.path.isfile(TEST_JOURNAL_FILENAME)
+    eq_(io.open(TEST_IDX_FILENAME).read(), '')
+
+    _update(j, '/test/dir3', 1300000000.00)
+    assert not os.path.isfile(TEST_JOURNAL_FILENAME)
+    eq_(io.open(TEST_IDX_FILENAME).readlines(),
+        ['/test/dir3,1300000000.0\n', '/test/dir2,1200000000.0\n'])
 
 
 @with_setup(teardown=teardown_both_idx)
@@ -189,7 +329,7 @@ def test_dump():
     """Dump method should persist idx_rows"""
     mkdir('')
     d = '/test/dir'
-    update_time = '1387159989.41'
+    update_time = 1387159989.41
     expected_output = '{0},{1}'.format(d, update_time)
 
     j = Jay(idx_filename=TEST_IDX_FILENAME,
@@ -204,7 +344,7 @@ def test_dump_unicode_support():
     """Dump method should persist idx_rows"""
     mkdir('')
     d = '/test/éñ'
-    update_time = '1387159989.41'
+    update_time = 1387159989.41
     expected_output = '{0},{1}'.format(d, update_time)
 
     j = Jay(idx_filename=TEST_IDX_FILENAME,
@@ -483,3 +623,1448 @@ def test_walkdir_with_ambiguous_terms():
     touch('dir1/file1')  # caution a file!
     expected_result = os.path.join(TEST_DIR, 'dir1', 'filedir')
     eq_(expected_result, walkdir(TEST_DIR, terms=['file', 'dir1']))
+
+
+@with_setup(teardown=teardown_dirs)
+def test_daemon_answers_forwarded_queries():
+    """A query forwarded to the daemon should print its output and
+       return its exit status"""
+    mkdir('')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(TEST_SOCKET_FILENAME)
+    server.listen(1)
+
+    def serve_once():
+        conn, _ = server.accept()
+        with closing(conn):
+            daemon.handle(conn)
+
+    thread = threading.Thread(target=serve_once)
+    thread.start()
+    fake_stdout = io.StringIO()
+    with closing(server), mock.patch.object(daemon.sys, 'stdout', fake_stdout):
+        status = daemon.forward(['--setup-bash'], TEST_SOCKET_FILENAME)
+    thread.join()
+    eq_(status, 0)
+    eq_(fake_stdout.getvalue().splitlines(),
+        [os.path.join(os.path.dirname(jay.__file__), 'jay.bash'),
+         os.path.join(os.path.dirname(jay.__file__), 'jay-autocomplete.bash')])
+
+
+@with_setup(teardown=teardown_dirs)
+def test_daemon_survives_bad_clients():
+    """Clients sending garbage, or going away before their reply, should
+       be dropped and the daemon should go on answering the next ones"""
+    mkdir('')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(TEST_SOCKET_FILENAME)
+    server.listen(4)
+    for request in (b'not json\n', b'{"cwd": "/"}\n', b'[]\n',
+                    b'{"argv": ["--version"], "cwd": "/"}\n'):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(TEST_SOCKET_FILENAME)
+        client.sendall(request)
+        client.close()  # the last one is gone before its reply
+
+    def serve():
+        for _ in range(5):
+            daemon.accept(server)
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    fake_stdout = io.StringIO()
+    with closing(server), mock.patch.object(daemon.sys, 'stdout', fake_stdout), \
+            mock.patch.object(daemon.sys, 'stderr', io.StringIO()):
+        status = daemon.forward(['--version'], TEST_SOCKET_FILENAME)
+        thread.join()
+    eq_(status, 0)
+    eq_(fake_stdout.getvalue(), jay.__version__ + '\n')
+
+
+@with_setup(setup=setup_idx, teardown=teardown_dirs)
+def test_daemon_drops_the_writes_of_clients_gone():
+    """A jump whose client gave up waiting, and jumped by itself, shouldn't
+       be recorded by the daemon as well"""
+    mkdir('dir1')
+    target = os.path.join(TEST_DIR, 'dir1')
+    for gone in (True, False):
+        client, conn = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        request = {'argv': [target], 'cwd': TEST_DIR}
+        client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        if gone:
+            client.close()
+        cwd = os.getcwd()  # the daemon goes to the cwd of the client
+        try:
+            with closing(conn), \
+                    mock.patch('jay.data_path', lambda basename: os.path.join(TEST_DIR, basename)):
+                daemon.handle(conn)
+        finally:
+            os.chdir(cwd)
+        if not gone:
+            client.close()
+        eq_(target in Jay(idx_filename=TEST_IDX_FILENAME).load(), not gone)
+
+
+@with_setup(teardown=teardown_dirs)
+def test_forward_gives_up_on_a_stuck_daemon():
+    """A daemon that doesn't answer in time should be left alone, for
+       the query to be answered in process"""
+    mkdir('')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(TEST_SOCKET_FILENAME)
+    server.listen(1)
+    with closing(server), mock.patch.object(daemon, 'FORWARD_TIMEOUT', 0.1):
+        start = time.time()
+        eq_(daemon.forward(['foo'], TEST_SOCKET_FILENAME), None)
+    assert time.time() - start < 1
+
+
+def test_only_queries_are_forwarded():
+    """Jumps, lists and completions should go to the daemon, commands
+       that may block it or depend on the client's environment shouldn't"""
+    for argv in ([], ['foo'], ['..', 'dir'], ['--list', '-n', '3', 'foo'], ['--list', '-n3'],
+                 ['--autocomplete', '1', 'j', '--fo']):
+        assert jay.forwarded(argv), argv
+    for argv in (['--daemon'], ['--batch'], ['--crawl'], ['--watch', '/tmp'],
+                 ['--import', 'bash'], ['--version'], ['--setup-bash'], ['--help']):
+        assert not jay.forwarded(argv), argv
+
+
+@with_setup(teardown=teardown_dirs)
+def test_forward_without_daemon():
+    """Without a daemon listening, forward should return None so the
+       query is answered in process"""
+    mkdir('')
+    eq_(daemon.forward(['foo'], TEST_SOCKET_FILENAME), None)
+    touch('socket')  # a stale socket file
+    eq_(daemon.forward(['foo'], TEST_SOCKET_FILENAME), None)
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_idx_is_not_reloaded_if_unchanged():
+    """The daemon reuses the singleton, so the index should only be parsed
+       again when the file changed"""
+    j = Jay(idx_filename=TEST_IDX_FILENAME)
+    j.idx_rows['/in/memory'] = 1387159989.41
+    Jay(idx_filename=TEST_IDX_FILENAME)
+    assert '/in/memory' in j.idx_rows
+
+    with io.open(TEST_IDX_FILENAME, 'w') as f:
+        f.write('/tmp/dir3,1387159999.99\n')
+    Jay(idx_filename=TEST_IDX_FILENAME)
+    eq_(j.idx_rows, {'/tmp/dir3': 1387159999.99})
+
+
+def test_parse_args_matches_docopt():
+    """The hand rolled parser should agree with docopt on the common cases"""
+    for argv in ([], ['foo'], ['foo', 'bar', 'baz'], ['..', 'dir'],
+                 ['--setup-bash'], ['--daemon'], ['--version'], ['--crawl'], ['--watch', '/tmp'],
+                 ['--autocomplete', '1', 'j', 'fo'], ['--list', '-n', '3', 'foo']):
+        eq_(parse_args(list(argv)), docopt(__doc__, argv=list(argv)))
+
+
+def _startup_time(code, env):
+    """Best wall time of a few runs of a fresh interpreter running `code`"""
+    timings = []
+    with io.open(os.devnull, 'w') as devnull:
+        for _ in range(5):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', code], env=env,
+                                  stdout=devnull)
+            timings.append(time.time() - start)
+    return min(timings)
+
+
+@with_setup(teardown=teardown_dirs)
+def test_recent_dir_startup_budget():
+    """Jumping to the recent dir shouldn't import the fuzzy matching,
+       argument parsing or csv machinery, nor take much longer than
+       starting python"""
+    if sys.version_info < (3, 7):
+        raise SkipTest('-X importtime needs python 3.7')
+
+    mkdir('xdg/jay', 'recent')
+    with io.open(os.path.join(TEST_DIR, 'xdg', 'jay', 'recent'), 'w') as f:
+        f.write(os.path.join(TEST_DIR, 'recent'))
+    env = dict(os.environ, XDG_DATA_HOME=os.path.join(TEST_DIR, 'xdg'),
+               PYTHONPATH=os.path.dirname(os.path.dirname(jay.__file__)))
+    code = 'import sys; sys.argv = ["jay"]; import jay; jay.main()'
+
+    importtime = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', code],
+                                  env=env, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, universal_newlines=True)
+    stdout, stderr = importtime.communicate()
+    eq_(stdout.strip(), os.path.join(TEST_DIR, 'recent'))
+    imported = set(line.split('|')[-1].strip() for line in stderr.splitlines())
+    for module in ('docopt', 'fuzzywuzzy', 'fuzzywuzzy.process', 'csv'):
+        assert module not in imported, '{} imported on startup'.format(module)
+
+    overhead = _startup_time(code, env) - _startup_time('pass', env)
+    assert overhead < STARTUP_BUDGET, \
+        'startup took {:.3f}s over the {:.3f}s budget'.format(overhead, STARTUP_BUDGET)
+
+
+@with_setup(teardown=teardown_dirs)
+def test_version_and_setup_bash_skip_the_data_dir():
+    """Printing the version or the bash setup shouldn't import xdg nor
+       create the data dir"""
+    mkdir('')
+    env = dict(os.environ, XDG_DATA_HOME=os.path.join(TEST_DIR, 'xdg'),
+               PYTHONPATH=os.path.dirname(os.path.dirname(jay.__file__)))
+    for flag in ('--version', '--setup-bash'):
+        code = ('import sys; sys.argv = ["jay", "{}"]; import jay; jay.main(); '
+                'print("xdg" in sys.modules)'.format(flag))
+        stdout = subprocess.check_output([sys.executable, '-c', code], env=env,
+                                         universal_newlines=True)
+        eq_(stdout.splitlines()[-1], 'False')
+        assert not os.path.exists(os.path.join(TEST_DIR, 'xdg'))
+
+
+def teardown_timings():
+    timings.disable()
+    probe.disarm()
+    teardown_dirs()
+
+
+def test_timings_disabled():
+    """Nothing should be recorded until timings are enabled"""
+    timings.enable()
+    timings.disable()
+    eq_(timings.phase('load'), timings.phase('dump'))
+    with timings.phase('load'):
+        timings.count('listed', 3)
+        timings.event('walkdir', listed=3)
+    s = timings.summary()
+    eq_((s['phases'], s['counters'], s['events']), ([], {}, {}))
+
+
+@with_setup(teardown=teardown_timings)
+def test_timings_record_phases_counters_and_events():
+    """Enabled timings should add up phases and counters, and keep
+       events, printed for humans or appended as json lines"""
+    mkdir('')
+    timings.enable()
+    for i in range(2):
+        with timings.phase('run'):
+            with timings.phase('load'):
+                timings.count('listed', 3)
+    timings.event('walkdir', term='src', listed=3)
+    s = timings.summary()
+    eq_([(p['name'], p['calls']) for p in s['phases']], [('run', 2), ('load', 2)])
+    assert s['phases'][0]['ms'] >= s['phases'][1]['ms']
+    eq_(s['counters'], {'listed': 6})
+    eq_(s['events'], {'walkdir': [{'term': 'src', 'listed': 3}]})
+
+    stream = io.StringIO()
+    timings.report(stream)
+    lines = stream.getvalue().splitlines()
+    eq_([line.split()[0] for line in lines[1:]], ['run', 'load', 'listed', 'walkdir'])
+    eq_(lines[-1].split()[1:], ['listed=3', 'term=src'])
+
+    metrics = os.path.join(TEST_DIR, 'metrics')
+    timings.append(metrics, ['src'])
+    timings.append(metrics, ['doc'])
+    with io.open(metrics) as f:
+        lines = [json.loads(line) for line in f]
+    eq_([line['argv'] for line in lines], [['src'], ['doc']])
+    eq_(lines[0]['counters'], {'listed': 6})
+
+
+@with_setup(teardown=teardown_timings)
+def test_timings_record_lazy_imports():
+    """The lazy imports of docopt and the fuzzy matcher should be
+       timed in their own phase"""
+    mkdir('')
+    timings.enable()
+    parse_args(['--list', 'src'])
+    matcher('fuzzy')
+    phases = dict((p['name'], p['calls']) for p in timings.summary()['phases'])
+    eq_(phases.get('import'), 2)
+
+
+@with_setup(teardown=teardown_timings)
+def test_main_with_timings():
+    """jay --timings should print the phases of the jump and the stats
+       of each level walked to stderr, and JAY_PROFILE dump cProfile
+       stats"""
+    mkdir('src/projects', 'data')
+    stats = os.path.join(TEST_DIR, 'stats')
+    stderr = io.StringIO()
+    with mock.patch('jay.out'), mock.patch.object(sys, 'stderr', stderr), \
+            mock.patch.object(sys, 'argv', ['jay', '--timings', TEST_DIR, 'sr', 'pro']), \
+            mock.patch.object(jay, 'PROFILE', stats), \
+            mock.patch('jay.data_path', lambda basename: os.path.join(TEST_DIR, 'data', basename)):
+        eq_(jay.main(), 0)
+    lines = stderr.getvalue().splitlines()
+    assert lines[0].startswith('jay: ')
+    phases = [line.split()[0] for line in lines[1:]]
+    for name in ('parse_args', 'run', 'listdir', 'walkdir'):
+        assert name in phases, phases
+    eq_([line.split()[-1] for line in lines if line.split()[0] == 'walkdir'],
+        ['term=sr', 'term=pro'])
+    import pstats
+    assert pstats.Stats(stats).total_calls > 0
+
+
+def test_trigrams():
+    """Trigrams should be taken from each padded, lowercased word"""
+    eq_(trigrams('/My/dir'), set(['  m', ' my', 'my ', '  d', ' di', 'dir', 'ir ']))
+
+
+def test_gram_index_candidates():
+    """GramIndex.candidates should return the dirs sharing the most
+       trigrams with the term, up to a limit"""
+    grams = GramIndex(['/home/projects', '/home/music', '/tmp/proj'])
+    eq_(sorted(grams.candidates('proj', limit=10)), ['/home/projects', '/tmp/proj'])
+    eq_(grams.candidates('projects', limit=1), ['/home/projects'])
+    eq_(grams.candidates('xyz', limit=10), [])
+
+    grams.discard('/home/projects')
+    eq_(grams.candidates('proj', limit=10), ['/tmp/proj'])
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_grams_are_persisted_with_the_snapshot():
+    """The trigram index should be saved by dump and catch up with
+       the journal when loaded"""
+    j = Jay(idx_filename=TEST_IDX_FILENAME)
+    j.store.grams
+    j.dump()
+    eq_(GramIndex.load(TEST_GRAMS_FILENAME).dirs, set(['/tmp/dir1', '/home/dir2']))
+
+    _update(j, '/test/dir3', 1387159999.99)
+    j.delete('/tmp/dir1')
+    eq_(j.store.grams.dirs, set(['/home/dir2', '/test/dir3']))
+
+    j.idx_rows = None  # force loading everything again
+    eq_(j.store.grams.dirs, set(['/home/dir2', '/test/dir3']))
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_grams_only_catch_up_with_the_journal():
+    """The indexes saved along with the snapshot the rows were read from
+       should only look up the journaled dirs, not walk every row"""
+    j = Index(TEST_IDX_FILENAME, backend='binary')
+    j.store.grams
+    j.dump()
+    j = Index(TEST_IDX_FILENAME, backend='binary')
+    _update(j, '/test/dir3', 1387159999.99)
+    j.delete('/tmp/dir1')
+
+    j = Index(TEST_IDX_FILENAME, backend='binary')
+    with mock.patch.object(GramIndex, 'sync') as fake_sync:
+        eq_(j.store.grams.dirs, set(['/home/dir2', '/test/dir3']))
+    assert not fake_sync.called
+
+    # indexes not tied to the snapshot are synced with every row
+    os.remove(TEST_IDX_FILENAME + store.BINARY_SUFFIX + store.INDEXED_SUFFIX)
+    j = Index(TEST_IDX_FILENAME, backend='binary')
+    with mock.patch.object(GramIndex, 'sync', autospec=True) as fake_sync:
+        j.store.grams
+    assert fake_sync.called
+    j.idx_rows = None
+    eq_(j.store.grams.dirs, set(['/home/dir2', '/test/dir3']))
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_compaction_leaves_the_indexes_not_loaded():
+    """A compaction shouldn't load the indexes to rewrite them, the next
+       process loading them syncs them with every row and saves them"""
+    j = Index(TEST_IDX_FILENAME, backend='binary')
+    j.store.grams
+    j.dump()
+    with mock.patch.object(GramIndex, 'load') as fake_load:
+        j = Index(TEST_IDX_FILENAME, backend='binary')
+        _update(j, '/test/dir3', 1387159999.99)
+        j.dump()
+    assert not fake_load.called
+
+    j = Index(TEST_IDX_FILENAME, backend='binary')
+    with mock.patch.object(GramIndex, 'sync', autospec=True,
+                           side_effect=GramIndex.sync) as fake_sync:
+        eq_(j.store.grams.dirs, set(['/tmp/dir1', '/home/dir2', '/test/dir3']))
+    assert fake_sync.called
+
+    # saved then, so the next process only catches up with the journal
+    j = Index(TEST_IDX_FILENAME, backend='binary')
+    j.delete('/tmp/dir1')
+    j = Index(TEST_IDX_FILENAME, backend='binary')
+    with mock.patch.object(GramIndex, 'sync') as fake_sync:
+        eq_(j.store.grams.dirs, set(['/home/dir2', '/test/dir3']))
+    assert not fake_sync.called
+
+
+def _extract_one(term, dirs):
+    """The best match of a full scan, None if no dir matches at all"""
+    match = process.extractOne(term, sorted(dirs), score_cutoff=1)
+    return match[0] if match else None
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_fuzzyfind_ranks_like_a_full_scan():
+    """Pruning candidates with trigrams shouldn't change the best match"""
+    dirs = ['/home/user/projects/jay', '/home/user/projects/api',
+            '/home/user/music', '/usr/local/lib', '/usr/lib/python3',
+            '/tmp/dir1', '/home/dir2', '/var/log/apache2', '/etc/nginx']
+    mkdir('')
+    j = Jay(idx_filename=TEST_IDX_FILENAME)
+    j.idx_rows = {d: 1387159989.41 for d in dirs}
+    for term in ('jay', 'proj', 'api', 'mus', 'lib', 'py', 'dir', 'log',
+                 'ngx', 'usr', 'zzz', 'a'):
+        eq_(j.fuzzyfind(term), _extract_one(term, dirs))
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_fuzzyfind_without_candidates_scores_the_top_ranked_dirs():
+    """A term sharing no trigram with any dir should only score as many
+       of the top ranked dirs as there would be candidates"""
+    mkdir('')
+    j = Index(TEST_IDX_FILENAME)
+    rows = {'/home/dir{}'.format(i): 1387159989.41 + i for i in range(10)}
+    rows['/x/zxqq'] = 1000000000.0
+    j.idx_rows = rows
+    scored = []
+
+    def scores(self, term, choices):
+        scored.extend(choices)
+        return process.extractWithoutOrder(term, choices, score_cutoff=1)
+
+    with mock.patch.object(jay, 'FUZZY_CANDIDATES', 3), \
+            mock.patch('jay.match.FuzzyMatcher.scores', scores):
+        j.fuzzyfind('qqxz')
+    eq_(sorted(scored), ['/home/dir7', '/home/dir8', '/home/dir9'])
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_sqlite_updates_and_deletions():
+    """The sqlite backend should persist updates and deletions right away"""
+    mkdir('')
+    j = Jay(idx_filename=TEST_IDX_FILENAME, backend='sqlite')
+    _update(j, '/test/dir1', 1100000000.00)
+    _update(j, '/test/dir2', 1200000000.00)
+    _update(j, '/test/dir1', 1300000000.00)
+    j.delete('/test/dir2')
+    j.delete('/non/existent/dir')
+    eq_(j.idx_rows, {'/test/dir1': 1300000000.00})
+    eq_(store.SqliteStore(TEST_IDX_FILENAME, 10).load(), {'/test/dir1': 1300000000.00})
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_sqlite_max_num_entries():
+    """The sqlite backend should evict the least recent dirs
+       over the max idx rows allowed"""
+    mkdir('')
+    j = Jay(idx_filename=TEST_IDX_FILENAME, backend='sqlite',
+            idx_max_size=TEST_IDX_MAX_SIZE)
+    _update(j, '/test/dir2', 1200000000.00)
+    _update(j, '/test/dir1', 1100000000.00)
+    _update(j, '/test/dir3', 1300000000.00)
+    eq_(j.idx_rows, {'/test/dir3': 1300000000.00, '/test/dir2': 1200000000.00})
+    eq_(sorted(j.store.candidates('dir', 10)), ['/test/dir2', '/test/dir3'])
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_sqlite_is_migrated_from_csv():
+    """The sqlite index should be created with the entries of the csv index"""
+    with io.open(TEST_JOURNAL_FILENAME, 'w') as f:
+        f.write('u 1387159999.99 /test/dir\n')
+    j = Jay(idx_filename=TEST_IDX_FILENAME, backend='sqlite')
+    eq_(j.idx_rows, {'/tmp/dir1': 1387159989.41,
+                     '/home/dir2': 1387158735.64,
+                     '/test/dir': 1387159999.99})
+    eq_(j.fuzzyfind('dir2'), '/home/dir2')
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_binary_snapshot_is_migrated_from_csv():
+    """The binary index should be created with the entries of the csv index"""
+    j = Jay(idx_filename=TEST_IDX_FILENAME, backend='binary')
+    assert os.path.isfile(TEST_IDX_FILENAME + '.bin')
+    eq_(j.load(), {'/tmp/dir1': 1387159989.41, '/home/dir2': 1387158735.64})
+    eq_(j.fuzzyfind('dir2'), '/home/dir2')
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_binary_snapshot_is_queried_in_place():
+    """Looking up a dir in the binary index shouldn't read every entry"""
+    j = Jay(idx_filename=TEST_IDX_FILENAME, backend='binary')
+    with mock.patch.object(snapshot.Snapshot, 'items') as fake_items:
+        eq_(j.idx_rows['/tmp/dir1'], 1387159989.41)
+        assert '/home/dir2' in j.idx_rows
+        assert '/home/dir3' not in j.idx_rows
+    assert not fake_items.called
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_binary_snapshot_with_journal():
+    """Updates and deletions should be journaled on top of the binary
+       snapshot and folded into it by dump"""
+    mkdir('')
+    j = Jay(idx_filename=TEST_IDX_FILENAME, backend='binary',
+            idx_max_size=TEST_IDX_MAX_SIZE)
+    _update(j, '/test/dir1', 1100000000.0)
+    _update(j, '/test/dir2', 1200000000.0)
+    j.dump()
+    _update(j, '/test/dir3', 1300000000.0)
+    _update(j, '/test/éñ', 1400000000.0)
+    j.delete('/test/dir2')
+    eq_(j.load(), {'/test/dir1': 1100000000.0, '/test/dir3': 1300000000.0,
+                   '/test/éñ': 1400000000.0})
+
+    j.dump()
+    assert not os.path.isfile(TEST_IDX_FILENAME + '.bin.log')
+    eq_(len(snapshot.Snapshot(TEST_IDX_FILENAME + '.bin')), TEST_IDX_MAX_SIZE)
+    eq_(j.load(), {'/test/dir3': 1300000000.0, '/test/éñ': 1400000000.0})
+
+
+@with_setup(teardown=teardown_dirs)
+def test_listdir_does_not_stat_every_entry():
+    """listdir should know which entries are dirs without a stat each"""
+    mkdir('dir1', 'dir2')
+    touch('file')
+    if not hasattr(os, 'scandir'):
+        raise SkipTest('os.scandir needs python 3.5')
+    with mock.patch.object(os.path, 'isdir') as fake_isdir:
+        eq_(['dir1', 'dir2'], listdir(TEST_DIR))
+    assert not fake_isdir.called
+
+
+@with_setup(teardown=teardown_dirs)
+def test_atomic_write_keeps_the_old_file_on_failure():
+    """A file written atomically should be replaced once written, and
+       left as it was if writing it fails"""
+    mkdir('')
+    filename = os.path.join(TEST_DIR, 'file')
+    with atomic_write(filename, 'w') as f:
+        f.write('old')
+    try:
+        with atomic_write(filename, 'w') as f:
+            f.write('new')
+            raise ValueError
+    except ValueError:
+        pass
+    with io.open(filename) as f:
+        eq_(f.read(), 'old')
+    eq_(os.listdir(TEST_DIR), ['file'])
+
+
+@with_setup(teardown=teardown_dirs)
+def test_listdir_cache():
+    """Listings should be cached until the mtime of the dir changes"""
+    mkdir('dir1', 'dir2', 'cache')
+    old = time.time() - 60
+    os.utime(TEST_DIR, (old, old))
+    cache = DirCache(os.path.join(TEST_DIR, 'cache', 'dirs'))
+    with mock.patch.object(jay, '_dircache', cache):
+        eq_(['cache', 'dir1', 'dir2'], listdir(TEST_DIR))
+        cache.save()
+        with mock.patch.object(os, 'scandir') as fake_scandir:
+            eq_(['cache', 'dir1', 'dir2'], listdir(TEST_DIR))
+        assert not fake_scandir.called
+
+        mkdir('dir3')
+        eq_(['cache', 'dir1', 'dir2', 'dir3'], listdir(TEST_DIR))
+
+    eq_(DirCache(os.path.join(TEST_DIR, 'cache', 'dirs')).entries[TEST_DIR][1],
+        ['cache', 'dir1', 'dir2'])
+
+
+@with_setup(teardown=teardown_dirs)
+def test_listdir_cache_skips_recently_modified_dirs():
+    """Listings of dirs modified just now shouldn't be cached"""
+    mkdir('dir1')
+    cache = DirCache(os.path.join(TEST_DIR, 'dirs'))
+    with mock.patch.object(jay, '_dircache', cache):
+        eq_(['dir1'], listdir(TEST_DIR))
+    eq_(cache.entries, {})
+
+
+@with_setup(teardown=teardown_dirs)
+def test_walkdir_beam_recovers_from_a_wrong_pick():
+    """With a beam, a best match near the root that leads nowhere
+       shouldn't hide a better path through a lesser match"""
+    mkdir('src/misc', 'src-old/proj')
+    # nothing in src matches proj at all
+    eq_(os.path.join(TEST_DIR, 'src', ''),
+        walkdir(TEST_DIR, terms=['proj', 'src'], beam_width=1))
+    eq_(os.path.join(TEST_DIR, 'src-old', 'proj'),
+        walkdir(TEST_DIR, terms=['proj', 'src'], beam_width=3))
+
+
+@with_setup(teardown=teardown_dirs)
+def test_walkdir_beam_bounds_listings():
+    """A beam search should list at most `width` paths per term"""
+    mkdir('a1/b1', 'a2/b2', 'a3/b3', 'a4/b4')
+    listed = []
+
+    def fake_listdir(path):
+        listed.append(path)
+        return listdir(path)
+
+    with mock.patch.object(jay, 'listdir', fake_listdir):
+        walkdir(TEST_DIR, terms=['b', 'a'], beam_width=2)
+    eq_(len(listed), 3)  # the root, then the two best matches for `a`
+
+
+def _age(*dirs):
+    """Make the mtime of dirs old enough for their listings to be cached"""
+    old = time.time() - 60
+    for d in dirs:
+        os.utime(os.path.join(TEST_DIR, d), (old, old))
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_crawl_discovers_dirs():
+    """Crawling should add the dirs under the roots as discovered, leaving
+       out hidden dirs, dirs too deep and dirs already in the index"""
+    mkdir('index', 'root/a/b/c', 'root/.git/objects', 'root/d')
+    j = Jay(idx_filename=os.path.join(TEST_DIR, 'index', 'index'))
+    root = os.path.join(TEST_DIR, 'root')
+    _update(j, os.path.join(root, 'd'), 1387159989.41)
+
+    listings = DirCache(os.path.join(TEST_DIR, 'index', 'crawl'))
+    eq_(crawl(j, [root], listings, max_depth=2), (3, 3))
+    rows = j.load()
+    eq_(sorted(rows), [root, os.path.join(root, 'a'),
+                       os.path.join(root, 'a', 'b'), os.path.join(root, 'd')])
+    eq_(rows[os.path.join(root, 'd')], 1387159989.41)
+    assert float(rows[root]) < time.time() - DISCOVERED_AGE + 60
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_crawl_only_lists_changed_dirs():
+    """A crawl should only list again the dirs that changed since the last one"""
+    mkdir('index', 'root/a/b', 'root/c')
+    _age('root', 'root/a', 'root/a/b', 'root/c')
+    j = Jay(idx_filename=os.path.join(TEST_DIR, 'index', 'index'))
+    root = os.path.join(TEST_DIR, 'root')
+    crawl(j, [root], DirCache(os.path.join(TEST_DIR, 'index', 'crawl')))
+
+    mkdir('root/a/new')
+    listed = []
+
+    def fake_children(path):
+        listed.append(path)
+        return children(path)
+
+    with mock.patch('jay.crawl.children', fake_children):
+        added = crawl(j, [root], DirCache(os.path.join(TEST_DIR, 'index', 'crawl')))
+    eq_(added, (1, 1))
+    eq_(listed, [os.path.join(root, 'a'), os.path.join(root, 'a', 'new')])
+    assert os.path.join(root, 'a', 'new') in j.load()
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_crawl_respects_the_entries_budget():
+    """A crawl shouldn't look at more dirs than its budget"""
+    mkdir('index', 'root/a', 'root/b', 'root/c')
+    j = Jay(idx_filename=os.path.join(TEST_DIR, 'index', 'index'))
+    listings = DirCache(os.path.join(TEST_DIR, 'index', 'crawl'))
+    eq_(crawl(j, [os.path.join(TEST_DIR, 'root')], listings, max_entries=2), (2, 2))
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_crawl_discovers_evicted_dirs_again():
+    """A crawl should tell how many dirs a small index kept, and the
+       next crawl should add the evicted ones again, unchanged or not"""
+    mkdir('index', 'root/a', 'root/b', 'root/c')
+    idx = os.path.join(TEST_DIR, 'index', 'index')
+    root = os.path.join(TEST_DIR, 'root')
+    j = Jay(idx_filename=idx, idx_max_size=3)
+    j.update('/visited')
+    eq_(crawl(j, [root], DirCache(os.path.join(TEST_DIR, 'index', 'crawl'))), (4, 2))
+    eq_(len(j.load()), 3)
+
+    j = Jay(idx_filename=idx, idx_max_size=10)
+    eq_(crawl(j, [root], DirCache(os.path.join(TEST_DIR, 'index', 'crawl'))), (2, 2))
+    eq_(len(j.load()), 5)
+    j.delete(os.path.join(root, 'b'))
+    eq_(crawl(j, [root], DirCache(os.path.join(TEST_DIR, 'index', 'crawl'))), (1, 1))
+
+
+def _history(basename, *lines):
+    filename = os.path.join(TEST_DIR, basename)
+    with io.open(filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return filename
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_import_reads_every_format():
+    """Imports should find the dirs visited in shell histories and the
+       data of other jumpers, telling their formats apart"""
+    mkdir('index', 'src/jay/api', 'music', 'photos', 'docs')
+    src = os.path.join(TEST_DIR, 'src')
+    bash = _history('bash_history', '#1387159980', 'ls', '#1387159981', 'cd {}'.format(src),
+                    'cd jay && make', 'cd api; vim x', 'cd -', 'git commit -m "cd nowhere"')
+    zsh = _history('zsh_history', ': 1387159982:0;cd {}/music'.format(TEST_DIR),
+                   ': 1387159983:0;cd "/gone dir"')
+    autojump = _history('autojump.txt', '20.0\t{}/photos'.format(TEST_DIR))
+    z = _history('z', '{}/docs|3|1387159984'.format(TEST_DIR), 'garbage')
+    eq_([sniff(io.open(f).readline()) for f in (bash, zsh, autojump, z)],
+        ['bash', 'zsh', 'autojump', 'z'])
+
+    j = Jay(idx_filename=os.path.join(TEST_DIR, 'index', 'index'))
+    with mock.patch.object(j.store, 'update_many', wraps=j.store.update_many) as update_many:
+        eq_(import_history(j, [bash, zsh, autojump, z]), 6)
+    eq_(update_many.call_count, 1)
+    rows = j.load()
+    eq_(sorted(rows), [os.path.join(TEST_DIR, d) for d in
+                       ('docs', 'music', 'photos', 'src', 'src/jay', 'src/jay/api')])
+    eq_(rows[os.path.join(TEST_DIR, 'music')], 1387159982.0)
+    assert abs(rows[os.path.join(TEST_DIR, 'docs')] - visits(1387159984, 3)) < 1e-3
+    # 4 visits of autojump, weighing 10 * sqrt(4), as of the file mtime
+    assert abs(rows[os.path.join(TEST_DIR, 'photos')] -
+               visits(os.path.getmtime(autojump), 4)) < 1e-3
+    # the one visit to src/jay is back from `cd -` to src/jay/api
+    assert rows[os.path.join(TEST_DIR, 'src', 'jay')] > rows[os.path.join(TEST_DIR, 'src')]
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_import_merges_with_the_index():
+    """Importing should add up the visits imported, and the ones already
+       in the index, of each dir"""
+    mkdir('index', 'music')
+    music = os.path.join(TEST_DIR, 'music')
+    j = Jay(idx_filename=os.path.join(TEST_DIR, 'index', 'index'))
+    _update(j, music, 1387159980)
+    z = _history('z', '{}|1|1387159980'.format(music), '{}/|1|1387159980'.format(music))
+    eq_(import_history(j, [z]), 1)
+    assert abs(j.load()[music] - visits(1387159980, 3)) < 1e-3
+
+
+def test_run_import_reports_missing_sources():
+    """Importing a missing file should fail with a message"""
+    fake_out = mock.Mock()
+    with mock.patch('jay.out', fake_out):
+        eq_(run(parse_args(['--import', '/no/such/history'])), 1)
+    assert '/no/such/history' in fake_out.call_args[0][0]
+
+
+def _watcher(roots):
+    if not sys.platform.startswith('linux'):
+        raise SkipTest('watching dirs needs linux')
+    j = Jay(idx_filename=os.path.join(TEST_DIR, 'index', 'index'))
+    return Watcher(j, roots, delay=0.05)
+
+
+def _poll_until_flushed(watcher):
+    watcher.poll()
+    for _ in range(20):
+        if not watcher.pending:
+            break
+        watcher.poll()
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_watcher_adds_created_dirs():
+    """Dirs created under a watched root should be added to the index,
+       even when created faster than they could be watched"""
+    mkdir('index', 'root')
+    root = os.path.join(TEST_DIR, 'root')
+    watcher = _watcher([root])
+    mkdir('root/a/b/c', 'root/.hidden')
+    _poll_until_flushed(watcher)
+    eq_(sorted(watcher.j.load()), [os.path.join(root, 'a'),
+                                   os.path.join(root, 'a', 'b'),
+                                   os.path.join(root, 'a', 'b', 'c')])
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_watcher_coalesces_and_removes_dirs():
+    """Removing or moving out a dir should remove it and the dirs under it
+       from the index, in a single batch"""
+    mkdir('index', 'root/a/b', 'root/c', 'elsewhere')
+    root = os.path.join(TEST_DIR, 'root')
+    watcher = _watcher([root])
+    j = watcher.j
+    for d in ('a', 'a/b', 'c'):
+        _update(j, os.path.join(root, d), 1387159989.41)
+    _update(j, '/somewhere/else', 1387159989.41)
+
+    shutil.rmtree(os.path.join(root, 'a'))
+    os.rename(os.path.join(root, 'c'), os.path.join(TEST_DIR, 'elsewhere', 'c'))
+    with mock.patch.object(j.store, 'delete_many', wraps=j.store.delete_many) as delete_many:
+        _poll_until_flushed(watcher)
+    eq_(delete_many.call_count, 1)
+    eq_(list(j.load()), ['/somewhere/else'])
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_watcher_moves_ranks_along_with_dirs():
+    """Dirs moved within the roots should keep their ranks and those of
+       the dirs under them at their new paths"""
+    mkdir('index', 'root/a/b', 'root/c')
+    root = os.path.join(TEST_DIR, 'root')
+    watcher = _watcher([root])
+    j = watcher.j
+    _update(j, os.path.join(root, 'a'), 1387159989.41)
+    _update(j, os.path.join(root, 'a', 'b'), 1387158735.64)
+
+    os.rename(os.path.join(root, 'a'), os.path.join(root, 'c', 'd'))
+    _poll_until_flushed(watcher)
+    eq_(j.load(), {os.path.join(root, 'c', 'd'): 1387159989.41,
+                   os.path.join(root, 'c', 'd', 'b'): 1387158735.64})
+
+    os.rename(os.path.join(root, 'c', 'd', 'b'), os.path.join(root, 'e'))
+    _poll_until_flushed(watcher)
+    eq_(j.load(), {os.path.join(root, 'c', 'd'): 1387159989.41,
+                   os.path.join(root, 'e'): 1387158735.64})
+
+
+def test_component_trie_complete():
+    """ComponentTrie.complete should return the most recent dirs with a
+       component starting with the prefix"""
+    trie = ComponentTrie(top_size=2)
+    trie.add('/home/projects', 1300000000.00)
+    trie.add('/tmp/proj', 1100000000.00)
+    trie.add('/home/Music', 1200000000.00)
+    eq_(trie.complete('proj', 10), ['/home/projects', '/tmp/proj'])
+    eq_(trie.complete('mu', 10), ['/home/Music'])
+    eq_(trie.complete('home', 1), ['/home/projects'])
+    eq_(trie.complete('xyz', 10), [])
+
+    trie.add('/tmp/proj', 1400000000.00)
+    eq_(trie.complete('pro', 10), ['/tmp/proj', '/home/projects'])
+    trie.discard('/tmp/proj')
+    eq_(trie.complete('pro', 10), ['/home/projects'])
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_trie_is_persisted_with_the_snapshot():
+    """The component trie should be saved by dump and catch up with
+       the journal when loaded"""
+    j = Jay(idx_filename=TEST_IDX_FILENAME)
+    j.store.trie
+    j.dump()
+    eq_(ComponentTrie.load(TEST_TRIE_FILENAME).complete('dir', 10),
+        ['/tmp/dir1', '/home/dir2'])
+
+    _update(j, '/test/dir3', 1387159999.99)
+    j.delete('/tmp/dir1')
+    j.idx_rows = None  # force loading everything again
+    eq_(j.store.complete('dir', 10), ['/test/dir3', '/home/dir2'])
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_sqlite_complete():
+    """The sqlite backend should complete the components of its dirs"""
+    j = Jay(idx_filename=TEST_IDX_FILENAME, backend='sqlite')
+    eq_(j.store.complete('dir', 10), ['/tmp/dir1', '/home/dir2'])
+    eq_(j.store.complete('ho', 10), ['/home/dir2'])
+    eq_(j.store.complete('ir', 10), [])
+
+
+def test_match_components():
+    """The terms should start components of the dir in order, and
+       resolve to the dir up to the component matching the last one"""
+    eq_(match_components('/home/Projects/jay/api/v1', ['proj', 'api']),
+        '/home/Projects/jay/api')
+    eq_(match_components('/home/projects/jay', ['proj', 'jay']), '/home/projects/jay')
+    eq_(match_components('/home/projects/jay', ['jay', 'proj']), None)
+    eq_(match_components('/home/projects/jay', ['ay', 'proj']), None)
+    eq_(match_components('/home/projects', ['projects', 'projects']), None)
+
+
+def test_component_index_candidates():
+    """ComponentIndex.candidates should return the dirs with components
+       starting with every term"""
+    index = ComponentIndex(['/home/projects/api', '/home/proj/web', '/srv/api'])
+    eq_(index.candidates(['proj', 'api']), set(['/home/projects/api']))
+    eq_(index.candidates(['api']), set(['/home/projects/api', '/srv/api']))
+    eq_(index.candidates(['proj', 'db']), set())
+    index.discard('/home/projects/api')
+    index.add('/home/proj/api')
+    eq_(index.candidates(['proj', 'api']), set(['/home/proj/api']))
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_store_paths():
+    """Every backend should resolve terms to the top ranked dirs matching
+       them component by component, persisting the component index"""
+    mkdir('')
+    rows = {'/home/projects/api/v1': 1300000000.00,
+            '/home/projects/api': 1100000000.00,
+            '/srv/proj/web/api': 1200000000.00,
+            '/srv/api/proj': 1400000000.00}
+    for backend in ('csv', 'binary', 'sqlite'):
+        j = Jay(idx_filename=os.path.join(TEST_DIR, backend), idx_max_size=10, backend=backend)
+        j.idx_rows = rows
+        j.dump()
+        eq_(j.store.paths(['proj', 'api'], 10), ['/home/projects/api', '/srv/proj/web/api'])
+        eq_(j.store.paths(['proj', 'api'], 1), ['/home/projects/api'])
+        eq_(j.store.paths(['api', 'pro'], 10), ['/srv/api/proj'])
+        eq_(j.store.paths(['proj', 'db'], 10), [])
+        j.delete('/home/projects/api/v1')
+        j.store.reload()
+        eq_(j.store.paths(['proj', 'api'], 10), ['/srv/proj/web/api', '/home/projects/api'])
+    eq_(ComponentIndex.load(os.path.join(TEST_DIR, 'csv.components')).dirs, set(rows))
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_run_with_several_terms_tries_the_index_first():
+    """Jumps with several terms should go to the indexed dirs matching
+       them without walking the filesystem, and walk it otherwise"""
+    mkdir('projects/jay/api', 'proj/api', 'other')
+    j = Jay(idx_filename=TEST_IDX_FILENAME)
+    j.idx_rows = {os.path.join(TEST_DIR, 'projects', 'jay', 'api'): 1300000000.00,
+                  os.path.join(TEST_DIR, 'gone', 'projects', 'api'): 1400000000.00}
+    j.dump()
+    fake_dispatch = mock.Mock(return_value=0)
+    fake_walkdir = mock.Mock(return_value=os.path.join(TEST_DIR, 'other'))
+    with mock.patch('jay.dispatch', fake_dispatch), mock.patch('jay.walkdir', fake_walkdir), \
+            mock.patch('jay.data_path', lambda basename: os.path.join(TEST_DIR, basename)):
+        run(parse_args(['proj', 'api']))
+        fake_dispatch.assert_called_once_with(os.path.join(TEST_DIR, 'projects', 'jay', 'api'))
+        eq_(fake_walkdir.call_count, 0)
+        run(parse_args(['oth', 'api']))
+        fake_walkdir.assert_called_once_with('/', terms=['api', 'oth'])
+
+
+def _batch(lines, **kwargs):
+    fake_out = mock.Mock()
+    with mock.patch('jay.out', fake_out), \
+            mock.patch('jay.data_path', lambda basename: os.path.join(TEST_DIR, basename)):
+        eq_(jay.batch(io.StringIO(lines), **kwargs), 0)
+    return [args[0] for args, _ in fake_out.call_args_list]
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_batch_answers_each_line():
+    """A batch should print the dir of each query, or an empty line, and
+       only count them as visits with record"""
+    mkdir('projects/jay/api', 'music')
+    api = os.path.join(TEST_DIR, 'projects', 'jay', 'api')
+    music = os.path.join(TEST_DIR, 'music')
+    j = Jay(idx_filename=TEST_IDX_FILENAME)
+    j.idx_rows = {api: 1300000000.00, music: 1300000000.00, '/gone/dir': 1400000000.00}
+    j.dump()
+    lines = 'music\n\nproj api\n{} proj jay api\ngone\n'.format(TEST_DIR)
+    eq_(_batch(lines), [music, '', api, api, ''])
+    j.store.reload()
+    eq_(j.idx_rows, {api: 1300000000.00, music: 1300000000.00, '/gone/dir': 1400000000.00})
+
+    eq_(_batch(lines, record=True), [music, '', api, api, ''])
+    j.store.reload()
+    assert j.idx_rows[music] > 1300000000.00
+    assert j.idx_rows[api] > 1300000000.00
+    assert '/gone/dir' not in j.idx_rows
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_batch_lists_each_dir_once():
+    """The dirs listed by a query should be reused by the next ones of
+       the batch, and listed again afterwards"""
+    mkdir('projects/jay/api', 'projects/jay/docs')
+    Jay(idx_filename=TEST_IDX_FILENAME)
+    fake_read_dirs = mock.Mock(wraps=jay.read_dirs)
+    with mock.patch('jay.read_dirs', fake_read_dirs):
+        lines = '{0} proj jay api\n{0} proj jay docs\n'.format(TEST_DIR)
+        eq_(_batch(lines), [os.path.join(TEST_DIR, 'projects', 'jay', 'api'),
+                            os.path.join(TEST_DIR, 'projects', 'jay', 'docs')])
+        eq_(fake_read_dirs.call_count, 3)
+        listdir(TEST_DIR)
+        eq_(fake_read_dirs.call_count, 4)
+
+
+def _autocomplete(params, current_position, **kwargs):
+    fake_out = mock.Mock()
+    with mock.patch('jay.out', fake_out), \
+            mock.patch('jay.data_path', lambda basename: os.path.join(TEST_DIR, basename)):
+        autocomplete(params, current_position, **kwargs)
+    return [args[0] for args, _ in fake_out.call_args_list]
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_autocomplete_from_the_index_and_the_filesystem():
+    """Completions should be the dirs of the index with a component
+       starting with the word, then the dirs under the partial path"""
+    mkdir('dirs/dir3', 'dirs/other', 'dirs/.dir4')
+    with mock.patch.object(os, 'getcwd', return_value=TEST_DIR):
+        eq_(_autocomplete(['j', 'dir'], '1'), ['/tmp/dir1', '/home/dir2', 'dirs'])
+    prefix = os.path.join(TEST_DIR, 'dirs', '')
+    eq_(_autocomplete(['j', prefix + 'd'], 1), [prefix + 'dir3'])
+    eq_(_autocomplete(['j', prefix + '.'], 1), [prefix + '.dir4'])
+    eq_(_autocomplete(['j', '/non/existent/d'], 1), [])
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_autocomplete_returns_partial_results_by_the_deadline():
+    """A slow filesystem shouldn't hold completions past the deadline"""
+    def slow_read_dirs(path, cache):
+        time.sleep(1)
+        return ['late']
+
+    start = time.time()
+    with mock.patch('jay.read_dirs', slow_read_dirs):
+        eq_(_autocomplete(['j', 'dir'], 1, deadline=0.2), ['/tmp/dir1', '/home/dir2'])
+    assert time.time() - start < 0.5
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_autocomplete_from_an_index_opened_on_another_thread():
+    """Completions should come from the index when it was opened on
+       another thread, as the daemon does, for every backend"""
+    for backend in ('csv', 'binary', 'sqlite'):
+        index = Index(TEST_IDX_FILENAME, backend=backend)
+        with mock.patch('jay.Jay', return_value=index), \
+                mock.patch.object(os, 'getcwd', return_value=TEST_DIR):
+            eq_(_autocomplete(['j', 'dir'], 1, deadline=1), ['/tmp/dir1', '/home/dir2'])
+
+
+TEST_SLOW_FILENAME = os.path.join(TEST_DIR, 'slow')
+
+
+def teardown_probe():
+    probe.disarm()
+    teardown_dirs()
+
+
+def _hang(path):
+    time.sleep(1)
+    return True
+
+
+@with_setup(teardown=teardown_probe)
+def test_probe_gives_up_on_slow_mounts():
+    """An armed probe should give up when out of time, and skip the
+       mount of the path for a while after"""
+    mkdir('')
+    eq_(probe.call(_hang, '/mnt/nfs'), True)  # unarmed, a plain call
+    probe.arm(0.2, TEST_SLOW_FILENAME)
+    start = time.time()
+    with mock.patch.object(probe, 'mount_of', lambda path: '/mnt/nfs'):
+        try:
+            probe.call(_hang, '/mnt/nfs/projects')
+        except probe.SlowPath:
+            pass
+        else:
+            assert False, 'the probe should have been given up on'
+    assert time.time() - start < 0.5
+
+    # skipped by the next invocations until the cooldown is over
+    probe.arm(0.2, TEST_SLOW_FILENAME)
+    fake_isdir = mock.Mock(return_value=True)
+    with mock.patch.object(os.path, 'isdir', fake_isdir):
+        for path in ('/mnt/nfs', '/mnt/nfs/music', '/mnt/nfs2'):
+            eq_(probe.isdir(path, False), path == '/mnt/nfs2')
+    fake_isdir.assert_called_once_with('/mnt/nfs2')
+    eq_(probe.SlowMounts(TEST_SLOW_FILENAME).until, {'/mnt/nfs': mock.ANY})
+    with mock.patch.object(probe, 'time', return_value=time.time() + probe.SLOW_COOLDOWN):
+        eq_(probe.SlowMounts(TEST_SLOW_FILENAME).until, {})
+
+
+@with_setup(teardown=teardown_probe)
+def test_probe_out_of_budget_doesnt_mark_mounts():
+    """Probes made once the budget is spent should fail without taking
+       their mount for a slow one"""
+    mkdir('')
+    probe.arm(0, TEST_SLOW_FILENAME)
+    eq_(probe.isdir(TEST_DIR, False), False)
+    assert not os.path.exists(TEST_SLOW_FILENAME)
+    probe.arm(1, TEST_SLOW_FILENAME)
+    eq_(probe.isdir(TEST_DIR, False), True)
+
+
+@with_setup(teardown=teardown_dirs)
+def test_mount_of():
+    """Paths should be on the longest mount point they're under, but
+       never on the root mount"""
+    mkdir('')
+    mounts = os.path.join(TEST_DIR, 'mounts')
+    with io.open(mounts, 'w') as f:
+        f.write('/dev/sda1 / ext4 rw 0 0\n'
+                'server:/ /mnt/my\\040nfs nfs rw 0 0\n'
+                'server:/music /mnt/my\\040nfs/music nfs rw 0 0\n')
+    with mock.patch.object(probe, 'MOUNTS_FILENAME', mounts):
+        eq_(probe.mount_of('/mnt/my nfs/music/jazz'), '/mnt/my nfs/music')
+        eq_(probe.mount_of('/mnt/my nfs/src'), '/mnt/my nfs')
+        eq_(probe.mount_of('/mnt/my nfsx'), '/mnt/my nfsx')
+        eq_(probe.mount_of('/home/user'), '/home/user')
+
+
+@with_setup(setup=setup_idx, teardown=teardown_probe)
+def test_jumps_fall_back_to_the_index_on_slow_mounts():
+    """With the filesystem hung, jumps should be answered from the index
+       without forgetting the dirs that can't be checked"""
+    probe.arm(0.2, TEST_SLOW_FILENAME)
+    fake_out = mock.Mock()
+    with mock.patch.object(os.path, 'isdir', _hang), mock.patch('jay.out', fake_out), \
+            mock.patch.object(probe, 'mount_of', lambda path: path), \
+            mock.patch('jay.data_path', lambda basename: os.path.join(TEST_DIR, basename)):
+        start = time.time()
+        eq_(relative_of_cwd('dir1'), None)
+        eq_(run(parse_args(['dir1'])), 0)
+        assert time.time() - start < 0.5
+    fake_out.assert_called_once_with('/tmp/dir1')
+    eq_(sorted(Jay(idx_filename=TEST_IDX_FILENAME).load()), ['/home/dir2', '/tmp/dir1'])
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_top_returns_the_best_matches():
+    """Jay.top should return the k best matches with their scores and
+       ranks, or the top ranked dirs without a term"""
+    mkdir('')
+    j = Jay(idx_filename=TEST_IDX_FILENAME)
+    j.idx_rows = {'/home/projects': 1300000000.00,
+                  '/tmp/proj': 1100000000.00,
+                  '/home/music': 1200000000.00}
+    best = j.top('proj', 2)
+    eq_([(d, ts) for d, score, ts in best],
+        [('/home/projects', 1300000000.00), ('/tmp/proj', 1100000000.00)])
+    assert best[0][1] >= best[1][1]
+    eq_(j.top('proj', 1)[0][0], j.fuzzyfind('proj'))
+    eq_([(d, rank) for d, score, rank in j.top('', 2)],
+        [('/home/projects', 1300000000.00), ('/home/music', 1200000000.00)])
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_run_list():
+    """jay --list should print score, rank and dir of the matches"""
+    fake_out = mock.Mock()
+    with mock.patch('jay.out', fake_out), \
+            mock.patch('jay.data_path', lambda basename: os.path.join(TEST_DIR, basename)):
+        eq_(run(parse_args(['--list', '-n', '1'])), 0)
+        eq_(run(parse_args(['--list', 'dir2'])), 0)
+    lines = [args[0].split('\t') for args, _ in fake_out.call_args_list]
+    eq_(lines[0], ['0.00', '1387159989.41', '/tmp/dir1'])
+    eq_([line[1:] for line in lines[1:]],
+        [['1387158735.64', '/home/dir2'], ['1387159989.41', '/tmp/dir1']])
+
+
+def test_frecency_visits():
+    """A visit should add one to the decayed visits of a dir, and
+       rank a dir visited once at the time of the visit"""
+    eq_(frecency.visit(None, 1300000000.0), 1300000000.0)
+    twice = frecency.visit(1300000000.0, 1300000000.0)
+    # two visits now are worth one visit a half life from now
+    assert abs(twice - (1300000000.0 + frecency.FRECENCY_HALF_LIFE)) < 1e-3
+    # and a visit a half life ago is worth half a visit
+    earlier = frecency.visit(1300000000.0 - frecency.FRECENCY_HALF_LIFE, 1300000000.0)
+    assert abs(frecency.weight(earlier, 1300000000.0) - 1.5 / 2.5) < 1e-9
+    eq_(frecency.weight(0.0, 1300000000.0), 0.0)
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_frecent_dirs_rank_first():
+    """A dir visited often should beat an equally good match visited once
+       more recently, in memory, after replaying the journal, and in sqlite"""
+    mkdir('')
+    now = time.time()
+    for backend in ('csv', 'sqlite'):
+        j = Jay(idx_filename=TEST_IDX_FILENAME, backend=backend)
+        for _ in range(3):
+            _update(j, '/often/dir', now - 3600)
+        _update(j, '/once/dir', now)
+        eq_(j.fuzzyfind('dir'), '/often/dir')
+        j.store.reload()
+        eq_(j.fuzzyfind('dir'), '/often/dir')
+        assert j.idx_rows['/often/dir'] > j.idx_rows['/once/dir']
+
+
+def test_subsequence_score():
+    """The subsequence matcher should reject dirs without the term's
+       characters in order, and prefer basenames, word boundaries
+       and characters in a row"""
+    eq_(subsequence_score('zzz', '/etc/nginx'), None)
+    eq_(subsequence_score('xgn', '/etc/nginx'), None)
+    eq_(subsequence_score('', '/etc/nginx'), 0)
+    eq_(subsequence_score('nginx', '/etc/nginx'), 100)
+    assert subsequence_score('jay', '/home/jay') > subsequence_score('jay', '/home/jay/foo')
+    assert subsequence_score('hp', '/home/projects') > subsequence_score('hp', '/home/aphid')
+    assert subsequence_score('pro', '/home/projects') > subsequence_score('pro', '/home/pxrxo')
+    assert subsequence_score('mp', '/home/MyPhotos') > subsequence_score('mp', '/home/myphotos')
+
+
+def test_matchers_best():
+    """Matchers should return the best matches, ties in the order of the
+       choices, the fuzzy one like fuzzywuzzy's extractOne"""
+    choices = ['/home/projects', '/tmp/proj', '/home/music']
+    eq_(matcher('fuzzy').best('proj', choices, 1)[0], process.extractOne('proj', choices))
+    eq_(matcher('subsequence').best('proj', choices, 5),
+        [('/home/projects', 100), ('/tmp/proj', 100)])
+    try:
+        matcher('nope')
+    except ValueError:
+        pass
+    else:
+        assert False, 'unknown matchers should raise ValueError'
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_fuzzyfind_and_walkdir_with_the_subsequence_matcher():
+    """The matcher picked by config should be used by fuzzyfind and walkdir,
+       even for terms sharing no trigram with the dirs"""
+    mkdir('src/projects/jay', 'src/music')
+    j = Jay(idx_filename=TEST_IDX_FILENAME)
+    j.idx_rows = {'/home/projects': 1300000000.00, '/home/music': 1300000000.00}
+    with mock.patch('jay.MATCHER', 'subsequence'):
+        eq_(j.fuzzyfind('pjs'), '/home/projects')
+        eq_(j.fuzzyfind('zzz'), None)
+        for beam_width in (1, 3):
+            eq_(walkdir(TEST_DIR, ['jy', 'pj', 'src'], beam_width),
+                os.path.join(TEST_DIR, 'src', 'projects', 'jay'))
+
+
+def _packed_dirs():
+    return [('/home/user/projects/jay', 1300000000.00), ('/home/user/music', 1300000000.00),
+            ('/usr/lib/python3', 1200000000.00), ('/tmp/jay', 1100000000.00),
+            ('/var/log/apache2', 1300000000.00)]
+
+
+def test_packed_candidates():
+    """The packed index should pick the dirs with the most characters and
+       pairs of characters of the term, top ranked first on ties"""
+    if packed.numpy is None:
+        raise SkipTest('the packed index is only used along with numpy')
+    index = PackedIndex(_packed_dirs())
+    eq_(index.candidates('jay', 2), ['/home/user/projects/jay', '/tmp/jay'])
+    eq_(index.candidates('pyth', 1), ['/usr/lib/python3'])
+    eq_(index.candidates('@@@', 10), [])
+
+    index.discard('/home/user/projects/jay')
+    index.add('/srv/jay', 1400000000.00)
+    index.add('/tmp/jay', 1500000000.00)
+    eq_(index.candidates('jay', 2), ['/tmp/jay', '/srv/jay'])
+
+
+@with_setup(teardown=teardown_dirs)
+def test_packed_index_is_persisted():
+    """Dumping the packed index should fold in the dirs added and removed"""
+    mkdir('')
+    filename = os.path.join(TEST_DIR, 'index.packed')
+    index = PackedIndex(_packed_dirs())
+    index.sync(dict(_packed_dirs()[1:] + [('/srv/jay', 1400000000.00)]))
+    index.dump(filename)
+    loaded = PackedIndex.load(filename)
+    eq_(sorted(loaded.dirs), ['/home/user/music', '/srv/jay', '/tmp/jay',
+                              '/usr/lib/python3', '/var/log/apache2'])
+    eq_(loaded.extra, {})
+    if packed.numpy is not None:
+        eq_(loaded.candidates('jay', 2), ['/srv/jay', '/tmp/jay'])
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_fuzzyfind_with_packed_candidates():
+    """Large indexes should pick their fuzzy candidates from the packed
+       index, ranking like a full scan"""
+    mkdir('')
+    if packed.numpy is None:
+        raise SkipTest('the packed index is only used along with numpy')
+    dirs = [d for d, rank in _packed_dirs()]
+    j = Jay(idx_filename=TEST_IDX_FILENAME)
+    j.idx_rows = {d: 1387159989.41 for d in dirs}
+    with mock.patch.object(store, 'PACKED_MIN_SIZE', 1):
+        for term in ('jay', 'mus', 'lib', 'py', 'log', 'zzz'):
+            eq_(j.fuzzyfind(term), _extract_one(term, dirs))
+        j.dump()
+        assert os.path.isfile(TEST_IDX_FILENAME + '.packed')
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_query_cache_answers_without_scoring():
+    """A term searched before should be answered from the query cache,
+       without loading nor scoring the index"""
+    j = Jay(idx_filename=TEST_IDX_FILENAME)
+    eq_(j.fuzzyfind('dir1'), '/tmp/dir1')
+    j.queries.save()  # as a jump does once it's dispatched
+    j.update('/tmp/dir1')  # a visit to a dir in the index
+    j.store.reload()
+    j._queries = None  # read the cache from disk again
+    with mock.patch.object(Jay, 'fuzzy_scores') as fake_scores, \
+            mock.patch.object(store.CsvStore, 'read') as fake_read:
+        eq_(j.fuzzyfind('dir1'), '/tmp/dir1')
+    assert not fake_scores.called
+    assert not fake_read.called
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_query_cache_follows_frecency():
+    """Visits should change the answer to a cached term like they change
+       the best match, for every backend"""
+    mkdir('')
+    alpha, beta = '/tmp/qc/alpha/proj', '/tmp/qc/beta/proj'
+    for backend in ('csv', 'binary', 'sqlite'):
+        j = Index(os.path.join(TEST_DIR, backend), backend=backend)
+        with mock.patch.object(jay, 'time', return_value=1387159989.41):
+            j.update_many([alpha, beta, beta])
+            eq_(j.fuzzyfind('proj'), beta)
+            j.update_many([alpha] * 20)
+            eq_(j.top('proj', 1)[0][0], alpha)
+            with mock.patch.object(Index, 'fuzzy_scores') as fake_scores:
+                eq_(j.fuzzyfind('proj'), alpha)
+            assert not fake_scores.called
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_query_cache_catches_up_with_other_processes():
+    """A cached term should follow the visits made by other processes,
+       before and after they compact the index"""
+    mkdir('')
+    alpha, beta = '/tmp/qc/alpha/proj', '/tmp/qc/beta/proj'
+    for backend in ('csv', 'binary', 'sqlite'):
+        filename = os.path.join(TEST_DIR, backend)
+        j = Index(filename, backend=backend)
+        other = Index(filename, backend=backend)
+        with mock.patch.object(jay, 'time', return_value=1387159989.41):
+            j.update_many([alpha, alpha, beta])
+            eq_(j.fuzzyfind('proj'), alpha)
+            j.queries.save()
+            other.idx_rows  # visits to dirs it knows don't bump the generation
+            other.update_many([beta] * 2)
+            other.update_many([beta])
+            with mock.patch.object(Index, 'fuzzy_scores') as fake_scores:
+                eq_(j.fuzzyfind('proj'), beta)
+                other.dump()
+                other.update_many([alpha] * 3)
+                eq_(j.fuzzyfind('proj'), alpha)
+            assert not fake_scores.called
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_fuzzyfind_agrees_with_top_on_many_ties():
+    """The best match should be the same as the top listed one, however
+       many dirs tie on their fuzzy score"""
+    mkdir('')
+    j = Index(TEST_IDX_FILENAME)
+    j.idx_rows = {'/a/p{:02}/docs'.format(i): 1000000000.0 for i in range(25)}
+    with mock.patch.object(jay, 'time', return_value=1387159989.41):
+        j.update('/z/docs')
+        for i in range(2):  # scored, then cached
+            eq_(j.fuzzyfind('docs'), '/z/docs')
+            eq_(j.top('docs', 1)[0][0], '/z/docs')
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_query_cache_is_invalidated_by_new_dirs():
+    """Adding or removing dirs should bump the index generation and
+       empty the query cache, for every backend"""
+    for backend in ('csv', 'binary', 'sqlite'):
+        j = Jay(idx_filename=TEST_IDX_FILENAME, backend=backend)
+        j.delete('/test/dir1')
+        eq_(j.fuzzyfind('dir1'), '/tmp/dir1')
+        generation = j.store.generation()
+        _update(j, '/test/dir1', 1387159999.99)
+        assert j.store.generation() > generation
+        eq_(j.fuzzyfind('dir1'), '/test/dir1')
+        generation = j.store.generation()
+        j.delete('/test/dir1')
+        assert j.store.generation() > generation
+        eq_(j.fuzzyfind('dir1'), '/tmp/dir1')
+
+
+@with_setup(teardown=teardown_dirs)
+def test_query_cache_evicts_the_least_recently_used():
+    """The query cache should keep at most max_size terms, forgetting
+       the least recently used ones"""
+    mkdir('')
+    fake_store = mock.Mock()
+    fake_store.generation.return_value = 1
+    fake_store.loaded_mark = None
+    fake_store.rows = {'/a': 1.0, '/b': 1.0, '/c': 1.0, '/cc': 2.0}
+    cache = QueryCache(os.path.join(TEST_DIR, 'queries'), fake_store, max_size=2)
+    cache.set('a', [('/a', 90, 1.0)])
+    cache.set('b', [('/b', 90, 1.0)])
+    eq_(cache.get('a'), [('/a', 90, 1.0)])
+    cache.set('c', [('/c', 90, 1.0), ('/cc', 85, 2.0)])
+    cache.save()
+    cache = QueryCache(os.path.join(TEST_DIR, 'queries'), fake_store, max_size=2)
+    eq_(cache.get('b'), None)
+    eq_(cache.get('a'), [('/a', 90, 1.0)])
+    eq_(cache.get('c'), [('/c', 90, 1.0), ('/cc', 85, 2.0)])
+    cache.discard('/cc')
+    eq_(cache.get('c'), None)
+    cache.set('c', [('/c', 90, 1.0)])
+    fake_store.generation.return_value = 2
+    eq_(cache.get('c'), None)
+
+
+@with_setup(setup=setup_idx, teardown=teardown_both_idx)
+def test_dispatch_drops_cached_queries_of_missing_dirs():
+    """Jumping to a cached dir that no longer exists should forget it"""
+    j = Jay(idx_filename=TEST_IDX_FILENAME)
+    j.update('/non/existent/dir')
+    j.queries.set('gone', [('/non/existent/dir', 90, j.idx_rows['/non/existent/dir'])])
+    with mock.patch('jay.out'):
+        eq_(jay.dispatch(j.fuzzyfind('gone')), 1)
+    eq_(j.queries.get('gone'), None)
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_deferred_writes_lose_no_update():
+    """With deferred writes, rapid jumps should print their dir right
+       away and still get every visit to the index, across compactions"""
+    mkdir('data')
+    if not hasattr(os, 'fork'):
+        raise SkipTest('deferring writes needs fork')
+    # long paths, so that the journal gets compacted along the way
+    parent = os.path.join('a' * 250, 'b' * 250)
+    dirs = [os.path.join(TEST_DIR, parent, str(i)) for i in range(30)]
+    mkdir(*[os.path.join(parent, str(i)) for i in range(30)])
+    env = dict(os.environ, XDG_DATA_HOME=os.path.join(TEST_DIR, 'data'),
+               JAY_DEFER_WRITES='1')
+    jumps = [subprocess.Popen([sys.executable, '-c', 'import sys, jay; sys.exit(jay.main())', d],
+                              env=env, stdout=subprocess.PIPE) for d in dirs]
+    for d, jump in zip(dirs, jumps):
+        eq_(jump.communicate()[0].decode('utf-8').strip(), d)
+
+    # the children writing the index may still be at it
+    idx = os.path.join(TEST_DIR, 'data', 'jay', 'index')
+    deadline = time.time() + 10
+    rows = {}
+    while len(rows) < len(dirs) and time.time() < deadline:
+        time.sleep(0.05)
+        rows = store.CsvStore(idx, 100).load()
+    eq_(sorted(rows), sorted(dirs))
+    assert os.path.getsize(idx) > 0, 'the journal should have been compacted'
+
+
+UPDATER = '''
+import sys, time
+from jay import store
+backend, idx, worker, visits = sys.argv[1:]
+s = getattr(store, backend)(idx, 1000, 512)
+for i in range(int(visits)):
+    s.visit('/worker{}/dir{}'.format(worker, i), time.time())
+    s.visit('/shared', time.time())
+'''
+
+
+def stress_store(backend):
+    mkdir('')
+    idx = os.path.join(TEST_DIR, 'index')
+    workers, visits = 8, 40
+    start = time.time()
+    updaters = [subprocess.Popen([sys.executable, '-c', UPDATER, backend, idx,
+                                  str(worker), str(visits)])
+                for worker in range(workers)]
+    eq_([updater.wait() for updater in updaters], [0] * workers)
+    end = time.time()
+
+    rows = getattr(store, backend)(idx, 1000).load()
+    eq_(sorted(d for d in rows if d != '/shared'),
+        sorted('/worker{}/dir{}'.format(worker, i)
+               for worker in range(workers) for i in range(visits)))
+    # every visit to the shared dir was counted once
+    count = frecency.math.log(workers * visits) / frecency.DECAY
+    assert start + count - 1 <= rows['/shared'] <= end + count + 1, rows['/shared']
+    assert end - start < 60, '{} updates took {:.1f}s'.format(
+        2 * workers * visits, end - start)
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_csv_store_concurrent_updates():
+    """Parallel updaters compacting the journal shouldn't lose updates"""
+    stress_store('CsvStore')
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_binary_store_concurrent_updates():
+    """Parallel updaters of the binary index shouldn't lose updates"""
+    stress_store('BinaryStore')
+
+
+@with_setup(teardown=teardown_both_idx)
+def test_sqlite_store_concurrent_updates():
+    """Parallel updaters of the sqlite index shouldn't lose updates"""
+    stress_store('SqliteStore')